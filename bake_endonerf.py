@@ -0,0 +1,238 @@
+from run_endonerf import config_parser, create_nerf, render_path, query_deformation, add_device_args, configure_device, DEVICE_ARGS
+from run_endonerf_helpers import *
+import os
+import json
+import time
+import configargparse
+from tqdm import tqdm
+
+
+'''
+Setup
+'''
+
+# replaced by the device of --device in __main__
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+'''
+Bake a trained model into a sparse voxel grid
+'''
+
+###################################################################################################
+# Usage Example
+###################################################################################################
+
+# python bake_endonerf.py --config_file configs/example.txt --resolution 256 --deform_resolution 64
+
+###################################################################################################
+
+
+def lattice(bbox_min, bbox_max, resolution):
+    """Grid vertices [R^3, 3] in (x, y, z), enumerated in (z, y, x) order."""
+    axes = [torch.linspace(float(bbox_min[k]), float(bbox_max[k]), resolution) for k in range(3)]
+    zz, yy, xx = torch.meshgrid(axes[2], axes[1], axes[0], indexing='ij')
+    return torch.stack([xx, yy, zz], -1).reshape(-1, 3)
+
+
+def query_points(network_query_fn, network_fn, pts, dirs, t, chunk):
+    """Evaluate the network at single points, each one treated as a ray with one sample."""
+    raw_list = []
+    dx_list = []
+    for i in range(0, pts.shape[0], chunk):
+        pts_c = pts[i:i+chunk]
+        dirs_c = dirs[i:i+chunk] if dirs is not None else None
+        frame_time = t * torch.ones_like(pts_c[:, :1])
+        raw, dx = network_query_fn(pts_c[:, None], dirs_c, frame_time, network_fn)
+        raw_list += [raw[:, 0]]
+        dx_list += [dx[:, 0]]
+    return torch.cat(raw_list, 0), torch.cat(dx_list, 0)
+
+
+def fitting_dirs(hwf, n_dirs):
+    """Unit viewing directions of the reference camera on a sqrt(n_dirs)^2 pixel grid."""
+    H, W, focal = hwf
+    _, rays_d = get_rays(H, W, focal, torch.eye(4)[:3, :4])
+    n = max(int(np.ceil(np.sqrt(n_dirs))), 2)
+    rows = torch.linspace(0, H - 1, n).long()
+    cols = torch.linspace(0, W - 1, n).long()
+    dirs = rays_d[rows][:, cols].reshape(-1, 3)
+    return dirs / torch.norm(dirs, dim=-1, keepdim=True)
+
+
+def bake(render_kwargs, times, hwf, bbox_min, bbox_max, resolution=128, deform_resolution=64,
+         sh_degree=2, n_dirs=16, alpha_thresh=5e-3, chunk=1024*64):
+    """Evaluate the canonical network on an occupancy-pruned grid and the deformation network per frame.
+    Returns a dict that can be saved with torch.save and loaded by BakedGrid.load.
+    """
+    network_query_fn = render_kwargs['network_query_fn']
+    model = render_kwargs['network_fine'] if render_kwargs['network_fine'] is not None else render_kwargs['network_fn']
+    canonical = model._occ if hasattr(model, '_occ') else model
+    if isinstance(model, TNeRF):
+        raise ValueError("tnerf has no canonical space and cannot be baked")
+    use_viewdirs = render_kwargs['use_viewdirs']
+    if not use_viewdirs:
+        sh_degree = 0
+
+    bbox_min = torch.Tensor(bbox_min)
+    bbox_max = torch.Tensor(bbox_max)
+
+    # Density at every grid vertex; it does not depend on the viewing direction
+    pts = lattice(bbox_min, bbox_max, resolution)
+    dirs = torch.Tensor([[0., 0., -1.]]).expand(pts.shape) if use_viewdirs else None
+    raw, _ = query_points(network_query_fn, canonical, pts, dirs, 0., chunk)
+    sigma = F.relu(raw[:, 3]).reshape(resolution, resolution, resolution)
+
+    # Prune empty space, dilated by one voxel to keep the trilinear support of occupied cells
+    voxel_len = torch.norm((bbox_max - bbox_min) / (resolution - 1))
+    occupied = (1. - torch.exp(-sigma * voxel_len)) > alpha_thresh
+    occupied = F.max_pool3d(occupied[None, None].float(), 3, stride=1, padding=1)[0, 0] > 0
+    print('Occupied voxels: {} / {} ({:.2f}%)'.format(int(occupied.sum()), occupied.numel(), 100. * occupied.float().mean().item()))
+
+    index = -torch.ones(occupied.shape, dtype=torch.long)
+    index[occupied] = torch.arange(int(occupied.sum()))
+    pts_occ = pts[occupied.reshape(-1)]
+
+    # Least-squares projection of the colour logits onto the SH basis
+    n_coeffs = (sh_degree + 1) ** 2
+    if use_viewdirs:
+        dirs = fitting_dirs(hwf, max(n_dirs, n_coeffs))
+        basis_pinv = torch.linalg.pinv(sh_basis(dirs, sh_degree))  # [n_coeffs, K]
+    else:
+        dirs = None
+        basis_pinv = torch.ones(1, 1) / SH_C0
+
+    K = dirs.shape[0] if dirs is not None else 1
+    density = []
+    sh = []
+    pts_chunk = max(chunk // K, 1)
+    for i in range(0, pts_occ.shape[0], pts_chunk):
+        p = pts_occ[i:i+pts_chunk]
+        p_rep = p[:, None].expand([p.shape[0], K, 3]).reshape(-1, 3)
+        d_rep = dirs[None].expand([p.shape[0], K, 3]).reshape(-1, 3) if dirs is not None else None
+        raw, _ = query_points(network_query_fn, canonical, p_rep, d_rep, 0., chunk)
+        raw = raw.reshape(p.shape[0], K, -1)
+        density += [raw[..., 3].mean(-1)]
+        sh += [torch.einsum('ck,nkj->njc', basis_pinv, raw[..., :3])]
+    density = torch.cat(density, 0)
+    sh = torch.cat(sh, 0)
+
+    # Per-frame deformation from observation to canonical space, the canonical network is not needed
+    pts = lattice(bbox_min, bbox_max, deform_resolution)
+    deform = []
+    for t in tqdm(times):
+        dx = torch.cat([query_deformation(network_query_fn, pts[i:i+chunk, None], float(t) * torch.ones_like(pts[i:i+chunk, :1]), model)[:, 0]
+                        for i in range(0, pts.shape[0], chunk)], 0)
+        deform += [dx.t().reshape(3, deform_resolution, deform_resolution, deform_resolution).half()]
+    deform = torch.stack(deform, 0)
+
+    return {
+        'bbox_min': bbox_min,
+        'bbox_max': bbox_max,
+        'index': index.int(),
+        'density': density,
+        'sh': sh,
+        'sh_degree': sh_degree,
+        'deform': deform,
+        'times': torch.Tensor(np.asarray(times, dtype=np.float32)),
+    }
+
+
+def psnr_report(render_kwargs, baked, render_times, hwf, nerf_args):
+    """Render the same frames with the MLP and the baked grid, compare speed and PSNR."""
+    render_poses = torch.eye(4)[None, :3, :4].expand([len(render_times), 3, 4]).to(device)
+    render_times = torch.Tensor(render_times).to(device)
+    baked_kwargs = dict(render_kwargs)
+    baked_kwargs['baked'] = baked
+
+    with torch.no_grad():
+        t0 = time.time()
+        rgbs_mlp, disps_mlp = render_path(render_poses, render_times, hwf, nerf_args.chunk, render_kwargs,
+                                          render_factor=nerf_args.render_factor)
+        t_mlp = time.time() - t0
+        t0 = time.time()
+        rgbs_baked, disps_baked = render_path(render_poses, render_times, hwf, nerf_args.chunk, baked_kwargs,
+                                              render_factor=nerf_args.render_factor)
+        t_baked = time.time() - t0
+
+    psnrs = [mse2psnr(img2mse(torch.Tensor(a), torch.Tensor(b))).item() for a, b in zip(rgbs_baked, rgbs_mlp)]
+    return {
+        'n_frames': len(psnrs),
+        'psnr_vs_mlp': float(np.mean(psnrs)),
+        'psnr_vs_mlp_per_frame': psnrs,
+        'disp_mae_vs_mlp': float(np.mean(np.abs(disps_baked - disps_mlp))),
+        'sec_per_frame_mlp': t_mlp / len(psnrs),
+        'sec_per_frame_baked': t_baked / len(psnrs),
+        'speedup': t_mlp / max(t_baked, 1e-9),
+    }
+
+
+if __name__ == '__main__':
+    cfg_parser = configargparse.ArgumentParser()
+    cfg_parser.add_argument('--config_file', type=str,
+                        help='config file path')
+    cfg_parser.add_argument('--reload_ckpt', type=str, default='',
+                        help='model ckpt to reload')
+    cfg_parser.add_argument('--out_postfix', type=str, default='',
+                        help='the postfix append to the output directory name')
+    cfg_parser.add_argument("--resolution", type=int, default=128,
+                        help='resolution of the canonical density/colour grid')
+    cfg_parser.add_argument("--deform_resolution", type=int, default=64,
+                        help='resolution of the per-frame deformation grid')
+    cfg_parser.add_argument("--sh_degree", type=int, default=2,
+                        help='degree of spherical harmonics for view-dependent colour (0-2)')
+    cfg_parser.add_argument("--n_dirs", type=int, default=16,
+                        help='num of viewing directions used to fit SH coefficients')
+    cfg_parser.add_argument("--alpha_thresh", type=float, default=5e-3,
+                        help='voxels with lower opacity are pruned')
+    cfg_parser.add_argument("--bbox_min", nargs=3, type=float, default=[-1., -1., -1.],
+                        help='lower corner of the baked volume (NDC by default)')
+    cfg_parser.add_argument("--bbox_max", nargs=3, type=float, default=[1., 1., 1.],
+                        help='upper corner of the baked volume (NDC by default)')
+    cfg_parser.add_argument("--n_frames", type=int, default=0,
+                        help='num of deformation frames, 0 to use all frames in poses_bounds.npy')
+    cfg_parser.add_argument("--n_report_frames", type=int, default=4,
+                        help='num of frames rendered for the PSNR-vs-MLP report, 0 to skip')
+    add_device_args(cfg_parser)
+
+    cfg = cfg_parser.parse_args()
+
+    nerf_parser = config_parser()
+    nerf_args = nerf_parser.parse_args(f'--config {cfg.config_file}')
+    for k in DEVICE_ARGS:
+        setattr(nerf_args, k, getattr(cfg, k))
+    device = configure_device(nerf_args)
+
+    if cfg.reload_ckpt:
+        setattr(nerf_args, 'ft_path', os.path.join(nerf_args.basedir, nerf_args.expname, cfg.reload_ckpt))
+
+    poses_arr = np.load(os.path.join(nerf_args.datadir, 'poses_bounds.npy'))
+    H, W, focal = poses_arr[0, :-2].reshape([3, 5])[:, -1]
+    hwf = [int(H) // nerf_args.factor, int(W) // nerf_args.factor, focal / nerf_args.factor]
+    n_frames = cfg.n_frames if cfg.n_frames > 0 else poses_arr.shape[0]
+    times = np.linspace(0., 1., n_frames)
+
+    _, render_kwargs_test, epoch, _, _, _ = create_nerf(nerf_args, training=False)
+    render_kwargs_test.update({'near' : 0., 'far' : 1.})
+
+    out_dir = os.path.join(nerf_args.basedir, nerf_args.expname, f"baked_{epoch}" + (f"_{cfg.out_postfix}" if cfg.out_postfix else ""))
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    cfg_parser.write_config_file(cfg, [os.path.join(out_dir, 'args.txt')])
+
+    print('Baking...')
+    with torch.no_grad():
+        baked_dict = bake(render_kwargs_test, times, hwf, cfg.bbox_min, cfg.bbox_max, resolution=cfg.resolution,
+                          deform_resolution=cfg.deform_resolution, sh_degree=cfg.sh_degree, n_dirs=cfg.n_dirs,
+                          alpha_thresh=cfg.alpha_thresh, chunk=nerf_args.netchunk)
+    baked_path = os.path.join(out_dir, 'baked.tar')
+    torch.save({k: (v.cpu() if torch.is_tensor(v) else v) for k, v in baked_dict.items()}, baked_path)
+    print('Baked grid saved to', baked_path)
+
+    if cfg.n_report_frames > 0:
+        baked = BakedGrid.load(baked_path, device, chunk=nerf_args.netchunk)
+        report = psnr_report(render_kwargs_test, baked, np.linspace(0., 1., cfg.n_report_frames), hwf, nerf_args)
+        print('PSNR vs MLP: {:.2f} dB, {:.3f}s vs {:.3f}s per frame ({:.1f}x)'.format(
+            report['psnr_vs_mlp'], report['sec_per_frame_baked'], report['sec_per_frame_mlp'], report['speedup']))
+        with open(os.path.join(out_dir, 'bake_report.json'), 'w') as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,77 @@
+import os, sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+import json
+import re
+import subprocess
+import time
+
+
+###################################################################################################
+# Usage Example
+###################################################################################################
+
+# python benchmarks/bench_coarse_to_fine.py --config configs/cutting.txt --target_psnr 30 --N_iter 20000 --c2f_iters 1000 3000
+
+###################################################################################################
+
+
+def run_training(args, expname, extra_args):
+    """Trains with the config until the target PSNR is reached or N_iter ends, returns the
+    time to the target PSNR reported by train() and the wall time of the whole run."""
+    cmd = [sys.executable, args.script, '--config', args.config, '--expname', expname,
+           '--N_iter', str(args.N_iter), '--target_psnr', str(args.target_psnr), '--no_reload',
+           '--i_testset', str(10**9), '--i_video', str(10**9), '--i_img', str(10**9)] + extra_args
+    if args.basedir:
+        cmd += ['--basedir', args.basedir]
+    t0 = time.time()
+    out = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    wall = time.time() - t0
+    if out.returncode != 0:
+        print(out.stdout)
+        raise RuntimeError('training of {} failed'.format(expname))
+
+    m = re.search(r'\[TARGET\] PSNR \S+ reached at iter (\d+) after ([\d.]+) s', out.stdout)
+    return {
+        'target_iter': int(m.group(1)) if m else None,
+        'time_to_target_sec': float(m.group(2)) if m else None,
+        'wall_sec': wall,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, required=True,
+                        help='config file of the training')
+    parser.add_argument("--script", type=str, default=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'run_endonerf.py'),
+                        help='training script')
+    parser.add_argument("--basedir", type=str, default='',
+                        help='where to store the experiments, the basedir of the config if empty')
+    parser.add_argument("--target_psnr", type=float, default=30.,
+                        help='full resolution training PSNR to reach')
+    parser.add_argument("--N_iter", type=int, default=20000,
+                        help='max num of iterations per run')
+    parser.add_argument("--c2f_iters", type=int, nargs='+', default=[1000, 3000],
+                        help='coarse-to-fine schedule of the compared run')
+    parser.add_argument("--out", type=str, default='',
+                        help='write the results to this json file')
+    args = parser.parse_args()
+
+    c2f_args = ['--c2f_iters'] + [str(it) for it in args.c2f_iters]
+    results = {
+        'target_psnr': args.target_psnr,
+        'c2f_iters': args.c2f_iters,
+        'baseline': run_training(args, 'bench_c2f_baseline', []),
+        'coarse_to_fine': run_training(args, 'bench_c2f', c2f_args),
+        'coarse_to_fine_no_pe_anneal': run_training(args, 'bench_c2f_no_pe', c2f_args + ['--c2f_no_pe_anneal']),
+    }
+    base = results['baseline']['time_to_target_sec']
+    for name in ['coarse_to_fine', 'coarse_to_fine_no_pe_anneal']:
+        t = results[name]['time_to_target_sec']
+        results[name]['speedup'] = base / t if base is not None and t is not None else None
+
+    print(json.dumps(results, indent=2))
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,154 @@
+import os, sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import copy
+import json
+import tempfile
+import time
+
+from run_endonerf import *
+
+
+###################################################################################################
+# Usage Example
+###################################################################################################
+
+# python benchmarks/bench_compile.py --config configs/cutting.txt --methods none compile torchscript
+# python benchmarks/bench_compile.py --config configs/cutting.txt --methods none compile --compile_mode reduce-overhead
+
+###################################################################################################
+
+
+def sync():
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+
+def make_model(args, method):
+    args = copy.deepcopy(args)
+    args.compile = method
+    args.no_reload = True
+    args.basedir = tempfile.mkdtemp()  # create_nerf lists the checkpoints of the experiment
+    os.makedirs(os.path.join(args.basedir, args.expname))
+    args.autotune_chunks = False
+    args.occupancy_grid = False
+    torch.manual_seed(0)
+    render_kwargs_train, render_kwargs_test, _, _, optimizer, _ = create_nerf(args)
+    render_kwargs_train['use_depth'] = True
+    render_kwargs_test.update({'near': 0., 'far': 1.})
+    return render_kwargs_train, render_kwargs_test, optimizer
+
+
+def make_steps(args, hwf, data, method):
+    """The training step (ray sampling, render, losses, backward and optimizer step) and the
+    inference step (one chunk of rays rendered without gradients) with the networks compiled
+    by 'method'. Both take the frame index, frame 0 is at the canonical time 0."""
+    images, poses, times, ray_importance_maps, depth_maps = data
+    render_kwargs_train, render_kwargs_test, optimizer = make_model(args, method)
+    H, W, focal = hwf
+    train_step = TrainStep(args.N_rand, images, poses, ray_importance_maps=ray_importance_maps, depth_maps=depth_maps)
+    outputs = ['rgb_map', 'rgb0', 'disp_map']
+
+    def train(img_i):
+        batch_rays, target_s, depth_s, _ = train_step.sample(img_i, H, W, focal)
+        render_kwargs_train.update({'near': torch.add(depth_s, 1e-6, out=train_step.pool.get('near', depth_s.shape)),
+                                    'far': args.depth_sampling_sigma})
+        rgb, disp, _, extras = train_step.render(H, W, focal, args.chunk, batch_rays, times[img_i], render_kwargs_train,
+                                                 outputs=outputs)
+        optimizer.zero_grad()
+        loss = img2mse(rgb, target_s) + F.huber_loss(1.0 / (disp + 1e-6), depth_s, delta=0.2)
+        if 'rgb0' in extras:
+            loss = loss + img2mse(extras['rgb0'], target_s)
+        loss.backward()
+        optimizer.step()
+        return loss.item()
+
+    rays_o, rays_d = get_rays(H, W, focal, poses[0])
+    chunk_rays = torch.stack([rays_o.reshape(-1, 3)[:args.chunk], rays_d.reshape(-1, 3)[:args.chunk]], 0)
+
+    def inference(img_i):
+        with torch.no_grad():
+            rgb, _, _, _ = render(H, W, focal, chunk=args.chunk, rays=chunk_rays, frame_time=times[img_i],
+                                  outputs=['rgb_map', 'disp_map'], **render_kwargs_test)
+        return rgb
+
+    return train, inference
+
+
+def timed(fn, frames, iters):
+    times = []
+    out = None
+    for k in range(iters):
+        sync()
+        t0 = time.perf_counter()
+        out = fn(frames[k % len(frames)])
+        sync()
+        times.append(time.perf_counter() - t0)
+    return float(np.median(times)) * 1000., out
+
+
+def bench(args, hwf, data, method):
+    """Compile time (the first calls, until every frame time has been seen) and step time of
+    both steps, and the inference outputs to compare the methods."""
+    train, inference = make_steps(args, hwf, data, method)
+    frames = list(range(data[0].shape[0]))
+    result = {}
+    for name, fn in [('train', train), ('inference', inference)]:
+        np.random.seed(0)
+        t0 = time.perf_counter()
+        for k in frames * args.warmup:
+            fn(k)
+        sync()
+        result[name + '_warmup_s'] = time.perf_counter() - t0
+        result[name + '_step_ms'], _ = timed(fn, frames, args.iters)
+    result['inference_rgb'] = [inference(k) for k in frames]
+    return result
+
+
+if __name__ == '__main__':
+    parser = config_parser()
+    parser.add_argument("--hwf", nargs=3, type=float, default=[512, 640, 569.46820041],
+                        help='image height, width and focal length')
+    parser.add_argument("--methods", type=str, nargs='+', default=['none', 'compile', 'torchscript'],
+                        help='compile methods to compare, see --compile')
+    parser.add_argument("--n_frames", type=int, default=2,
+                        help='num of random training frames, the first at time 0')
+    parser.add_argument("--iters", type=int, default=20,
+                        help='num of timed steps')
+    parser.add_argument("--warmup", type=int, default=2,
+                        help='num of untimed steps per frame, the first compile the graphs')
+    parser.add_argument("--out", type=str, default='',
+                        help='write the results to this json file')
+    args = parser.parse_args()
+    configure_device(args)
+    hwf = [int(args.hwf[0]), int(args.hwf[1]), args.hwf[2]]
+
+    # run_endonerf_helpers enables anomaly detection globally, its checks would dominate the timings
+    torch.autograd.set_detect_anomaly(False)
+
+    H, W, _ = hwf
+    torch.manual_seed(0)
+    masks = (torch.rand(args.n_frames, H, W) > 0.2).float()
+    data = (torch.rand(args.n_frames, H, W, 3), torch.eye(4)[None, :3, :4].repeat(args.n_frames, 1, 1),
+            torch.linspace(0., 1., args.n_frames), ray_sampling_importance_from_masks(masks),
+            torch.rand(args.n_frames, H, W) * 0.5 + 0.25)
+
+    results = {}
+    for method in args.methods:
+        results[method] = bench(args, hwf, data, method)
+    reference = results[args.methods[0]]
+    reference_rgb = reference['inference_rgb']
+    for method, r in results.items():
+        # Same initial weights, inputs and training steps, the inference outputs only differ by the
+        # rounding of the fused kernels accumulated over the steps
+        r['inference_max_abs_diff'] = max(float((a - b).abs().max()) for a, b in zip(r.pop('inference_rgb'), reference_rgb))
+
+    print('{:12s} {:>14s} {:>12s} {:>18s} {:>16s} {:>10s}'.format('method', 'train ms/step', 'speedup', 'inference ms/chunk', 'speedup', 'max diff'))
+    for method, r in results.items():
+        print('{:12s} {:14.2f} {:11.2f}x {:18.2f} {:15.2f}x {:10.2e}   (warmup {:.1f} s + {:.1f} s)'.format(
+            method, r['train_step_ms'], reference['train_step_ms'] / r['train_step_ms'], r['inference_step_ms'],
+            reference['inference_step_ms'] / r['inference_step_ms'], r['inference_max_abs_diff'],
+            r['train_warmup_s'], r['inference_warmup_s']))
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,105 @@
+import os, sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+import json
+import time
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from run_endonerf import COMPOSITORS, raw2outputs, set_default_device
+from tests.test_compositing import random_inputs, reference_raw2outputs
+
+
+###################################################################################################
+# Usage Example
+###################################################################################################
+
+# python benchmarks/bench_compositing.py --n_rays 2048 --n_samples 128 --iters 50
+
+###################################################################################################
+
+
+def timeit(fns, iters, warmup):
+    """Median wall time of one call in ms for each of fns, calls are interleaved so that
+    load changes on the machine affect all of them alike."""
+    times = [[] for _ in fns]
+    for k in range(iters + warmup):
+        for fn, t in zip(fns, times):
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+            t0 = time.time()
+            fn()
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+            if k >= warmup:
+                t.append(time.time() - t0)
+    return [float(np.median(t)) * 1000. for t in times]
+
+
+def bench_function(name, args):
+    torch.manual_seed(0)
+    raw, z_vals, rays_d = random_inputs(args.n_rays, args.n_samples, args.density_scale)
+    compositor = COMPOSITORS[name]
+    new = lambda raw, outputs=None: raw2outputs(raw, z_vals, rays_d, compositor=compositor, outputs=outputs)
+    ref = lambda raw: reference_raw2outputs(raw, z_vals, rays_d, name)
+
+    # Forward parity, compared on the finite entries (tan can legitimately overflow); the
+    # parity itself is asserted by tests/test_compositing.py
+    result = {}
+    out_new, out_ref = new(raw), ref(raw)
+    for key, a, b in zip(['rgb_map', 'disp_map', 'acc_map', 'weights', 'depth_map'], out_new, out_ref):
+        finite = torch.isfinite(a) & torch.isfinite(b)
+        result['max_abs_diff_' + key] = (a[finite] - b[finite]).abs().max().item() if finite.any() else 0.
+
+    # Forward
+    with torch.no_grad():
+        result['ref_forward_ms'], result['new_forward_ms'], result['new_forward_rgb_only_ms'] = timeit(
+            [lambda: ref(raw), lambda: new(raw), lambda: new(raw, outputs=('rgb_map',))], args.iters, args.warmup)
+
+    # Forward + backward through the rgb map
+    raw_grad = raw.clone().requires_grad_(True)
+    def step(fn):
+        raw_grad.grad = None
+        fn(raw_grad)[0].sum().backward()
+    result['ref_backward_ms'], result['new_backward_ms'] = timeit(
+        [lambda: step(ref), lambda: step(new)], args.iters, args.warmup)
+    result['forward_speedup'] = result['ref_forward_ms'] / result['new_forward_ms']
+    result['backward_speedup'] = result['ref_backward_ms'] / result['new_backward_ms']
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_rays", type=int, default=2048,
+                        help='num of rays per call, the N_rand of a training step')
+    parser.add_argument("--n_samples", type=int, default=128,
+                        help='num of samples per ray, N_samples + N_importance')
+    parser.add_argument("--density_scale", type=float, default=5.,
+                        help='std of the random raw densities')
+    parser.add_argument("--iters", type=int, default=50,
+                        help='num of timed calls per function')
+    parser.add_argument("--warmup", type=int, default=5,
+                        help='num of untimed calls per function')
+    parser.add_argument("--functions", type=str, nargs='+', default=list(COMPOSITORS.keys()),
+                        help='volumetric functions to benchmark')
+    parser.add_argument("--out", type=str, default='',
+                        help='write the results to this json file')
+    args = parser.parse_args()
+
+    # run_endonerf_helpers enables anomaly detection globally, its checks would dominate the timings
+    torch.autograd.set_detect_anomaly(False)
+
+    if torch.cuda.is_available():
+        set_default_device('cuda')
+
+    results = {name: bench_function(name, args) for name in args.functions}
+    for name, r in results.items():
+        print('{:18s} fwd {:7.3f} -> {:7.3f} ms ({:.2f}x)  fwd+bwd {:7.3f} -> {:7.3f} ms ({:.2f}x)  max |diff| rgb {:.2e}'.format(
+            name, r['ref_forward_ms'], r['new_forward_ms'], r['forward_speedup'],
+            r['ref_backward_ms'], r['new_backward_ms'], r['backward_speedup'], r['max_abs_diff_rgb_map']))
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
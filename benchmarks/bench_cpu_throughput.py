@@ -0,0 +1,67 @@
+import os, sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import json
+import time
+
+from run_endonerf import *
+
+
+###################################################################################################
+# Usage Example
+###################################################################################################
+
+# python benchmarks/bench_cpu_throughput.py --config configs/cutting.txt --threads 1 4 8 16 --chunks 1024 4096 16384 32768
+
+###################################################################################################
+
+
+def render_throughput(args, render_kwargs, hwf, chunk, netchunk, n_frames):
+    """Rays/s of rendering n_frames frames at render_factor as render_path() does."""
+    args.netchunk = netchunk  # read by network_query_fn on every call
+    poses = torch.eye(4)[None, :3, :4].expand([n_frames, 3, 4])
+    times = torch.linspace(0., 1., n_frames)
+    t0 = time.time()
+    with torch.no_grad():
+        rgbs, _ = render_path(poses, times, hwf, chunk, render_kwargs, render_factor=args.render_factor)
+    return rgbs.shape[0] * rgbs.shape[1] * rgbs.shape[2] / (time.time() - t0)
+
+
+if __name__ == '__main__':
+    parser = config_parser()
+    parser.add_argument("--threads", type=int, nargs='+', default=[],
+                        help='intra-op thread counts to benchmark, default the cores of the cpu_affinity')
+    parser.add_argument("--chunks", type=int, nargs='+', default=[1024, 4096, 16384, 32768],
+                        help='chunk sizes to benchmark, netchunk is 4 x chunk')
+    parser.add_argument("--n_frames", type=int, default=2,
+                        help='num of rendered frames per measurement')
+    parser.add_argument("--hwf", nargs=3, type=float, default=[512, 640, 569.46820041],
+                        help='image height, width and focal length')
+    parser.add_argument("--out", type=str, default='',
+                        help='write the results to this json file')
+    args = parser.parse_args()
+    args.device = 'cpu'
+    configure_device(args)
+    hwf = [int(args.hwf[0]), int(args.hwf[1]), args.hwf[2]]
+
+    # Weights of the latest checkpoint if there is one, the throughput does not depend on them
+    args.autotune_chunks = False
+    _, render_kwargs, _, _, _, _ = create_nerf(args, training=False)
+    render_kwargs.update({'near': 0., 'far': 1.})
+
+    threads = args.threads if len(args.threads) > 0 else [torch.get_num_threads()]
+    results = {'render_factor': args.render_factor, 'runs': []}
+    for n_threads in threads:
+        torch.set_num_threads(n_threads)
+        for chunk in args.chunks:
+            rays_per_sec = render_throughput(args, render_kwargs, hwf, chunk, 4 * chunk, args.n_frames)
+            results['runs'].append({'threads': n_threads, 'chunk': chunk, 'netchunk': 4 * chunk, 'rays_per_sec': rays_per_sec})
+            print('threads {:3d} chunk {:6d} netchunk {:6d}: {:9.0f} rays/s'.format(n_threads, chunk, 4 * chunk, rays_per_sec))
+
+    best = max(results['runs'], key=lambda r: r['rays_per_sec'])
+    results['best'] = best
+    print('Best: --num_threads {} --chunk {} --netchunk {} ({:.0f} rays/s)'.format(
+        best['threads'], best['chunk'], best['netchunk'], best['rays_per_sec']))
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,66 @@
+import os, sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+import json
+import re
+import subprocess
+
+
+###################################################################################################
+# Usage Example
+###################################################################################################
+
+# python benchmarks/bench_ddp_scaling.py --config configs/cutting.txt --max_nproc 4 --N_iter 200
+
+###################################################################################################
+
+
+def run_training(args, nproc):
+    """Trains N_iter iterations on nproc ranks, returns the training loop time reported by rank 0."""
+    launcher = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'run_endonerf_ddp.py')
+    cmd = [sys.executable, launcher, '--nproc', str(nproc), '--master_port', str(args.master_port),
+           '--config', args.config, '--expname', 'bench_ddp_{}'.format(nproc), '--N_iter', str(args.N_iter), '--no_reload',
+           '--i_weights', str(10**9), '--i_testset', str(10**9), '--i_video', str(10**9), '--i_img', str(10**9)]
+    if args.basedir:
+        cmd += ['--basedir', args.basedir]
+    out = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    m = re.search(r'Trained (\d+) iterations in ([\d.]+) s', out.stdout)
+    if out.returncode != 0 or m is None:
+        print(out.stdout)
+        raise RuntimeError('training on {} ranks failed'.format(nproc))
+    return int(m.group(1)), float(m.group(2))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, required=True,
+                        help='config file of the training')
+    parser.add_argument("--basedir", type=str, default='',
+                        help='where to store the experiments, the basedir of the config if empty')
+    parser.add_argument("--max_nproc", type=int, default=4,
+                        help='the training runs on 1, 2, ... max_nproc ranks')
+    parser.add_argument("--N_iter", type=int, default=200,
+                        help='num of iterations per run')
+    parser.add_argument("--N_rand", type=int, default=2048,
+                        help='N_rand of the config, to report rays/s')
+    parser.add_argument("--master_port", type=int, default=29500,
+                        help='free port of rank 0 for the process group')
+    parser.add_argument("--out", type=str, default='',
+                        help='write the results to this json file')
+    args = parser.parse_args()
+
+    results = {}
+    for nproc in range(1, args.max_nproc + 1):
+        n_iters, t = run_training(args, nproc)
+        results[nproc] = {
+            'iters_per_sec': n_iters / t,
+            'rays_per_sec': n_iters * nproc * args.N_rand / t,
+        }
+        results[nproc]['scaling_efficiency'] = results[nproc]['rays_per_sec'] / (nproc * results[1]['rays_per_sec'])
+        print('{} rank(s): {:8.2f} it/s {:10.0f} rays/s  efficiency {:.2f}'.format(
+            nproc, results[nproc]['iters_per_sec'], results[nproc]['rays_per_sec'], results[nproc]['scaling_efficiency']))
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
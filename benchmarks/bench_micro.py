@@ -0,0 +1,231 @@
+import os, sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import copy
+import json
+import platform
+import subprocess
+import tempfile
+import time
+
+from run_endonerf import *
+
+
+###################################################################################################
+# Usage Example
+###################################################################################################
+
+# python benchmarks/bench_micro.py --config configs/cutting.txt --out micro_baseline.json
+# python benchmarks/bench_micro.py --config configs/cutting.txt --baseline micro_baseline.json --only raw2outputs render_rays
+
+###################################################################################################
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_CONFIG = os.path.join(ROOT, 'configs', 'cutting.txt')
+NERF_TYPES = ['original', 'direct_temporal', 'recurrent_temporal', 'tnerf']
+
+
+def sync():
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+
+def timeit(fn, iters, warmup):
+    """Median, min and max wall time of one call in ms."""
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(iters):
+        sync()
+        t0 = time.perf_counter()
+        fn()
+        sync()
+        times.append(time.perf_counter() - t0)
+    return {'ms': float(np.median(times)) * 1000., 'min_ms': float(np.min(times)) * 1000., 'max_ms': float(np.max(times)) * 1000.}
+
+
+def backward_fn(fn, params):
+    """fn() followed by the backward pass of the sum of its first output."""
+    def step():
+        for p in params:
+            p.grad = None
+        out = fn()
+        (out[0] if isinstance(out, (tuple, list)) else out).sum().backward()
+    return step
+
+
+def make_model(args, nerf_type):
+    args = copy.deepcopy(args)
+    args.nerf_type = nerf_type
+    args.no_reload = True
+    args.basedir = tempfile.mkdtemp()  # create_nerf lists the checkpoints of the experiment
+    os.makedirs(os.path.join(args.basedir, args.expname))
+    args.autotune_chunks = False
+    args.occupancy_grid = False
+    render_kwargs_train, render_kwargs_test, _, grad_vars, _, _ = create_nerf(args)
+    for kwargs in [render_kwargs_train, render_kwargs_test]:
+        kwargs.update({'near': 0., 'far': 1.})
+    return render_kwargs_train, render_kwargs_test, grad_vars
+
+
+def benchmarks(args, hwf):
+    """Name -> (fn, params of the backward pass or None) of the benchmarked calls, with inputs
+    of the training shapes: N_rand rays of N_samples + N_importance samples at frame time 0.5."""
+    H, W, focal = hwf
+    N_rand, N_samples, N_importance = args.N_rand, args.N_samples, args.N_importance
+    N_pts = N_rand * (N_samples + N_importance)
+    torch.manual_seed(0)
+    benches = {}
+
+    # Positional encoding of positions, times and view directions
+    embed_fn, _ = get_embedder(args.multires, 3, args.i_embed)
+    embedtime_fn, _ = get_embedder(args.multires, 1, args.i_embed)
+    embeddirs_fn, _ = get_embedder(args.multires_views, 3, args.i_embed)
+    pts_flat = torch.rand(N_pts, 3) * 2. - 1.
+    benches['embed/position'] = (lambda: embed_fn(pts_flat), None)
+    benches['embed/time'] = (lambda: embedtime_fn(torch.full([N_pts, 1], 0.5)), None)
+    benches['embed/viewdirs'] = (lambda: embeddirs_fn(pts_flat), None)
+
+    # Rays of a full frame, as generated for rendering and for the training batches
+    c2w = torch.eye(4)[:3, :4]
+    rays_o, rays_d = get_rays(H, W, focal, c2w)
+    benches['rays/get_rays'] = (lambda: get_rays(H, W, focal, c2w), None)
+    benches['rays/ndc_rays'] = (lambda: ndc_rays(H, W, focal, 1., rays_o, rays_d), None)
+
+    # Ray batch of the training step, in NDC as render() passes it to render_rays()
+    inds = torch.randint(0, H * W, [N_rand])
+    batch_o, batch_d = ndc_rays(H, W, focal, 1., rays_o.reshape(-1, 3)[inds], rays_d.reshape(-1, 3)[inds])
+    viewdirs = rays_d.reshape(-1, 3)[inds]
+    viewdirs = viewdirs / torch.norm(viewdirs, dim=-1, keepdim=True)
+    ones = torch.ones_like(batch_o[..., :1])
+    ray_batch = torch.cat([batch_o, batch_d, 0. * ones, ones, 0.5 * ones, viewdirs], -1)
+    pts = batch_o[:, None] + batch_d[:, None] * torch.rand(N_rand, N_samples + N_importance, 1)
+
+    # Importance sampling along the rays and of the pixel coordinates of a frame
+    z_vals = torch.linspace(0., 1., N_samples).expand([N_rand, N_samples])
+    z_vals_mid = .5 * (z_vals[..., 1:] + z_vals[..., :-1])
+    weights = torch.rand(N_rand, N_samples)
+    ray_importance_map = torch.rand(1, H * W)
+    benches['sampling/importance_sampling_ray'] = (lambda: importance_sampling_ray(z_vals_mid, weights[..., 1:-1], N_importance, det=True), None)
+    benches['sampling/importance_sampling_coords'] = (lambda: importance_sampling_coords(ray_importance_map, N_rand), None)
+
+    # Compositing of the samples of the fine pass with every volumetric function
+    raw = torch.randn(N_rand, N_samples + N_importance, 4)
+    raw_grad = raw.clone().requires_grad_(True)
+    z_vals_all, _ = torch.sort(torch.rand(N_rand, N_samples + N_importance), -1)
+    for name, compositor in COMPOSITORS.items():
+        benches['raw2outputs/' + name] = (lambda c=compositor: raw2outputs(raw_grad, z_vals_all, batch_d, compositor=c), [raw_grad])
+
+    # Networks: their forward on embedded inputs, run_network (embedding + batchify) and
+    # render_rays end to end, for training with gradients and for inference
+    for nerf_type in args.nerf_types:
+        render_kwargs_train, render_kwargs_test, grad_vars = make_model(args, nerf_type)
+        model = render_kwargs_train['network_fn']
+        network_query_fn = render_kwargs_train['network_query_fn']
+        embedded = torch.cat([embed_fn(pts_flat), embeddirs_fn(pts_flat)], -1) if args.use_viewdirs else embed_fn(pts_flat)
+        embedded_time = embedtime_fn(torch.full([N_pts, 1], 0.5))
+        frame_time = torch.full([N_rand, 1], 0.5)
+        # The kwargs of render() that render_rays() does not take
+        render_only_keys = ['near', 'far', 'ndc', 'lindisp', 'use_viewdirs']
+        train_kwargs = {k: v for k, v in render_kwargs_train.items() if k not in render_only_keys}
+        test_kwargs = {k: v for k, v in render_kwargs_test.items() if k not in render_only_keys}
+        train_kwargs['use_depth'] = False
+
+        benches['nerf_forward/' + nerf_type] = (lambda m=model: m(embedded, [embedded_time, embedded_time]), grad_vars)
+        benches['run_network/' + nerf_type] = (lambda m=model, q=network_query_fn: q(pts, viewdirs, frame_time, m), grad_vars)
+        benches['batchify/' + nerf_type] = (lambda m=model: batchify(m, args.netchunk)(embedded, [embedded_time, embedded_time]), grad_vars)
+        benches['render_rays/train/' + nerf_type] = (lambda kw=train_kwargs: render_rays(ray_batch, **kw)['rgb_map'], grad_vars)
+        benches['render_rays/inference/' + nerf_type] = (lambda kw=test_kwargs: render_rays(ray_batch, **kw, outputs=['rgb_map', 'disp_map'])['rgb_map'], None)
+    return benches
+
+
+def run_benchmarks(args, hwf):
+    results = {}
+    for name, (fn, params) in benchmarks(args, hwf).items():
+        if args.only and not any(name.startswith(prefix) for prefix in args.only):
+            continue
+        with torch.no_grad():
+            results[name] = timeit(fn, args.iters, args.warmup)
+        if params is not None:
+            results[name + '/backward'] = timeit(backward_fn(fn, params), args.iters, args.warmup)
+        print('{:48s} {:10.3f} ms'.format(name, results[name]['ms']))
+        if name + '/backward' in results:
+            print('{:48s} {:10.3f} ms'.format(name + '/backward', results[name + '/backward']['ms']))
+    return results
+
+
+def environment(args, hwf):
+    out = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True)
+    return {
+        'commit': out.stdout.strip() if out.returncode == 0 else None,
+        'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'host': platform.node(),
+        'torch': torch.__version__,
+        'device': torch.cuda.get_device_name() if torch.cuda.is_available() else platform.processor() or 'cpu',
+        'num_threads': torch.get_num_threads(),
+        'config': args.config,
+        'shapes': {'N_rand': args.N_rand, 'N_samples': args.N_samples, 'N_importance': args.N_importance,
+                   'H': hwf[0], 'W': hwf[1], 'netdepth': args.netdepth, 'netwidth': args.netwidth,
+                   'chunk': args.chunk, 'netchunk': args.netchunk},
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Prints the speed ratio of each benchmark to the baseline, returns the names slower by more than tolerance."""
+    if baseline['environment']['shapes'] != results['environment']['shapes']:
+        print('Warning: the shapes differ from those of the baseline', baseline['environment']['shapes'])
+    print('Compared to {} ({}):'.format(baseline['environment']['commit'], baseline['environment']['date']))
+    regressions = []
+    for name, r in results['results'].items():
+        if name not in baseline['results']:
+            continue
+        ratio = r['ms'] / baseline['results'][name]['ms']
+        flag = ''
+        if ratio > 1. + tolerance:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        elif ratio < 1. / (1. + tolerance):
+            flag = '  faster'
+        print('{:48s} {:10.3f} -> {:10.3f} ms ({:.2f}x){}'.format(name, baseline['results'][name]['ms'], r['ms'], ratio, flag))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = config_parser()
+    parser.add_argument("--hwf", nargs=3, type=float, default=[512, 640, 569.46820041],
+                        help='image height, width and focal length')
+    parser.add_argument("--nerf_types", type=str, nargs='+', default=NERF_TYPES,
+                        help='nerf types to benchmark')
+    parser.add_argument("--only", type=str, nargs='+', default=[],
+                        help='benchmark only the names starting with one of these, e.g. raw2outputs render_rays/train')
+    parser.add_argument("--iters", type=int, default=20,
+                        help='num of timed calls per benchmark')
+    parser.add_argument("--warmup", type=int, default=3,
+                        help='num of untimed calls per benchmark')
+    parser.add_argument("--out", type=str, default='',
+                        help='write the results to this json file')
+    parser.add_argument("--baseline", type=str, default='',
+                        help='json file of earlier results to compare to')
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help='relative slowdown reported as a regression, the exit code is 1 if there is any')
+    args = parser.parse_args()
+    if args.config is None:
+        # The shapes of the configs shipped with the repo
+        args = parser.parse_args(['--config', DEFAULT_CONFIG] + sys.argv[1:])
+    configure_device(args)
+    hwf = [int(args.hwf[0]), int(args.hwf[1]), args.hwf[2]]
+
+    # run_endonerf_helpers enables anomaly detection globally, its checks would dominate the timings
+    torch.autograd.set_detect_anomaly(False)
+
+    results = {'environment': environment(args, hwf), 'results': run_benchmarks(args, hwf)}
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if len(compare(results, baseline, args.tolerance)) > 0:
+            sys.exit(1)
@@ -0,0 +1,98 @@
+import os, sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import json
+import time
+import copy
+
+from run_endonerf import *
+
+
+###################################################################################################
+# Usage Example
+###################################################################################################
+
+# python benchmarks/bench_precision.py --config configs/cutting.txt --bench_iters 50 --render_factor 4
+
+###################################################################################################
+
+
+def random_batch(hwf, N_rand):
+    H, W, focal = hwf
+    rays_o, rays_d = get_rays(H, W, focal, torch.eye(4)[:3, :4])
+    inds = torch.randint(0, H * W, [N_rand])
+    batch_rays = torch.stack([rays_o.reshape(-1, 3)[inds], rays_d.reshape(-1, 3)[inds]], 0)
+    target_s = torch.rand([N_rand, 3])
+    return batch_rays, target_s
+
+
+def bench_mode(args, hwf, half):
+    args = copy.deepcopy(args)
+    args.do_half_precision = half
+    torch.manual_seed(0)
+    render_kwargs_train, render_kwargs_test, _, _, optimizer, extras = create_nerf(args)
+    render_kwargs_train.update({'near': 0., 'far': 1.})
+    render_kwargs_test.update({'near': 0., 'far': 1.})
+    grad_scaler = extras['grad_scaler']
+
+    # Full-frame render for PSNR parity
+    with torch.no_grad():
+        rgbs, _ = render_path(torch.eye(4)[None, :3, :4].to(device), torch.Tensor([0.5]).to(device), hwf, args.chunk,
+                              render_kwargs_test, render_factor=args.render_factor)
+
+    # Training throughput
+    torch.manual_seed(1)
+    batches = [random_batch(hwf, args.N_rand) for _ in range(args.bench_iters + args.bench_warmup)]
+    for k, (batch_rays, target_s) in enumerate(batches):
+        if k == args.bench_warmup:
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+            t0 = time.time()
+        rgb, _, _, extras_r = render(hwf[0], hwf[1], hwf[2], chunk=args.chunk, rays=batch_rays,
+                                     frame_time=0.5, **render_kwargs_train)
+        loss = img2mse(rgb, target_s)
+        if 'rgb0' in extras_r:
+            loss = loss + img2mse(extras_r['rgb0'], target_s)
+        optimizer.zero_grad()
+        if grad_scaler is not None:
+            grad_scaler.scale(loss).backward()
+            grad_scaler.step(optimizer)
+            grad_scaler.update()
+        else:
+            loss.backward()
+            optimizer.step()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    elapsed = time.time() - t0
+
+    return rgbs[0], args.bench_iters * args.N_rand / elapsed
+
+
+if __name__ == '__main__':
+    parser = config_parser()
+    parser.add_argument("--bench_iters", type=int, default=50,
+                        help='num of timed training steps per precision mode')
+    parser.add_argument("--bench_warmup", type=int, default=5,
+                        help='num of untimed training steps per precision mode')
+    parser.add_argument("--hwf", nargs=3, type=float, default=[512, 640, 569.46820041],
+                        help='image height, width and focal length')
+    parser.add_argument("--out", type=str, default='',
+                        help='write the results to this json file')
+    args = parser.parse_args()
+    hwf = [int(args.hwf[0]), int(args.hwf[1]), args.hwf[2]]
+
+    rgb_fp32, rays_per_sec_fp32 = bench_mode(args, hwf, half=False)
+    rgb_half, rays_per_sec_half = bench_mode(args, hwf, half=True)
+
+    results = {
+        'device': device.type,
+        'half_precision_dtype': str(get_autocast_dtype(args.half_precision_dtype, device.type)),
+        'rays_per_sec_fp32': rays_per_sec_fp32,
+        'rays_per_sec_half': rays_per_sec_half,
+        'speedup': rays_per_sec_half / rays_per_sec_fp32,
+        'render_psnr_half_vs_fp32': mse2psnr(img2mse(torch.Tensor(rgb_half), torch.Tensor(rgb_fp32))).item(),
+    }
+    print(json.dumps(results, indent=2))
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
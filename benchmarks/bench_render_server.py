@@ -0,0 +1,146 @@
+import os, sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'preprocess'))
+
+import argparse
+import concurrent.futures
+import json
+import re
+import subprocess
+import threading
+import time
+
+import numpy as np
+
+from render_client import RenderClient
+from bench_suite import write_config
+
+
+###################################################################################################
+# Usage Example
+###################################################################################################
+
+# Headless on CPU with a synthetic scene and untrained weights:
+#   python benchmarks/bench_render_server.py --workdir /tmp/endonerf_bench --render_factor 2
+# A trained experiment on the GPU:
+#   python benchmarks/bench_render_server.py --config configs/cutting.txt --device cuda --concurrency 1 4 16
+
+###################################################################################################
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def start_server(config, server_args):
+    """Starts render_server.py on a free port, returns the process, its address and the seconds
+    until it served, the cost every one-shot render process pays before rendering."""
+    cmd = [sys.executable, os.path.join(ROOT, 'render_server.py'), '--configs', config, '--port', '0'] + server_args
+    t0 = time.time()
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    log = []
+    for line in proc.stdout:
+        log.append(line)
+        m = re.search(r'Serving .* on http://([\d.]+:\d+)', line)
+        if m:
+            # keep reading the output, a full pipe would block the server
+            threading.Thread(target=lambda: [None for _ in proc.stdout], daemon=True).start()
+            return proc, m.group(1), time.time() - t0
+    print(''.join(log))
+    raise RuntimeError('render server failed to start')
+
+
+def make_requests(n, n_times, jitter, seed=0):
+    """n requests at n_times distinct frame times, with poses translated by up to 'jitter'."""
+    rng = np.random.RandomState(seed)
+    times = np.linspace(0., 1., n_times)
+    requests = []
+    for k in range(n):
+        pose = np.eye(4)
+        pose[:3, 3] = rng.uniform(-jitter, jitter, 3)
+        requests.append({'pose': pose, 'time': times[k % n_times]})
+    return requests
+
+
+def latency_stats(latencies):
+    return {'p50_ms': float(np.percentile(latencies, 50)) * 1000., 'p95_ms': float(np.percentile(latencies, 95)) * 1000.}
+
+
+def run_requests(client, requests, concurrency, render_factor, outputs):
+    """Sends the requests from 'concurrency' threads, returns the wall time and the latencies."""
+    def send(r):
+        t0 = time.time()
+        client.render(pose=r['pose'], time=r['time'], render_factor=render_factor, outputs=outputs)
+        return time.time() - t0
+
+    t0 = time.time()
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as pool:
+        latencies = list(pool.map(send, requests))
+    return time.time() - t0, latencies
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workdir", type=str, default='./bench_render_server',
+                        help='where to write the synthetic scene and its config')
+    parser.add_argument("--config", type=str, default='',
+                        help='experiment to serve, a synthetic scene with untrained weights if empty')
+    parser.add_argument("--render_factor", type=int, default=0,
+                        help='downsampling factor of the requested frames')
+    parser.add_argument("--outputs", type=str, nargs='+', default=['rgb', 'depth'],
+                        help='requested outputs')
+    parser.add_argument("--n_requests", type=int, default=32,
+                        help='num of requests per measurement')
+    parser.add_argument("--n_times", type=int, default=4,
+                        help='num of distinct frame times of the requests, only requests of the same time are batched')
+    parser.add_argument("--concurrency", type=int, nargs='+', default=[1, 4, 16],
+                        help='num of concurrent clients to measure')
+    parser.add_argument("--out", type=str, default='',
+                        help='write the results to this json file')
+    args, server_args = parser.parse_known_args()
+
+    config = args.config
+    if not config:
+        from make_synthetic_scene import make_scene
+        os.makedirs(args.workdir, exist_ok=True)
+        args.datadir = os.path.join(args.workdir, 'scene')
+        if not os.path.exists(os.path.join(args.datadir, 'poses_bounds.npy')):
+            make_scene(args.datadir, 24, 64, 80)
+        config = os.path.join(args.workdir, 'bench.txt')
+        write_config(args, config)
+        os.makedirs(os.path.join(args.workdir, 'logs', 'bench'), exist_ok=True)
+
+    proc, address, startup_s = start_server(config, server_args)
+    try:
+        client = RenderClient(address)
+        print('Server ready after {:.1f} s: {}'.format(startup_s, client.models()))
+        results = {'startup_s': startup_s, 'render_factor': args.render_factor, 'outputs': args.outputs,
+                   'n_requests': args.n_requests, 'n_times': args.n_times, 'runs': []}
+
+        # Warm up the allocator and the chunk shapes, then the latency of requests one at a time
+        run_requests(client, make_requests(2, 1, 0.), 1, args.render_factor, args.outputs)
+        _, latencies = run_requests(client, make_requests(args.n_requests, args.n_times, 0.05), 1, args.render_factor, args.outputs)
+        results['sequential'] = latency_stats(latencies)
+        # A one-shot process per request pays the startup on top of the rendering
+        results['one_shot_estimate_ms'] = startup_s * 1000. + results['sequential']['p50_ms']
+        print('Sequential: p50 {:.1f} ms, p95 {:.1f} ms (one-shot process estimate {:.0f} ms)'.format(
+            results['sequential']['p50_ms'], results['sequential']['p95_ms'], results['one_shot_estimate_ms']))
+
+        for concurrency in args.concurrency:
+            before = client.stats()
+            wall, latencies = run_requests(client, make_requests(args.n_requests, args.n_times, 0.05, seed=concurrency),
+                                           concurrency, args.render_factor, args.outputs)
+            after = client.stats()
+            batches = after['batches'] - before['batches']
+            run = dict(concurrency=concurrency, requests_per_sec=len(latencies) / wall,
+                       rays_per_sec=(after['rays_rendered'] - before['rays_rendered']) / wall,
+                       requests_per_batch=(after['requests'] - before['requests']) / max(batches, 1), **latency_stats(latencies))
+            results['runs'].append(run)
+            print('{:3d} clients: {:7.2f} requests/s, {:9.0f} rays/s, {:5.2f} requests/batch, p50 {:8.1f} ms, p95 {:8.1f} ms'.format(
+                concurrency, run['requests_per_sec'], run['rays_per_sec'], run['requests_per_batch'], run['p50_ms'], run['p95_ms']))
+    finally:
+        proc.terminate()
+        proc.wait()
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,126 @@
+import os, sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import copy
+import json
+import tempfile
+import time
+
+from run_endonerf import *
+
+
+###################################################################################################
+# Usage Example
+###################################################################################################
+
+# python benchmarks/bench_startup.py --config configs/cutting.txt --n_frames 156 --repeats 3
+
+###################################################################################################
+
+
+def write_checkpoints(args, hwf, n_frames):
+    """Saves the state after one optimizer step as train() does, with per-frame maps of n_frames
+    frames, and the same state as a single-file checkpoint of the previous format."""
+    args = copy.deepcopy(args)
+    args.no_reload = True
+    render_kwargs_train, _, _, grad_vars, optimizer, _ = create_nerf(args)
+    sum(p.sum() for p in grad_vars).backward()
+    optimizer.step()
+
+    H, W, _ = hwf
+    save_dict = {
+        'global_step': 1,
+        'network_fn_state_dict': render_kwargs_train['network_fn'].state_dict(),
+        'optimizer_state_dict': optimizer.state_dict(),
+    }
+    if render_kwargs_train['network_fine'] is not None:
+        save_dict['network_fine_state_dict'] = render_kwargs_train['network_fine'].state_dict()
+    maps = {
+        'ray_importance_maps': torch.rand(n_frames, H, W),
+        'depth_maps': torch.rand(n_frames, H, W),
+    }
+
+    ckpt_writer = CheckpointWriter(os.path.join(args.basedir, args.expname))
+    ckpt_writer.save(1, save_dict, {k: (v, 0) for k, v in maps.items()})
+    ckpt_writer.writer.close()
+
+    legacy_path = os.path.join(args.basedir, 'legacy.tar')
+    torch.save(dict(save_dict, **{k: v.cpu().numpy() for k, v in maps.items()}), legacy_path)
+    return legacy_path
+
+
+def legacy_startup(args, legacy_path):
+    """Checkpoint loading as create_nerf did before the index: the whole file to the device."""
+    args = copy.deepcopy(args)
+    args.no_reload = True
+    render_kwargs_train, _, _, _, optimizer, _ = create_nerf(args)
+    ckpt = torch.load(legacy_path, weights_only=False)
+    optimizer.load_state_dict(ckpt['optimizer_state_dict'])
+    render_kwargs_train['network_fn'].load_state_dict(ckpt['network_fn_state_dict'])
+    if render_kwargs_train['network_fine'] is not None:
+        render_kwargs_train['network_fine'].load_state_dict(ckpt['network_fine_state_dict'])
+
+
+def timeit(fn, repeats):
+    times = []
+    for _ in range(repeats):
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        t0 = time.time()
+        fn()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        times.append(time.time() - t0)
+    return float(np.median(times))
+
+
+if __name__ == '__main__':
+    parser = config_parser()
+    parser.add_argument("--n_frames", type=int, default=156,
+                        help='num of frames of the per-frame maps in the checkpoint')
+    parser.add_argument("--hwf", nargs=3, type=float, default=[512, 640, 569.46820041],
+                        help='image height, width and focal length')
+    parser.add_argument("--repeats", type=int, default=3,
+                        help='num of timed startups per entry point, the median is reported')
+    parser.add_argument("--out", type=str, default='',
+                        help='write the results to this json file')
+    args = parser.parse_args()
+    hwf = [int(args.hwf[0]), int(args.hwf[1]), args.hwf[2]]
+
+    if torch.cuda.is_available():
+        set_default_device('cuda')
+
+    with tempfile.TemporaryDirectory() as basedir:
+        args.basedir = basedir
+        args.ft_path = None
+        args.no_reload = False
+        args.autotune_chunks = False
+        os.makedirs(os.path.join(basedir, args.expname))
+        legacy_path = write_checkpoints(args, hwf, args.n_frames)
+        ckpt_path = os.path.join(basedir, args.expname, CheckpointWriter.read_index(os.path.join(basedir, args.expname))['latest'])
+
+        args_ft = copy.deepcopy(args)
+        args_ft.ft_path = ckpt_path
+        entry_points = {
+            # train() resuming: network weights, optimizer state and per-frame maps
+            'train_resume': lambda: create_nerf(args, training=True),
+            # run_endonerf.py --render_only: latest checkpoint from the index, weights only
+            'render_only': lambda: create_nerf(args, training=False),
+            # endo_pc_reconstruction.py and bake_endonerf.py with --reload_ckpt
+            'reconstruction_bake': lambda: create_nerf(args_ft, training=False),
+            # any entry point before the checkpoint index
+            'legacy_full_load': lambda: legacy_startup(args, legacy_path),
+        }
+
+        results = {
+            'device': device.type,
+            'ckpt_mb': os.path.getsize(ckpt_path) / 2**20,
+            'legacy_ckpt_mb': os.path.getsize(legacy_path) / 2**20,
+        }
+        for name, fn in entry_points.items():
+            results[name + '_sec'] = timeit(fn, args.repeats)
+
+    print(json.dumps(results, indent=2))
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
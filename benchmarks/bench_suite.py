@@ -0,0 +1,210 @@
+import os, sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'preprocess'))
+
+import argparse
+import json
+import platform
+import re
+import resource
+import subprocess
+import time
+
+
+###################################################################################################
+# Usage Example
+###################################################################################################
+
+# Headless on CPU with a synthetic scene, appending to a history of results:
+#   python benchmarks/bench_suite.py --workdir /tmp/endonerf_bench --history bench_history.jsonl
+# With the settings of a config and real data on the GPU:
+#   python benchmarks/bench_suite.py --config configs/cutting.txt --datadir data1/cutting_tissues_twice --device cuda
+
+###################################################################################################
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Metrics where larger is better, the others are better smaller
+HIGHER_IS_BETTER = ['iters_per_sec', 'render_fps', 'render_rays_per_sec']
+
+
+def peak_memory():
+    """Peak resident set size of this process and peak CUDA memory allocated, in MB."""
+    import torch
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    rss_mb = maxrss / 2**20 if sys.platform == 'darwin' else maxrss / 2**10  # bytes on macOS, KB on Linux
+    cuda_mb = torch.cuda.max_memory_allocated() / 2**20 if torch.cuda.is_available() else 0.
+    return {'peak_rss_mb': rss_mb, 'peak_cuda_mb': cuda_mb}
+
+
+def render_job():
+    """Renders the render_poses of the trained model without writing images or videos."""
+    from run_endonerf import config_parser, configure_device, load_data, create_nerf, render_path, device
+    import run_endonerf
+    import torch
+    args = config_parser().parse_args()
+    configure_device(args)
+    _, _, _, _, _, _, render_poses, render_times, hwf, _, _, _, near, far, _, _ = load_data(args)
+    _, render_kwargs_test, _, _, _, _ = create_nerf(args, training=False)
+    render_kwargs_test.update({'near': near + 1e-6, 'far': far})
+    render_poses = torch.Tensor(render_poses).to(run_endonerf.device)
+    render_times = torch.Tensor(render_times).to(run_endonerf.device)
+    with torch.no_grad():
+        render_path(render_poses, render_times, hwf, args.chunk, render_kwargs_test, render_factor=args.render_factor)
+
+
+def run_job(job):
+    """Entry of the child processes, a fresh process per job so that the peak memory is its own."""
+    if job == 'train':
+        from run_endonerf import train
+        train()
+    else:
+        render_job()
+    print('[MEMORY] ' + json.dumps(peak_memory()))
+
+
+def run_child(job, train_args):
+    cmd = [sys.executable, os.path.abspath(__file__), '--job', job] + train_args
+    t0 = time.time()
+    out = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    if out.returncode != 0:
+        print(out.stdout)
+        raise RuntimeError('{} job failed'.format(job))
+    return out.stdout, time.time() - t0
+
+
+def write_config(args, path):
+    """The benchmark config: the settings of args.config (if any) with the data, output and device of the suite."""
+    lines = []
+    if args.config:
+        with open(args.config) as f:
+            lines = [l for l in f.read().splitlines() if l.split('=')[0].strip() not in ['expname', 'basedir', 'datadir']]
+    else:
+        # The settings of configs/cutting.txt with a smaller batch for CPU boxes
+        lines = ['dataset_type = llff', 'factor = 1', 'llffhold = 8', 'llff_renderpath = fixidentity',
+                 'N_rand = 512', 'N_samples = 32', 'N_importance = 32', 'use_viewdirs = True', 'raw_noise_std = 1e0',
+                 'davinci_endoscopic = True', 'use_fgmask = True', 'use_depth = True', 'depth_sampling_sigma = 1.0',
+                 'nerf_type = direct_temporal', 'no_batching = True', 'not_zero_canonical = False']
+    lines += ['expname = bench', 'basedir = {}'.format(os.path.join(args.workdir, 'logs')), 'datadir = {}'.format(args.datadir)]
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+def git_commit():
+    out = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True)
+    return out.stdout.strip() if out.returncode == 0 else None
+
+
+def run_suite(args):
+    os.makedirs(args.workdir, exist_ok=True)
+    if not args.datadir:
+        from make_synthetic_scene import make_scene
+        args.datadir = os.path.join(args.workdir, 'scene_{}x{}_{}'.format(args.height, args.width, args.n_frames))
+        if not os.path.exists(os.path.join(args.datadir, 'poses_bounds.npy')):
+            make_scene(args.datadir, args.n_frames, args.height, args.width)
+    config = os.path.join(args.workdir, 'bench.txt')
+    write_config(args, config)
+
+    common = ['--config', config, '--device', args.device] + args.extra_args
+    results = {'commit': git_commit(), 'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'host': platform.node(),
+               'device': args.device, 'datadir': args.datadir, 'N_iter': args.N_iter}
+
+    # Training from scratch: loop speed, time to the target PSNR and peak memory
+    print('Training {} iterations'.format(args.N_iter))
+    stdout, _ = run_child('train', common + ['--N_iter', str(args.N_iter), '--no_reload', '--stage_timers',
+                                             '--target_psnr', str(args.target_psnr), '--i_print', str(min(100, args.N_iter)),
+                                             '--i_weights', str(args.N_iter), '--i_img', str(10**9),
+                                             '--i_testset', str(10**9), '--i_video', str(10**9)])
+    m = re.search(r'Trained (\d+) iterations in ([\d.]+) s', stdout)
+    results['iters_per_sec'] = int(m.group(1)) / float(m.group(2))
+    m = re.search(r'\[TARGET\] PSNR \S+ reached at iter (\d+) after ([\d.]+) s', stdout)
+    results['time_to_target_psnr_sec'] = float(m.group(2)) if m else None
+    results['target_psnr'] = args.target_psnr
+    psnrs = re.findall(r'\[TRAIN\] Iter: \d+ .*PSNR: ([\d.]+)', stdout)
+    results['final_train_psnr'] = float(psnrs[-1]) if len(psnrs) > 0 else None
+    train_memory = json.loads(re.search(r'\[MEMORY\] (.*)', stdout).group(1))
+    results.update({'train_' + k: v for k, v in train_memory.items()})
+
+    # Rendering of the render_poses with the trained weights
+    print('Rendering')
+    stdout, _ = run_child('render', common + ['--render_factor', str(args.render_factor)])
+    m = re.search(r'Rendered (\d+) frames .*\(([\d.]+) rays/s, ([\d.]+) frames/s\)', stdout)
+    results['render_rays_per_sec'] = float(m.group(2))
+    results['render_fps'] = float(m.group(3))
+    render_memory = json.loads(re.search(r'\[MEMORY\] (.*)', stdout).group(1))
+    results.update({'render_' + k: v for k, v in render_memory.items()})
+    return results
+
+
+def compare(results, previous, tolerance):
+    """Relative changes to the previous results, and the metrics worse by more than tolerance."""
+    changes, regressions = {}, []
+    for k, v in results.items():
+        if not k in previous or not isinstance(v, (int, float)) or not isinstance(previous[k], (int, float)) or previous[k] == 0 \
+                or k in ['N_iter', 'target_psnr', 'final_train_psnr']:
+            continue
+        change = v / previous[k] - 1.
+        changes[k] = change
+        worse = -change if k in HIGHER_IS_BETTER else change
+        if worse > tolerance:
+            regressions.append(k)
+    return changes, regressions
+
+
+if __name__ == '__main__':
+    if '--job' in sys.argv:
+        i = sys.argv.index('--job')
+        job = sys.argv[i + 1]
+        sys.argv = sys.argv[:i] + sys.argv[i + 2:]
+        run_job(job)
+        sys.exit(0)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workdir", type=str, default='./bench_suite',
+                        help='where to write the synthetic scene, the config and the experiment')
+    parser.add_argument("--config", type=str, default='',
+                        help='training settings, the settings of configs/cutting.txt with N_rand 512 if empty')
+    parser.add_argument("--datadir", type=str, default='',
+                        help='scene to train on, a synthetic scene is generated in workdir if empty')
+    parser.add_argument("--n_frames", type=int, default=24,
+                        help='num of frames of the synthetic scene')
+    parser.add_argument("--height", type=int, default=64,
+                        help='image height of the synthetic scene')
+    parser.add_argument("--width", type=int, default=80,
+                        help='image width of the synthetic scene')
+    parser.add_argument("--device", type=str, default='cpu', choices=['auto', 'cuda', 'cpu'],
+                        help='device of the runs')
+    parser.add_argument("--N_iter", type=int, default=500,
+                        help='num of training iterations')
+    parser.add_argument("--target_psnr", type=float, default=22.,
+                        help='training PSNR of the time-to-PSNR metric')
+    parser.add_argument("--render_factor", type=int, default=0,
+                        help='downsampling factor of the rendering')
+    parser.add_argument("--history", type=str, default='',
+                        help='append the results to this json lines file and compare them to its last entry')
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help='relative change of a metric reported as a regression')
+    parser.add_argument("--out", type=str, default='',
+                        help='write the results to this json file')
+    args, args.extra_args = parser.parse_known_args()
+
+    results = run_suite(args)
+    print(json.dumps(results, indent=2))
+
+    if args.history:
+        previous = None
+        if os.path.exists(args.history):
+            with open(args.history) as f:
+                entries = [json.loads(l) for l in f if l.strip()]
+            previous = entries[-1] if len(entries) > 0 else None
+        if previous is not None:
+            changes, regressions = compare(results, previous, args.tolerance)
+            print('Compared to {} ({}):'.format(previous.get('commit'), previous.get('date')))
+            for k, change in changes.items():
+                print('  {:28s} {:+7.1f}%{}'.format(k, 100. * change, '  REGRESSION' if k in regressions else ''))
+        with open(args.history, 'a') as f:
+            f.write(json.dumps(results) + '\n')
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
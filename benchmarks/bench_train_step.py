@@ -0,0 +1,182 @@
+import os, sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import copy
+import json
+import tempfile
+import time
+
+from torch.utils._python_dispatch import TorchDispatchMode
+from torch.utils._pytree import tree_flatten
+
+from run_endonerf import *
+
+
+###################################################################################################
+# Usage Example
+###################################################################################################
+
+# python benchmarks/bench_train_step.py --config configs/cutting.txt --iters 20
+
+###################################################################################################
+
+
+class AllocationCounter(TorchDispatchMode):
+    """Counts the tensors with new storage created by the operators, forward and backward, on
+    any device: outputs of in-place and out= operators and views are not counted."""
+    def __init__(self):
+        super().__init__()
+        self.count = 0
+        self.bytes = 0
+
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+        out = func(*args, **(kwargs or {}))
+        inputs = {t.untyped_storage().data_ptr() for t in tree_flatten((args, kwargs))[0] if isinstance(t, torch.Tensor)}
+        for t in tree_flatten(out)[0]:
+            if isinstance(t, torch.Tensor) and t.untyped_storage().data_ptr() not in inputs:
+                self.count += 1
+                self.bytes += t.untyped_storage().nbytes()
+        return out
+
+
+def reference_sample(N_rand, images, poses, ray_importance_maps, depth_maps, depth_scale, img_i, H, W, focal):
+    """Ray sampling of train() as it was before TrainStep, used as reference: rays of the
+    whole frame and a fresh pixel grid in every iteration."""
+    target = images[img_i]
+    pose = poses[img_i, :3, :4]
+    ray_importance_map = ray_importance_maps[img_i]
+    depth_map = depth_maps[img_i]
+    rays_o, rays_d = get_rays(H, W, focal, torch.Tensor(pose))
+    coords = torch.stack(torch.meshgrid(torch.linspace(0, H-1, H), torch.linspace(0, W-1, W)), -1)
+    coords = torch.reshape(coords, [-1,2])
+    select_inds, _, cdf = importance_sampling_coords(ray_importance_map[coords[:, 0].long(), coords[:, 1].long()].unsqueeze(0), N_rand)
+    select_inds = torch.max(torch.zeros_like(select_inds), select_inds)
+    select_inds = torch.min((coords.shape[0] - 1) * torch.ones_like(select_inds), select_inds)
+    select_inds = select_inds.squeeze(0)
+    select_coords = coords[select_inds].long()
+    rays_o = rays_o[select_coords[:, 0], select_coords[:, 1]]
+    rays_d = rays_d[select_coords[:, 0], select_coords[:, 1]]
+    batch_rays = torch.stack([rays_o, rays_d], 0)
+    target_s = target[select_coords[:, 0], select_coords[:, 1]]
+    depth_s = depth_map[select_coords[:, 0], select_coords[:, 1]] / depth_scale
+    return batch_rays, target_s, depth_s
+
+
+def reference_render(H, W, focal, chunk, rays, frame_time, near, far, use_viewdirs=False, **kwargs):
+    """Ray batch assembly of render() as it was before the rays_buffer, used as reference."""
+    rays_o, rays_d = rays
+    viewdirs = rays_d / (torch.norm(rays_d, dim=-1, keepdim=True) + 1e-6)
+    rays_o, rays_d = ndc_rays(H, W, focal, 1., rays_o, rays_d)
+    near = near.unsqueeze(0).reshape(-1, 1)
+    far = far * torch.ones_like(near)
+    frame_time = frame_time * torch.ones_like(rays_d[...,:1])
+    rays = torch.cat([rays_o, rays_d, near, far, frame_time], -1)
+    if use_viewdirs:
+        rays = torch.cat([rays, viewdirs], -1)
+    ret = batchify_rays(rays, chunk, **kwargs)
+    return ret['rgb_map'], ret['disp_map'], ret
+
+
+def make_step(args, hwf, data, pooled):
+    """One training iteration (ray sampling, render, image and depth losses, backward and
+    optimizer step) with TrainStep if pooled, else with the reference code."""
+    images, poses, times, ray_importance_maps, depth_maps = data
+    args = copy.deepcopy(args)
+    args.no_reload = True
+    args.basedir = tempfile.mkdtemp()  # create_nerf lists the checkpoints of the experiment
+    os.makedirs(os.path.join(args.basedir, args.expname))
+    args.autotune_chunks = False
+    torch.manual_seed(0)
+    render_kwargs_train, _, _, _, optimizer, _ = create_nerf(args)
+    render_kwargs_train['use_depth'] = True
+    H, W, focal = hwf
+    depth_scale = 1.
+    train_step = TrainStep(args.N_rand, images, poses, ray_importance_maps=ray_importance_maps, depth_maps=depth_maps,
+                           depth_scale=depth_scale)
+    outputs = ['rgb_map', 'rgb0', 'disp_map']
+
+    def step(img_i):
+        if pooled:
+            batch_rays, target_s, depth_s, _ = train_step.sample(img_i, H, W, focal)
+            render_kwargs_train.update({'near': torch.add(depth_s, 1e-6, out=train_step.pool.get('near', depth_s.shape)),
+                                        'far': args.depth_sampling_sigma})
+            rgb, disp, _, extras = train_step.render(H, W, focal, args.chunk, batch_rays, times[img_i], render_kwargs_train,
+                                                     outputs=outputs)
+        else:
+            batch_rays, target_s, depth_s = reference_sample(args.N_rand, images, poses, ray_importance_maps, depth_maps,
+                                                             depth_scale, img_i, H, W, focal)
+            render_kwargs_train.update({'near': depth_s.detach().clone() + 1e-6, 'far': args.depth_sampling_sigma})
+            kwargs = {k: v for k, v in render_kwargs_train.items() if k not in ['ndc', 'lindisp']}
+            rgb, disp, extras = reference_render(H, W, focal, args.chunk, batch_rays, times[img_i], outputs=outputs, **kwargs)
+        optimizer.zero_grad()
+        loss = img2mse(rgb, target_s) + F.huber_loss(1.0 / (disp + 1e-6), depth_s, delta=0.2)
+        if 'rgb0' in extras:
+            loss = loss + img2mse(extras['rgb0'], target_s)
+        loss.backward()
+        optimizer.step()
+    return step
+
+
+def bench(args, hwf, data, pooled):
+    step = make_step(args, hwf, data, pooled)
+    n_frames = data[0].shape[0]
+    np.random.seed(0)
+    for k in range(args.warmup):
+        step(k % n_frames)
+
+    # Allocations of one iteration, in a separate run as the counting slows the operators down
+    counter = AllocationCounter()
+    cuda_allocs = torch.cuda.memory_stats()['allocation.all.allocated'] if torch.cuda.is_available() else 0
+    with counter:
+        step(0)
+    result = {'tensor_allocations_per_step': counter.count, 'allocated_mb_per_step': counter.bytes / 2**20}
+    if torch.cuda.is_available():
+        result['cuda_allocator_allocations_per_step'] = torch.cuda.memory_stats()['allocation.all.allocated'] - cuda_allocs
+
+    times = []
+    for k in range(args.iters):
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        t0 = time.perf_counter()
+        step(k % n_frames)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        times.append(time.perf_counter() - t0)
+    result['step_ms'] = float(np.median(times)) * 1000.
+    return result
+
+
+if __name__ == '__main__':
+    parser = config_parser()
+    parser.add_argument("--hwf", nargs=3, type=float, default=[512, 640, 569.46820041],
+                        help='image height, width and focal length')
+    parser.add_argument("--n_frames", type=int, default=4,
+                        help='num of random training frames')
+    parser.add_argument("--iters", type=int, default=20,
+                        help='num of timed iterations')
+    parser.add_argument("--warmup", type=int, default=3,
+                        help='num of untimed iterations')
+    parser.add_argument("--out", type=str, default='',
+                        help='write the results to this json file')
+    args = parser.parse_args()
+    configure_device(args)
+    hwf = [int(args.hwf[0]), int(args.hwf[1]), args.hwf[2]]
+
+    # run_endonerf_helpers enables anomaly detection globally, its checks would dominate the timings
+    torch.autograd.set_detect_anomaly(False)
+
+    H, W, _ = hwf
+    torch.manual_seed(0)
+    masks = (torch.rand(args.n_frames, H, W) > 0.2).float()
+    data = (torch.rand(args.n_frames, H, W, 3), torch.eye(4)[None, :3, :4].repeat(args.n_frames, 1, 1),
+            torch.linspace(0., 1., args.n_frames), ray_sampling_importance_from_masks(masks),
+            torch.rand(args.n_frames, H, W) * 0.5 + 0.25)
+
+    results = {'reference': bench(args, hwf, data, False), 'train_step': bench(args, hwf, data, True)}
+    for name, r in results.items():
+        print('{:10s} {:8.2f} ms/step  {:5d} tensor allocations/step ({:.1f} MB){}'.format(
+            name, r['step_ms'], r['tensor_allocations_per_step'], r['allocated_mb_per_step'],
+            '  {} CUDA allocations/step'.format(r['cuda_allocator_allocations_per_step']) if 'cuda_allocator_allocations_per_step' in r else ''))
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -1,8 +1,8 @@
-from run_endonerf import config_parser, create_nerf
+from run_endonerf import config_parser, create_nerf, add_device_args, configure_device, DEVICE_ARGS
 import torch
 # from load_blender import pose_spherical
 from run_endonerf import render_path
-from run_endonerf_helpers import to8b
+from run_endonerf_helpers import to8b, StepProfiler
 import numpy as np
 import matplotlib.pyplot as plt
 # import mcubes
@@ -17,8 +17,7 @@ import cv2
 Setup
 '''
 
-# set cuda
-torch.set_default_tensor_type('torch.cuda.FloatTensor')
+# replaced by the device of --device in __main__
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
 
@@ -117,18 +116,26 @@ if __name__ == '__main__':
                         help='The greater its value, the more further pixels will mix together')
     cfg_parser.add_argument("--crop_left_size", type=int, default=75,
                         help='the size of pixels to crop')
+    cfg_parser.add_argument("--profile_steps", type=str, default='',
+                        help='start:end, capture the reconstruction of these frames with torch.profiler')
+    cfg_parser.add_argument("--profile_top_n", type=int, default=30,
+                        help='num of operators in the table of the profile')
+    add_device_args(cfg_parser)
 
     cfg = cfg_parser.parse_args()
     
     nerf_parser = config_parser()
     nerf_args = nerf_parser.parse_args(f'--config {cfg.config_file}')
+    for k in DEVICE_ARGS:
+        setattr(nerf_args, k, getattr(cfg, k))
+    device = configure_device(nerf_args)
 
     if cfg.reload_ckpt:
         setattr(nerf_args, 'ft_path', os.path.join(nerf_args.basedir, nerf_args.expname, cfg.reload_ckpt))
 
     # set render params for DaVinci endoscopic
     hwf = [512, 640, 569.46820041]
-    _, render_kwargs_test, epoch, _, _, _ = create_nerf(nerf_args)
+    _, render_kwargs_test, epoch, _, _, _ = create_nerf(nerf_args, training=False)
     render_kwargs_test.update({'near' : 0., 'far' : 1.})
 
     # output directory
@@ -147,16 +154,20 @@ if __name__ == '__main__':
     # reconstruct pointclouds
     print('Reconstructing point clouds...')
 
+    profiler = StepProfiler(cfg.profile_steps, os.path.join(nerf_args.basedir, nerf_args.expname), cfg.profile_top_n)
     pcds = []
     if cfg.n_frames == 1:
         print('>>> t=', cfg.start_t)
+        profiler.step(0)
         pcd = reconstruct_pointcloud(cfg.start_t, nerf_args, cfg.vis_rgbd, depth_filter=depth_smoother, crop_left_size=cfg.crop_left_size)
         pcds.append(pcd)
     else:
-        for test_time in np.linspace(cfg.start_t, cfg.end_t, cfg.n_frames):
+        for k, test_time in enumerate(np.linspace(cfg.start_t, cfg.end_t, cfg.n_frames)):
             print('>>> t=', test_time)
+            profiler.step(k)
             pcd = reconstruct_pointcloud(test_time, nerf_args, cfg.vis_rgbd, depth_filter=depth_smoother, crop_left_size=cfg.crop_left_size)
             pcds.append(pcd)
+    profiler.stop()
 
     if not cfg.no_pc_saved:
         print('Saving point clouds...')
@@ -0,0 +1,160 @@
+from run_endonerf import *
+import cv2
+import eval_rgb
+
+
+'''
+Evaluate the weights of a training run in a separate process
+'''
+
+###################################################################################################
+# Usage Example
+###################################################################################################
+
+# Started by training:  python run_endonerf.py --config configs/example.txt --eval_worker --eval_worker_gpu 1
+# Latest checkpoint:    python eval_worker.py --config configs/example.txt --eval_render_factor 4
+
+###################################################################################################
+
+
+def resize(imgs, H, W):
+    """Resizes images [N, H', W', ...] (numpy) to H x W by area averaging."""
+    if imgs.shape[1:3] == (H, W):
+        return imgs
+    return np.stack([cv2.resize(img, (W, H), interpolation=cv2.INTER_AREA) for img in imgs], 0)
+
+
+def compute_metrics(rgbs, gts, masks=None):
+    """PSNR, SSIM and LPIPS of eval_rgb.py for rendered images against ground truth [N, H, W, 3],
+    both restricted to the pixels of masks [N, H, W] if given."""
+    rgbs, gts = torch.Tensor(rgbs), torch.Tensor(gts)
+    if masks is not None:
+        masks = torch.Tensor(masks)[..., None]
+        rgbs, gts = rgbs * masks, gts * masks
+    return {
+        'psnr': eval_rgb.mse2psnr(eval_rgb.img2mse(rgbs, gts)).item(),
+        'ssim': eval_rgb.ssim(rgbs, gts, format='NHWC').item(),
+        'lpips': torch.mean(eval_rgb.lpips(rgbs, gts, format='NHWC')).item(),
+    }
+
+
+def load_weights(render_kwargs, ckpt_path):
+    ckpt = load_checkpoint(ckpt_path, ['network_fn_state_dict', 'network_fine_state_dict', 'occupancy_grid'])
+    render_kwargs['network_fn'].load_state_dict(ckpt['network_fn_state_dict'])
+    if render_kwargs['network_fine'] is not None:
+        render_kwargs['network_fine'].load_state_dict(ckpt['network_fine_state_dict'])
+    if render_kwargs['occupancy_grid'] is not None and 'occupancy_grid' in ckpt:
+        render_kwargs['occupancy_grid'].load_state_dict(ckpt['occupancy_grid'])
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+def evaluate(args, i, kinds, data, render_kwargs, writer):
+    """Runs the evaluations 'kinds' of the i_img, i_testset and i_video branches of train() for
+    the checkpoint of iteration i, rendering at 1/eval_render_factor resolution."""
+    images, masks, _, _, poses, times, render_poses, render_times, hwf, _, i_val, i_test = data[:12]
+    basedir, expname = args.basedir, args.expname
+    f = max(args.eval_render_factor, 1)
+    H, W, focal = hwf[0] // f, hwf[1] // f, hwf[2] / f
+
+    if 'img' in kinds:
+        # Log a rendered validation view to Tensorboard, cycling through the validation frames
+        img_i = i_val[(i // args.i_img) % len(i_val)]
+        with torch.no_grad():
+            rgb, disp, acc, extras = render(H, W, focal, chunk=args.chunk, c2w=torch.Tensor(poses[img_i, :3, :4]),
+                                            frame_time=torch.Tensor([times[img_i]])[0],
+                                            outputs=['rgb_map', 'disp_map', 'acc_map', 'rgb0', 'disp0', 'z_std'],
+                                            **render_kwargs)
+        target = resize(images[img_i:img_i+1], H, W)[0]
+        writer.add_scalar('val/psnr', mse2psnr(img2mse(rgb, torch.Tensor(target))).item(), i)
+        writer.add_image('gt', to8b(target), i, dataformats='HWC')
+        writer.add_image('rgb', to8b(rgb.cpu().numpy()), i, dataformats='HWC')
+        writer.add_image('disp', disp.cpu().numpy(), i, dataformats='HW')
+        writer.add_image('acc', acc.cpu().numpy(), i, dataformats='HW')
+        if 'rgb0' in extras:
+            writer.add_image('rgb_rough', to8b(extras['rgb0'].cpu().numpy()), i, dataformats='HWC')
+        if 'disp0' in extras:
+            writer.add_image('disp_rough', extras['disp0'].cpu().numpy(), i, dataformats='HW')
+        if 'z_std' in extras:
+            writer.add_image('acc_rough', extras['z_std'].cpu().numpy(), i, dataformats='HW')
+
+    if 'testset' in kinds:
+        testsavedir = os.path.join(basedir, expname, 'testset_{:06d}'.format(i))
+        with torch.no_grad():
+            rgbs, _ = render_path(torch.Tensor(poses[i_test]), torch.Tensor(times[i_test]), hwf, args.chunk,
+                                  render_kwargs, savedir=testsavedir, render_factor=args.eval_render_factor)
+        gts = resize(images[i_test], H, W)
+        masks_test = (resize(masks[i_test], H, W) > 0.5).astype(np.float32) if masks is not None else None
+        metrics = compute_metrics(rgbs, gts, masks_test)
+        for k, v in metrics.items():
+            writer.add_scalar('test/' + k, v, i)
+        print('[EVAL] Iter: {} PSNR: {:.3f} SSIM: {:.4f} LPIPS: {:.4f}'.format(i, metrics['psnr'], metrics['ssim'], metrics['lpips']))
+
+    if 'video' in kinds:
+        with torch.no_grad():
+            savedir = os.path.join(basedir, expname, 'frames_{}_{}_{:06d}_time/'.format(expname, args.llff_renderpath, i))
+            rgbs, disps = render_path(torch.Tensor(render_poses), torch.Tensor(render_times), hwf, args.chunk,
+                                      render_kwargs, savedir=savedir, render_factor=args.eval_render_factor)
+        moviebase = os.path.join(basedir, expname, '{}_{}_{:06d}_'.format(expname, args.llff_renderpath, i))
+        imageio.mimwrite(moviebase + 'rgb.mp4', to8b(rgbs), fps=args.video_fps, quality=8)
+        imageio.mimwrite(moviebase + 'disp.mp4', to8b(disps / np.max(disps)), fps=args.video_fps, quality=8)
+
+    writer.flush()
+
+
+if __name__ == '__main__':
+    parser = config_parser()
+    parser.add_argument("--eval_follow_pid", type=int, default=0,
+                        help='pid of the training to follow until it has ended, 0 evaluates the latest checkpoint once')
+    args = parser.parse_args()
+    configure_device(args)
+
+    data = load_data(args)
+    near, far = data[12:14]
+    args.no_reload = True
+    _, render_kwargs_test, _, _, _, _ = create_nerf(args, training=False)
+    render_kwargs_test.update({'near': near + 1e-6, 'far': far})
+    writer = SummaryWriter(os.path.join(args.basedir, 'summaries', args.expname))
+
+    # Following a training, the worker evaluates the weights-only snapshots train() saves at the
+    # evaluation iterations, otherwise the latest checkpoint. An evaluation runs for a snapshot if
+    # its iteration reached a new multiple of the period, snapshots saved while the previous
+    # evaluation ran are skipped
+    periods = {'img': args.i_img, 'testset': args.i_testset, 'video': args.i_video}
+    last_i = 0
+    expdir = os.path.join(args.basedir, args.expname)
+    if args.eval_follow_pid > 0:
+        expdir = os.path.join(expdir, EVAL_SNAPSHOT_DIR)
+    while True:
+        training_alive = args.eval_follow_pid > 0 and process_alive(args.eval_follow_pid) \
+            and not os.path.exists(os.path.join(expdir, EVAL_DONE_FILE))
+        index = CheckpointWriter.read_index(expdir)
+        latest = index['checkpoints'][-1] if index is not None and len(index['checkpoints']) > 0 else None
+
+        if latest is not None and latest['step'] > last_i:
+            i = latest['step']
+            kinds = [k for k, period in periods.items() if i // period > last_i // period or args.eval_follow_pid == 0]
+            if len(kinds) > 0:
+                try:
+                    load_weights(render_kwargs_test, os.path.join(expdir, latest['file']))
+                except FileNotFoundError:
+                    # Removed by the checkpoint rotation in the meantime, the index will list a newer one
+                    if not training_alive:
+                        break
+                    time.sleep(args.eval_poll_interval)
+                    continue
+                print('Evaluating {} of iteration {}'.format(', '.join(kinds), i))
+                evaluate(args, i, kinds, data, render_kwargs_test, writer)
+            last_i = i
+        elif not training_alive:
+            break
+        else:
+            time.sleep(args.eval_poll_interval)
+
+    writer.close()
@@ -0,0 +1,102 @@
+import configargparse
+import imageio
+import numpy as np
+import os
+
+
+"""
+Writes a synthetic deforming tissue scene in the layout of the EndoNeRF datasets read by
+load_llff_data (images/, masks/, depth/, edge_masks/ and poses_bounds.npy), so that training
+and rendering can be benchmarked without the DaVinci recordings.
+
+The surface is a height field in front of a fixed camera. A tissue point with canonical
+coordinates (X, Y) is seen at time t at
+    x = X + shift * sin(2 pi (t + Y)),  y = Y
+and its depth varies with a breathing motion,
+    depth = depth_mid + depth_amp * sin(2 pi f X) cos(2 pi f Y) * (0.5 + 0.5 sin(2 pi t)),
+so every frame has an exact ground truth. A tool (a bar sweeping over the tissue) occludes
+part of every frame and is marked in the masks as in the real data (255 = tool).
+"""
+
+
+def tissue_texture(X, Y):
+    """Pinkish tissue with darker vessels, a function of the canonical coordinates in [0, 1]."""
+    vessels = np.exp(-np.square(np.sin(7. * X + 3. * np.sin(5. * Y)) * 6.))
+    vessels += 0.5 * np.exp(-np.square(np.sin(11. * Y + 2. * np.cos(4. * X)) * 8.))
+    spots = 0.5 + 0.5 * np.sin(23. * X) * np.sin(19. * Y)
+    r = 0.75 + 0.1 * spots - 0.35 * vessels
+    g = 0.35 + 0.05 * spots - 0.2 * vessels
+    b = 0.35 + 0.05 * spots - 0.15 * vessels
+    return np.clip(np.stack([r, g, b], -1), 0., 1.)
+
+
+def synthesize_frame(t, H, W, shift=0.05, depth_mid=0.5, depth_amp=0.2, freq=1.5, tool_width=0.08):
+    """RGB [H, W, 3], tool mask [H, W] (1 = tool) and depth [H, W] in (0, 1) of frame time t."""
+    y, x = np.mgrid[:H, :W].astype(np.float32)
+    x, y = (x + .5) / W, (y + .5) / H
+    X = x - shift * np.sin(2. * np.pi * (t + y))
+    Y = y
+
+    rgb = tissue_texture(X, Y)
+    depth = depth_mid + depth_amp * np.sin(2. * np.pi * freq * X) * np.cos(2. * np.pi * freq * Y) * (0.5 + 0.5 * np.sin(2. * np.pi * t))
+    shading = 1. - 0.6 * (depth - depth_mid)  # closer is brighter
+    rgb = np.clip(rgb * shading[..., None], 0., 1.)
+
+    # A tool bar entering from the left border, its tip moving across the image
+    tip = 0.2 + 0.5 * t
+    center = 0.6 + 0.1 * np.sin(2. * np.pi * t)
+    tool = (np.abs(y - center - 0.3 * (x - tip)) < tool_width / 2.) & (x < tip)
+    rgb[tool] = 0.6 + 0.1 * np.sin(40. * x[tool])[..., None]
+    return rgb, tool.astype(np.float32), depth
+
+
+def edge_mask(mask):
+    """Boundary pixels of the mask."""
+    edges = np.zeros_like(mask, dtype=bool)
+    edges[1:, :] |= mask[1:, :] != mask[:-1, :]
+    edges[:, 1:] |= mask[:, 1:] != mask[:, :-1]
+    return edges.astype(np.float32)
+
+
+def make_scene(out_dir, n_frames=40, H=128, W=160, focal=None, **frame_kwargs):
+    """Writes the scene to out_dir, returns out_dir."""
+    for d in ['images', 'masks', 'depth', 'edge_masks']:
+        os.makedirs(os.path.join(out_dir, d), exist_ok=True)
+    focal = focal if focal is not None else 0.89 * W  # the field of view of the DaVinci data
+
+    poses_bounds = []
+    for i, t in enumerate(np.linspace(0., 1., n_frames)):
+        rgb, tool, depth = synthesize_frame(t, H, W, **frame_kwargs)
+        depth8 = np.clip(depth * 255., 1., 255.).astype(np.uint8)
+        name = '{:06d}.png'.format(i)
+        imageio.imwrite(os.path.join(out_dir, 'images', name), (rgb * 255.).astype(np.uint8))
+        imageio.imwrite(os.path.join(out_dir, 'masks', name), (tool * 255.).astype(np.uint8))
+        imageio.imwrite(os.path.join(out_dir, 'depth', name), depth8)
+        imageio.imwrite(os.path.join(out_dir, 'edge_masks', name), (edge_mask(tool) * 255.).astype(np.uint8))
+
+        # Fixed identity camera, near and far bounds from the depth map as create_poses_bounds.py
+        pose = np.concatenate([np.eye(3, 4), np.array([[H], [W], [focal]])], 1)
+        poses_bounds.append(np.concatenate([pose.reshape(-1), [depth8.min(), depth8.max()]]))
+
+    np.save(os.path.join(out_dir, 'poses_bounds.npy'), np.array(poses_bounds))
+    return out_dir
+
+
+if __name__ == '__main__':
+    parser = configargparse.ArgumentParser()
+    parser.add_argument('--out_dir', type=str, required=True,
+                        help='directory of the scene')
+    parser.add_argument('--n_frames', type=int, default=40,
+                        help='num of frames')
+    parser.add_argument('--height', type=int, default=128,
+                        help='image height')
+    parser.add_argument('--width', type=int, default=160,
+                        help='image width')
+    parser.add_argument('--shift', type=float, default=0.05,
+                        help='amplitude of the lateral tissue motion, in image widths')
+    parser.add_argument('--depth_amp', type=float, default=0.2,
+                        help='amplitude of the breathing motion, in units of the depth range')
+    args = parser.parse_args()
+
+    make_scene(args.out_dir, args.n_frames, args.height, args.width, shift=args.shift, depth_amp=args.depth_amp)
+    print('Synthetic scene saved to', args.out_dir)
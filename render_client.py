@@ -0,0 +1,106 @@
+import http.client
+import io
+import json
+import socket
+
+import numpy as np
+
+
+'''
+Client of render_server.py, depends on numpy only
+'''
+
+###################################################################################################
+# Usage Example
+###################################################################################################
+
+# from render_client import RenderClient
+# client = RenderClient('127.0.0.1:8765')          # or RenderClient('/tmp/endonerf.sock')
+# print(client.models())
+# out = client.render(time=0.5, render_factor=2, outputs=['rgb', 'depth', 'points'])
+# out['rgb']     # [H, W, 3] in [0, 1]
+# out['depth']   # [H, W]
+# out['points']  # [H x W, 6], xyz in camera coordinates and rgb
+
+###################################################################################################
+
+
+class RenderServerError(RuntimeError):
+    def __init__(self, status, message):
+        super(RenderServerError, self).__init__('{} {}'.format(status, message))
+        self.status = status
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=None):
+        super(UnixHTTPConnection, self).__init__('localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+class RenderClient:
+    """Requests to a render server at 'address', host:port or the path of its Unix socket.
+    A connection is opened per request, a client can be shared by threads."""
+    def __init__(self, address='127.0.0.1:8765', timeout=600.):
+        self.address = address
+        self.timeout = timeout
+
+    def connection(self):
+        if ':' in self.address:
+            host, port = self.address.rsplit(':', 1)
+            return http.client.HTTPConnection(host, int(port), timeout=self.timeout)
+        return UnixHTTPConnection(self.address, timeout=self.timeout)
+
+    def request(self, method, path, body=None):
+        conn = self.connection()
+        try:
+            headers = {'Content-Type': 'application/json'} if body is not None else {}
+            conn.request(method, path, body=json.dumps(body) if body is not None else None, headers=headers)
+            response = conn.getresponse()
+            data = response.read()
+        finally:
+            conn.close()
+        if response.status != 200:
+            try:
+                message = json.loads(data)['error']
+            except (ValueError, KeyError):
+                message = data.decode(errors='replace')
+            raise RenderServerError(response.status, message)
+        return data
+
+    def models(self):
+        """{name: {hwf, near_far, n_frames, step}} of the models served."""
+        return json.loads(self.request('GET', '/models'))
+
+    def stats(self):
+        return json.loads(self.request('GET', '/stats'))
+
+    def render(self, model=None, pose=None, time=None, frame=None, render_factor=0, outputs=('rgb', 'depth')):
+        """Renders a frame of 'model' (the only one if None) seen from the camera-to-world 'pose'
+        (3 x 4 or 4 x 4, identity if None) at frame time 'time', or with the pose and time of the
+        training frame index 'frame' where these are not given. Returns {output: array} of
+        'outputs', see render_server.OUTPUTS."""
+        request = {'render_factor': int(render_factor), 'outputs': list(outputs)}
+        if model is not None:
+            request['model'] = model
+        if pose is not None:
+            request['pose'] = np.asarray(pose, np.float32).tolist()
+        if time is not None:
+            request['time'] = float(time)
+        if frame is not None:
+            request['frame'] = int(frame)
+        with np.load(io.BytesIO(self.request('POST', '/render', request))) as npz:
+            return {k: npz[k] for k in npz.files}
+
+
+def to_open3d(points):
+    """open3d point cloud of the points [N, 6] of a render, as endo_pc_reconstruction.py saves."""
+    import open3d as o3d
+    pcd = o3d.geometry.PointCloud()
+    pcd.points = o3d.utility.Vector3dVector(points[:, :3].astype(np.float64))
+    pcd.colors = o3d.utility.Vector3dVector(points[:, 3:].astype(np.float64))
+    return pcd
@@ -0,0 +1,359 @@
+from run_endonerf import *
+import concurrent.futures
+import configargparse
+import http.server
+import io
+import queue
+import socketserver
+import threading
+
+
+'''
+Render service keeping trained models in memory
+'''
+
+###################################################################################################
+# Usage Example
+###################################################################################################
+
+# Server:  python render_server.py --configs configs/cutting.txt configs/pulling.txt --port 8765
+#          python render_server.py --configs configs/cutting.txt --socket /tmp/endonerf.sock
+# Client:  see render_client.py
+
+###################################################################################################
+
+# Protocol, HTTP/1.1 on localhost or a Unix socket:
+#   GET  /models  json of the loaded models: hwf, near_far, num of frames and checkpoint step
+#   GET  /stats   json counters of the served requests and the batched render calls
+#   POST /render  json request, answered with an npz archive of the requested outputs
+#     model:          name of the model, the expname of its config (optional with a single model)
+#     pose:           camera-to-world matrix, 3 x 4 or 4 x 4 nested lists, default identity
+#     frame:          index of a training frame whose pose and time are used if not given
+#     time:           frame time in [0, 1], default 0
+#     render_factor:  downsampling factor of the image, 0 for full resolution
+#     outputs:        subset of OUTPUTS, default ['rgb', 'depth']
+# Errors are answered with a json object {"error": message}.
+
+OUTPUTS = ['rgb', 'disp', 'depth', 'points']
+
+
+class RenderModel:
+    """An experiment loaded for rendering: the networks of its latest checkpoint (or of
+    ft_path), the intrinsics and bounds of its dataset and the poses and times of its
+    frames."""
+    def __init__(self, args):
+        self.name = args.expname
+        _, _, depth_maps, _, poses, times, _, _, hwf, _, _, _, near, far, close_depth, inf_depth = load_data(args)
+        if depth_maps is not None:
+            close_depth, inf_depth = np.percentile(depth_maps, 3.0), np.percentile(depth_maps, 99.9)
+        self.hwf = hwf
+        self.near_far = (float(close_depth), float(inf_depth))
+        self.poses = np.asarray(poses, np.float32)
+        self.times = np.asarray(times, np.float32)
+        self.chunk = args.chunk
+        _, self.render_kwargs, self.step, _, _, _ = create_nerf(args, training=False)
+        self.render_kwargs.update({'near': near + 1e-6, 'far': far})
+
+    def info(self):
+        return {'hwf': [self.hwf[0], self.hwf[1], float(self.hwf[2])], 'near_far': list(self.near_far),
+                'n_frames': len(self.times), 'step': self.step}
+
+    def intrinsics(self, render_factor):
+        H, W, focal = self.hwf
+        if render_factor != 0:
+            H, W, focal = H // render_factor, W // render_factor, focal / render_factor
+        return H, W, focal
+
+    def render(self, c2ws, frame_time, render_factor):
+        """Renders the poses c2ws [N, 3, 4] at one frame time in a single ray batch.
+        Returns rgb [N, H, W, 3] and disp [N, H, W] in host memory."""
+        H, W, focal = self.intrinsics(render_factor)
+        rays = [get_rays(H, W, focal, c2w) for c2w in torch.Tensor(c2ws)]
+        rays_o = torch.cat([r[0].reshape(-1, 3) for r in rays], 0)
+        rays_d = torch.cat([r[1].reshape(-1, 3) for r in rays], 0)
+
+        # stream the chunks to host memory as render_path
+        rgb, disp = np.empty([rays_o.shape[0], 3], np.float32), np.empty([rays_o.shape[0]], np.float32)
+        def consume(j, ret):
+            rgb[j:j+ret['rgb_map'].shape[0]] = ret['rgb_map'].cpu().numpy()
+            disp[j:j+ret['disp_map'].shape[0]] = ret['disp_map'].cpu().numpy()
+
+        with torch.no_grad():
+            render(H, W, focal, chunk=self.chunk, rays=torch.stack([rays_o, rays_d], 0), frame_time=frame_time,
+                   consumer=consume, outputs=['rgb_map', 'disp_map'], **self.render_kwargs)
+        return rgb.reshape([len(c2ws), H, W, 3]), disp.reshape([len(c2ws), H, W])
+
+
+def frame_outputs(model, rgb, disp, render_factor, outputs):
+    """The outputs of a rendered frame: rgb [H, W, 3] in [0, 1], disp [H, W], depth [H, W] scaled
+    to the depth range of the dataset as the depth maps of render_path, and points [H x W, 6],
+    the pinhole back-projection of the depth in camera coordinates followed by the colors."""
+    ret = {}
+    if 'rgb' in outputs:
+        ret['rgb'] = rgb
+    if 'disp' in outputs:
+        ret['disp'] = disp
+    if 'depth' in outputs or 'points' in outputs:
+        depth = (1.0 / (disp + 1e-6)) * (model.near_far[1] - model.near_far[0])
+        if 'depth' in outputs:
+            ret['depth'] = depth
+        if 'points' in outputs:
+            H, W, focal = model.intrinsics(render_factor)
+            v, u = np.mgrid[:H, :W].astype(np.float32)
+            xyz = np.stack([(u - W / 2.) * depth / focal, (v - H / 2.) * depth / focal, depth], -1)
+            ret['points'] = np.concatenate([xyz, rgb], -1).reshape(-1, 6)
+    return ret
+
+
+class RenderRequest:
+    def __init__(self, model, c2w, frame_time, render_factor, outputs):
+        self.model = model
+        self.c2w = c2w
+        self.frame_time = frame_time
+        self.render_factor = render_factor
+        self.outputs = outputs
+        self.future = concurrent.futures.Future()
+
+
+class RenderQueue:
+    """Renders the submitted requests in a single thread. The requests waiting when the thread
+    becomes free (after batch_wait seconds more, if > 0) are batched: those of the same model,
+    frame time and resolution are rendered in one ray batch, of at most max_batch_frames poses,
+    each distinct pose once. Requests of different times cannot share a batch, the networks are
+    evaluated at one time per call."""
+    def __init__(self, batch_wait=0., max_batch_frames=16):
+        self.batch_wait = batch_wait
+        self.max_batch_frames = max_batch_frames
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'batches': 0, 'frames_rendered': 0, 'rays_rendered': 0, 'render_s': 0.}
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, request):
+        self.queue.put(request)
+        return request.future
+
+    def next_requests(self):
+        requests = [self.queue.get()]
+        deadline = time.time() + self.batch_wait
+        while True:
+            try:
+                requests.append(self.queue.get_nowait())
+            except queue.Empty:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    requests.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+        return requests
+
+    def run(self):
+        while True:
+            groups = {}
+            for r in self.next_requests():
+                groups.setdefault((r.model.name, r.frame_time, r.render_factor), []).append(r)
+            for group in groups.values():
+                for k in range(0, len(group), self.max_batch_frames):
+                    self.render_batch(group[k:k+self.max_batch_frames])
+
+    def render_batch(self, requests):
+        model, frame_time, render_factor = requests[0].model, requests[0].frame_time, requests[0].render_factor
+        poses = {}
+        for r in requests:
+            poses.setdefault(r.c2w.tobytes(), r.c2w)
+        keys = list(poses.keys())
+        t0 = time.time()
+        try:
+            rgbs, disps = model.render(np.stack([poses[k] for k in keys], 0), frame_time, render_factor)
+        except Exception as e:
+            for r in requests:
+                r.future.set_exception(e)
+            return
+        with self.lock:
+            self.stats['requests'] += len(requests)
+            self.stats['batches'] += 1
+            self.stats['frames_rendered'] += len(keys)
+            self.stats['rays_rendered'] += rgbs.shape[0] * rgbs.shape[1] * rgbs.shape[2]
+            self.stats['render_s'] += time.time() - t0
+        for r in requests:
+            i = keys.index(r.c2w.tobytes())
+            r.future.set_result((rgbs[i], disps[i]))
+
+
+def request_field(request, key, types, default=None):
+    """request[key] if it has one of 'types' (bool is never a number), default if missing,
+    ValueError otherwise."""
+    value = request.get(key)
+    if value is None:
+        return default
+    if isinstance(value, bool) or not isinstance(value, types):
+        raise ValueError('{} must be {}, got {}'.format(key, ' or '.join(t.__name__ for t in types), json.dumps(value)))
+    return value
+
+
+def parse_request(models, request):
+    """RenderRequest of a json request, ValueError or KeyError (unknown model) if invalid."""
+    if not isinstance(request, dict):
+        raise ValueError('the request must be a json object')
+    name = request_field(request, 'model', (str,))
+    if name is None:
+        if len(models) > 1:
+            raise ValueError('model is required, loaded models: {}'.format(', '.join(models)))
+        name = next(iter(models))
+    model = models[name]
+
+    frame = request_field(request, 'frame', (int,))
+    if frame is not None and not 0 <= frame < len(model.times):
+        raise ValueError('frame {} out of range [0, {})'.format(frame, len(model.times)))
+    pose = request_field(request, 'pose', (list,))
+    if pose is not None:
+        try:
+            c2w = np.asarray(pose, np.float32)
+        except (TypeError, ValueError):
+            raise ValueError('pose must be 3 x 4 or 4 x 4 nested lists of numbers')
+        if c2w.shape not in [(3, 4), (4, 4)]:
+            raise ValueError('pose must be 3 x 4 or 4 x 4, got {}'.format(list(c2w.shape)))
+        c2w = c2w[:3, :4]
+    elif frame is not None:
+        c2w = model.poses[frame]
+    else:
+        c2w = np.eye(4, dtype=np.float32)[:3, :4]
+    frame_time = request_field(request, 'time', (int, float))
+    frame_time = float(frame_time) if frame_time is not None else (float(model.times[frame]) if frame is not None else 0.)
+
+    render_factor = request_field(request, 'render_factor', (int,), 0)
+    H, W, _ = model.hwf
+    if render_factor < 0 or (render_factor > 0 and (H // render_factor == 0 or W // render_factor == 0)):
+        raise ValueError('render_factor must be in [0, {}]'.format(min(H, W)))
+    outputs = request_field(request, 'outputs', (list,), ['rgb', 'depth'])
+    if not all(isinstance(k, str) for k in outputs):
+        raise ValueError('outputs must be a list of names')
+    unknown = [k for k in outputs if k not in OUTPUTS]
+    if len(unknown) > 0:
+        raise ValueError('unknown outputs {}, available: {}'.format(', '.join(unknown), ', '.join(OUTPUTS)))
+    return RenderRequest(model, np.ascontiguousarray(c2w), frame_time, render_factor, outputs)
+
+
+class RenderHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def send(self, code, body, content_type):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, code, obj):
+        self.send(code, json.dumps(obj).encode(), 'application/json')
+
+    def do_GET(self):
+        if self.path == '/models':
+            self.send_json(200, {name: m.info() for name, m in self.server.models.items()})
+        elif self.path == '/stats':
+            with self.server.render_queue.lock:
+                self.send_json(200, dict(self.server.render_queue.stats))
+        else:
+            self.send_json(404, {'error': 'unknown path ' + self.path})
+
+    def do_POST(self):
+        if self.path != '/render':
+            self.send_json(404, {'error': 'unknown path ' + self.path})
+            return
+        try:
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            request = parse_request(self.server.models, json.loads(body))
+        except KeyError as e:
+            self.send_json(404, {'error': 'unknown model {}'.format(e)})
+            return
+        except (ValueError, TypeError) as e:
+            self.send_json(400, {'error': str(e)})
+            return
+
+        try:
+            rgb, disp = self.server.render_queue.submit(request).result()
+        except Exception as e:
+            self.send_json(500, {'error': '{}: {}'.format(type(e).__name__, e)})
+            return
+        buf = io.BytesIO()
+        np.savez(buf, **frame_outputs(request.model, rgb, disp, request.render_factor, request.outputs))
+        self.send(200, buf.getvalue(), 'application/octet-stream')
+
+    def address_string(self):
+        # client_address is empty on Unix sockets
+        return self.client_address[0] if isinstance(self.client_address, tuple) else 'unix'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class RenderHTTPServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+
+class UnixRenderHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(models, host='127.0.0.1', port=8765, socket_path='', batch_wait=0., max_batch_frames=16, verbose=False):
+    """Serves the RenderModels 'models' {name: model} until interrupted."""
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = UnixRenderHTTPServer(socket_path, RenderHandler)
+        address = 'unix:' + socket_path
+    else:
+        server = RenderHTTPServer((host, port), RenderHandler)
+        address = 'http://{}:{}'.format(host, server.server_address[1])
+    server.models = models
+    server.render_queue = RenderQueue(batch_wait, max_batch_frames)
+    server.verbose = verbose
+    print('Serving {} on {}'.format(', '.join(models), address), flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if socket_path and os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+if __name__ == '__main__':
+    parser = configargparse.ArgumentParser()
+    parser.add_argument('--configs', type=str, nargs='+', required=True,
+                        help='config files of the experiments to serve, the latest checkpoint of each is loaded')
+    parser.add_argument('--host', type=str, default='127.0.0.1',
+                        help='address to listen on')
+    parser.add_argument('--port', type=int, default=8765,
+                        help='port to listen on, 0 for any free port')
+    parser.add_argument('--socket', type=str, default='',
+                        help='listen on this Unix socket instead of host and port')
+    parser.add_argument('--batch_wait_ms', type=float, default=0.,
+                        help='time to wait for more requests to batch with the first waiting one, 0 to batch only those already waiting')
+    parser.add_argument('--max_batch_frames', type=int, default=16,
+                        help='max num of poses rendered in one ray batch')
+    parser.add_argument('--compile', type=str, default='none', choices=COMPILE_METHODS,
+                        help='compile the networks, see run_endonerf.py --compile')
+    parser.add_argument('--verbose', action='store_true',
+                        help='log every request')
+    add_device_args(parser)
+    cfg = parser.parse_args()
+
+    models = {}
+    for config in cfg.configs:
+        nerf_args = config_parser().parse_args(['--config', config])
+        for k in DEVICE_ARGS + ['compile']:
+            setattr(nerf_args, k, getattr(cfg, k))
+        configure_device(nerf_args)
+        model = RenderModel(nerf_args)
+        if model.name in models:
+            raise ValueError('Two configs with expname ' + model.name)
+        models[model.name] = model
+        print('Loaded {} at iteration {}'.format(model.name, model.step))
+
+    serve(models, cfg.host, cfg.port, cfg.socket, cfg.batch_wait_ms / 1000., cfg.max_batch_frames, cfg.verbose)
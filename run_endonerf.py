@@ -1,7 +1,12 @@
 import os
+import sys
+import subprocess
 import imageio
 import time
 import math
+import json
+import hashlib
+import warnings
 from torch.utils.tensorboard import SummaryWriter
 from tqdm import tqdm, trange
 
@@ -10,10 +15,6 @@ from run_endonerf_helpers import *
 
 from load_blender import load_blender_data
 from load_llff import load_llff_data
-try:
-    from apex import amp
-except ImportError:
-    pass
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 np.random.seed(0)
@@ -27,28 +28,42 @@ def batchify(fn, chunk):
         return fn
     def ret(inputs_pos, inputs_time):
         num_batches = inputs_pos.shape[0]
+        if num_batches <= chunk:
+            return fn(inputs_pos, inputs_time)
 
-        out_list = []
-        dx_list = []
+        # outputs are written into buffers allocated from the first chunk's shapes
+        outs_all = None
         for i in range(0, num_batches, chunk):
-            out, dx = fn(inputs_pos[i:i+chunk], [inputs_time[0][i:i+chunk], inputs_time[1][i:i+chunk]])
-            out_list += [out]
-            dx_list += [dx]
+            outs = fn(inputs_pos[i:i+chunk], [inputs_time[0][i:i+chunk], inputs_time[1][i:i+chunk]])
+            if outs_all is None:
+                outs_all = [out.new_empty([num_batches] + list(out.shape[1:])) for out in outs]
+            for out_all, out in zip(outs_all, outs):
+                out_all[i:i+chunk] = out
 
-        return torch.cat(out_list, 0), torch.cat(dx_list, 0)
+        return tuple(outs_all)
     return ret
 
 
+@profiled('run_network')
 def run_network(inputs, viewdirs, frame_time, fn, embed_fn, embeddirs_fn, embedtime_fn, netchunk=1024*64,
-                embd_time_discr=True):
+                embd_time_discr=True, autocast_dtype=None, deformation_only=False):
     """Prepares inputs and applies network 'fn'.
     inputs: N_rays x N_points_per_ray x 3
     viewdirs: N_rays x 3
     frame_time: N_rays x 1
+    autocast_dtype: if not None, the MLPs run under torch.autocast with this dtype.
+      Embeddings and returned outputs stay in float32.
+    deformation_only: if True, only the deformation network of 'fn' is evaluated and
+      position_delta is returned alone. Rays may have different times and viewdirs
+      are ignored. Zero for networks without deformation.
     """
 
-    assert len(torch.unique(frame_time)) == 1, "Only accepts all points from same time"
-    cur_time = torch.unique(frame_time)[0]
+    if deformation_only:
+        viewdirs = None
+        if not hasattr(fn, 'query_deformation'):
+            return torch.zeros_like(inputs)
+    else:
+        assert len(torch.unique(frame_time)) == 1, "Only accepts all points from same time"
 
     # embed position
     inputs_flat = torch.reshape(inputs, [-1, inputs.shape[-1]])
@@ -72,35 +87,116 @@ def run_network(inputs, viewdirs, frame_time, fn, embed_fn, embeddirs_fn, embedt
         embedded_dirs = embeddirs_fn(input_dirs_flat)
         embedded = torch.cat([embedded, embedded_dirs], -1)
 
-    outputs_flat, position_delta_flat = batchify(fn, netchunk)(embedded, embedded_times)
+    if deformation_only:
+        with autocast(autocast_dtype, inputs.device.type):
+            position_delta_flat, = batchify(lambda x, ts: (fn.query_deformation(x, ts),), netchunk)(embedded, embedded_times)
+        return torch.reshape(position_delta_flat.float(), list(inputs.shape[:-1]) + [position_delta_flat.shape[-1]])
+
+    with autocast(autocast_dtype, inputs.device.type):
+        outputs_flat, position_delta_flat = batchify(fn, netchunk)(embedded, embedded_times)
+    outputs_flat, position_delta_flat = outputs_flat.float(), position_delta_flat.float()
     outputs = torch.reshape(outputs_flat, list(inputs.shape[:-1]) + [outputs_flat.shape[-1]])
     position_delta = torch.reshape(position_delta_flat, list(inputs.shape[:-1]) + [position_delta_flat.shape[-1]])
 
     return outputs, position_delta
 
 
-def batchify_rays(rays_flat,volumetric_function, chunk=1024*32, **kwargs):
+def run_network_occupied(network_query_fn, inputs, viewdirs, frame_time, network_fn, occupancy_grid=None):
+    """Applies network_query_fn only to samples in occupied cells of 'occupancy_grid'.
+    Occupied samples are packed as single-sample rays; skipped samples get zero density.
+    inputs: N_rays x N_points_per_ray x 3
+    Returns raw, position_delta and the number of evaluated samples per ray.
+    """
+    if occupancy_grid is None:
+        raw, position_delta = network_query_fn(inputs, viewdirs, frame_time, network_fn)
+        stage_timer.count('network_evals', inputs.shape[0] * inputs.shape[1])
+        return raw, position_delta, None
+
+    mask = occupancy_grid.query(inputs)  # [N_rays, N_points_per_ray]
+    if stage_timer.enabled:
+        stage_timer.count('network_evals', mask.sum())
+    raw = torch.zeros(list(inputs.shape[:-1]) + [network_fn.output_ch])
+    raw[..., 3] = -1e10
+    if not mask.any():
+        # Nothing to evaluate, the network cannot take an empty batch
+        return raw, torch.zeros_like(inputs), mask.sum(-1)
+
+    ray_inds = torch.nonzero(mask)[:, 0]
+    raw_packed, position_delta_packed = network_query_fn(inputs[mask][:, None],
+                                                         viewdirs[ray_inds] if viewdirs is not None else None,
+                                                         frame_time[ray_inds], network_fn)
+    raw = raw.masked_scatter(mask[..., None], raw_packed)
+    position_delta = torch.zeros_like(inputs).masked_scatter(mask[..., None], position_delta_packed)
+    return raw, position_delta, mask.sum(-1)
+
+
+def query_deformation(network_query_fn, inputs, frame_time, network_fn, occupancy_grid=None):
+    """Position delta of samples 'inputs' [N_rays, N_points_per_ray, 3] at per-ray times
+    'frame_time' [N_rays, 1] from the deformation network only. As in run_network_occupied,
+    samples in empty cells of 'occupancy_grid' are skipped and get zero.
+    """
+    if occupancy_grid is None:
+        return network_query_fn(inputs, None, frame_time, network_fn, deformation_only=True)
+
+    mask = occupancy_grid.query(inputs)  # [N_rays, N_points_per_ray]
+    if not mask.any():
+        return torch.zeros_like(inputs)
+    ray_inds = torch.nonzero(mask)[:, 0]
+    position_delta_packed = network_query_fn(inputs[mask][:, None], None, frame_time[ray_inds], network_fn,
+                                             deformation_only=True)
+    return torch.zeros_like(inputs).masked_scatter(mask[..., None], position_delta_packed)
+
+
+def update_occupancy_grid(occupancy_grid, render_kwargs, chunk=1024*64):
+    """Refreshes 'occupancy_grid' from the canonical densities of the coarse and fine networks.
+    """
+    network_query_fn = render_kwargs['network_query_fn']
+    canonical_fns = [m._occ if hasattr(m, '_occ') else m
+                     for m in [render_kwargs['network_fn'], render_kwargs['network_fine']] if m is not None]
+
+    def density_fn(pts):
+        viewdirs = torch.Tensor([[0., 0., -1.]]).expand(pts.shape) if render_kwargs['use_viewdirs'] else None
+        sigma = torch.zeros_like(pts[:, 0])
+        for fn in canonical_fns:
+            raw, _ = network_query_fn(pts[:, None], viewdirs, torch.zeros_like(pts[:, :1]), fn)
+            sigma = torch.maximum(sigma, F.relu(raw[:, 0, 3]))
+        return sigma
+
+    with torch.no_grad():
+        occupancy_grid.update(density_fn, chunk=chunk)
+
+
+def batchify_rays(rays_flat, chunk=1024*32, consumer=None, **kwargs):
     """Render rays in smaller minibatches to avoid OOM.
+    consumer: if not None, called as consumer(i, ret) with the outputs of the rays
+      starting at index i instead of gathering them, batchify_rays then returns None.
     """
 
     # if (torch.isnan(rays_flat).any() or torch.isinf(rays_flat).any()) and DEBUG:
     #     print(f"! [Numerical Error] rays_flat contains nan or inf.", flush=True)
-    
-    all_ret = {}
-    for i in range(0, rays_flat.shape[0], chunk):
-        ret = render_rays(rays_flat[i:i+chunk],volumetric_function=volumetric_function, **kwargs)
+
+    N_rays = rays_flat.shape[0]
+    if consumer is None and N_rays <= chunk:
+        return render_rays(rays_flat, **kwargs)
+
+    # outputs are written into buffers allocated from the first chunk's shapes
+    all_ret = None
+    for i in range(0, N_rays, chunk):
+        ret = render_rays(rays_flat[i:i+chunk], **kwargs)
+        if consumer is not None:
+            consumer(i, ret)
+            continue
+        if all_ret is None:
+            all_ret = {k : ret[k].new_empty([N_rays] + list(ret[k].shape[1:])) for k in ret}
         for k in ret:
-            if k not in all_ret:
-                all_ret[k] = []
-            all_ret[k].append(ret[k])
+            all_ret[k][i:i+chunk] = ret[k]
 
-    all_ret = {k : torch.cat(all_ret[k], 0) for k in all_ret}
     return all_ret
 
 
-def render(H, W, focal, volumetric_function, chunk=1024*32, rays=None, c2w=None, ndc=True,
+def render(H, W, focal, chunk=1024*32, rays=None, c2w=None, ndc=True,
                   near=0., far=1., frame_time=None,
-                  use_viewdirs=False, c2w_staticcam=None,
+                  use_viewdirs=False, c2w_staticcam=None, consumer=None, rays_buffer=None,
                   **kwargs):
     """Render rays
     Args:
@@ -118,10 +214,15 @@ def render(H, W, focal, volumetric_function, chunk=1024*32, rays=None, c2w=None,
       use_viewdirs: bool. If True, use viewing direction of a point in space in model.
       c2w_staticcam: array of shape [3, 4]. If not None, use this transformation matrix for 
        camera while using other c2w argument for viewing directions.
+      consumer: function. If not None, called as consumer(i, ret) with the flat render_rays()
+       outputs of every chunk of rays starting at index i, nothing is gathered or returned.
+      rays_buffer: array of shape [batch_size, 12] (use_viewdirs) or [batch_size, 9] the ray
+       batch is assembled in, None to allocate it.
+      outputs: collection of render_rays() keys to compute and return, None for all.
     Returns:
-      rgb_map: [batch_size, 3]. Predicted RGB values for rays.
-      disp_map: [batch_size]. Disparity map. Inverse of depth.
-      acc_map: [batch_size]. Accumulated opacity (alpha) along a ray.
+      rgb_map: [batch_size, 3]. Predicted RGB values for rays. None if not in outputs.
+      disp_map: [batch_size]. Disparity map. Inverse of depth. None if not in outputs.
+      acc_map: [batch_size]. Accumulated opacity (alpha) along a ray. None if not in outputs.
       extras: dict with everything returned by render_rays().
     """
     
@@ -163,29 +264,35 @@ def render(H, W, focal, volumetric_function, chunk=1024*32, rays=None, c2w=None,
 
     if 'use_depth' in kwargs and kwargs['use_depth']:
         # near is the mean of depth, far is the std of depth
-        near = near.unsqueeze(0).reshape(-1, 1)
-        far = far * torch.ones_like(near)
-    else:
-        near, far = near * torch.ones_like(rays_d[...,:1]), far * torch.ones_like(rays_d[...,:1])
-    frame_time = frame_time * torch.ones_like(rays_d[...,:1])
-    rays = torch.cat([rays_o, rays_d, near, far, frame_time], -1)
+        near = near.reshape(-1, 1)
+    if rays_buffer is None:
+        rays_buffer = torch.empty([rays_d.shape[0], 12 if use_viewdirs else 9])
+    rays = rays_buffer
+    rays[:, 0:3] = rays_o
+    rays[:, 3:6] = rays_d
+    rays[:, 6:7] = near  # scalars are broadcast to all rays
+    rays[:, 7:8] = far
+    rays[:, 8:9] = frame_time
     if use_viewdirs:
-        rays = torch.cat([rays, viewdirs], -1)
+        rays[:, 9:12] = viewdirs
 
     # Render and reshape
-    all_ret = batchify_rays(rays,volumetric_function, chunk, **kwargs)
+    all_ret = batchify_rays(rays, chunk, consumer=consumer, **kwargs)
+    if consumer is not None:
+        return None
     for k in all_ret:
         k_sh = list(sh[:-1]) + list(all_ret[k].shape[1:])
         all_ret[k] = torch.reshape(all_ret[k], k_sh)
 
     k_extract = ['rgb_map', 'disp_map', 'acc_map']
-    ret_list = [all_ret[k] for k in k_extract]
+    ret_list = [all_ret.get(k) for k in k_extract]
     ret_dict = {k : all_ret[k] for k in all_ret if k not in k_extract}
     return ret_list + [ret_dict]
 
 
-def render_path(render_poses, render_times, hwf, chunk, volumetric_function, render_kwargs, gt_imgs=None, savedir=None,
-                render_factor=0, save_also_gt=False, i_offset=0, save_depth=False, near_far=(0, 1)):
+def render_path(render_poses, render_times, hwf, chunk, render_kwargs, gt_imgs=None, savedir=None,
+                render_factor=0, save_also_gt=False, i_offset=0, save_depth=False, near_far=(0, 1), profiler=None):
+    """profiler: StepProfiler whose steps are the rendered frames."""
 
     H, W, focal = hwf
 
@@ -205,11 +312,27 @@ def render_path(render_poses, render_times, hwf, chunk, volumetric_function, ren
 
     rgbs = []
     disps = []
+    samples_per_ray = []
 
+    time0 = time.time()
     for i, (c2w, frame_time) in enumerate(zip(tqdm(render_poses), render_times)):
-        rgb, disp, acc, _ = render(H, W, focal, chunk=chunk, volumetric_function=volumetric_function,c2w=c2w[:3,:4], frame_time=frame_time, **render_kwargs)
-        rgbs.append(rgb.cpu().numpy())
-        disps.append(disp.cpu().numpy())
+        if profiler is not None:
+            profiler.step(i)
+        # stream the chunks to host memory, the full-image extras are never gathered on the device
+        rgb, disp = np.empty([H * W, 3], np.float32), np.empty([H * W], np.float32)
+        n_evaluated = []
+        def consume(j, ret):
+            rgb[j:j+ret['rgb_map'].shape[0]] = ret['rgb_map'].cpu().numpy()
+            disp[j:j+ret['disp_map'].shape[0]] = ret['disp_map'].cpu().numpy()
+            if 'samples_per_ray' in ret:
+                n_evaluated.append(ret['samples_per_ray'].sum().item())
+
+        render(H, W, focal, chunk=chunk, c2w=c2w[:3,:4], frame_time=frame_time, consumer=consume,
+               outputs=['rgb_map', 'disp_map', 'samples_per_ray'], **render_kwargs)
+        rgbs.append(rgb.reshape([H, W, 3]))
+        disps.append(disp.reshape([H, W]))
+        if len(n_evaluated) > 0:
+            samples_per_ray.append(sum(n_evaluated) / (H * W))
 
         if savedir is not None:
             rgb8_estim = to8b(rgbs[-1])
@@ -226,9 +349,23 @@ def render_path(render_poses, render_times, hwf, chunk, volumetric_function, ren
                 filename = os.path.join(save_dir_estim, '{:03d}.depth.npy'.format(i+i_offset))
                 np.save(filename, depth_estim)
     
+    if profiler is not None:
+        profiler.stop()
     rgbs = np.stack(rgbs, 0)
     disps = np.stack(disps, 0)
 
+    render_time = time.time() - time0
+    print('Rendered {} frames of {} x {} in {:.1f} s ({:.0f} rays/s, {:.2f} frames/s)'.format(
+        len(rgbs), H, W, render_time, len(rgbs) * H * W / render_time, len(rgbs) / render_time))
+
+    if len(samples_per_ray) > 0:
+        N_samples, N_importance = render_kwargs['N_samples'], render_kwargs['N_importance']
+        samples_full = N_samples + (N_samples + N_importance if N_importance > 0 else 0)  # without reuse or skipping
+        if render_kwargs.get('baked') is not None:
+            samples_full = N_samples + N_importance  # single uniform pass
+        print('Network evaluations per ray: {:.2f} / {} ({:.1f}% saved)'.format(
+            np.mean(samples_per_ray), samples_full, 100. * (1. - np.mean(samples_per_ray) / samples_full)))
+
     # depth_maps = 1.0 / (disps + 1e-6)
     # close_depth, inf_depth = np.percentile(depth_maps, 3.0), np.percentile(depth_maps, 99.0)
     # if save_depth:
@@ -239,7 +376,8 @@ def render_path(render_poses, render_times, hwf, chunk, volumetric_function, ren
 
     return rgbs, disps
 
-def render_path_gpu(render_poses, render_times, hwf, chunk, render_kwargs, render_factor=0):
+def render_path_gpu(render_poses, render_times, hwf, chunk, render_kwargs, render_factor=0, outputs=('rgb_map', 'disp_map')):
+    """Renders on the device and returns stacked rgb and disp tensors, None for maps not in outputs."""
 
     H, W, focal = hwf
 
@@ -253,18 +391,263 @@ def render_path_gpu(render_poses, render_times, hwf, chunk, render_kwargs, rende
     disps = []
 
     for i, (c2w, frame_time) in enumerate(zip(tqdm(render_poses), render_times)):
-        rgb, disp, _, _ = render(H, W, focal, chunk=chunk, c2w=c2w[:3,:4], frame_time=frame_time, **render_kwargs)
+        rgb, disp, _, _ = render(H, W, focal, chunk=chunk, c2w=c2w[:3,:4], frame_time=frame_time, outputs=outputs, **render_kwargs)
         rgbs.append(rgb)
         disps.append(disp)
 
-    rgbs = torch.stack(rgbs, 0)
-    disps = torch.stack(disps, 0)
+    rgbs = torch.stack(rgbs, 0) if 'rgb_map' in outputs else None
+    disps = torch.stack(disps, 0) if 'disp_map' in outputs else None
 
     return rgbs, disps
 
 
-def create_nerf(args):
+def write_depth_pngs(save_path, depth_maps, img_inds):
+    """Writes depth maps [N, H, W] (numpy) as 8-bit images normalized by their common maximum."""
+    max_depth = depth_maps.max()
+    for j, depth in zip(img_inds, depth_maps):
+        imageio.imwrite(os.path.join(save_path, 'depth_{:0d}.png'.format(j)), to8b(depth / max_depth))
+
+
+class DepthRefiner:
+    """Sparse, amortized refinement of the training depth maps (section 2.1).
+
+    As the full-frame refinement, a round replaces in every training frame the depth of the
+    masked pixels whose squared error to the rendered depth is above the (1 - quantile)
+    quantile over all H x W pixels. Frames are not rendered completely: the depth is first
+    probed at one masked pixel per cell of a regular grid covering 'sample_rate' of the
+    pixels, then only the cells with the highest probe errors, holding 'candidate_factor'
+    times as many masked pixels as the quantile selects, are rendered densely. Pixels that
+    are not rendered count as error free. With sample_rate 1 every masked pixel is rendered
+    and the result is that of the full-frame refinement.
+
+    The rays of a round are rendered 'rays_per_iter' at a time, one step() per training
+    iteration, or all in the first step() if 0. Diagnostics are written by 'writer'.
+    """
+    def __init__(self, depth_maps, masks, poses, times, i_train, hwf, depth_scale, render_kwargs, chunk,
+                 quantile=0.3, sample_rate=1., candidate_factor=2., rays_per_iter=0, writer=None):
+        self.depth_maps = depth_maps
+        self.masks = masks
+        self.poses = poses
+        self.times = times
+        self.i_train = i_train
+        self.hwf = hwf
+        self.depth_scale = depth_scale
+        self.render_kwargs = render_kwargs
+        self.chunk = chunk
+        self.quantile = quantile
+        self.candidate_factor = candidate_factor
+        self.rays_per_iter = rays_per_iter
+        self.writer = writer if writer is not None else BackgroundWriter()
+        self.generator = torch.Generator(device='cpu').manual_seed(0)
+        self.version = 0  # incremented on every change of depth_maps
+
+        H, W, _ = hwf
+        self.stride = max(int(round(1. / math.sqrt(min(sample_rate, 1.)))), 1)
+        y, x = torch.meshgrid(torch.arange(H), torch.arange(W), indexing='ij')
+        n_cells_x = (W + self.stride - 1) // self.stride
+        self.cell_of = ((y // self.stride) * n_cells_x + x // self.stride).reshape(-1).to(depth_maps.device)  # [H x W]
+        self.n_cells = int(self.cell_of.max()) + 1
+        self.job = None
+
+    @property
+    def active(self):
+        return self.job is not None
+
+    def start(self, refinement_round, save_path):
+        """Starts a round, finishing the running one first. No diagnostics are saved if save_path is None."""
+        if self.active:
+            self.finish()
+        self.job = self._round(refinement_round, save_path)
+
+    def step(self):
+        """Renders the rays of one training iteration. Returns True when the round is done."""
+        if not self.active:
+            return False
+        for _ in self.job:
+            if self.rays_per_iter > 0:
+                return False
+        self.job = None
+        return True
+
+    def finish(self):
+        while self.active:
+            self.step()
+
+    def _render_depth(self, j, inds):
+        """Generator rendering the depth of pixels 'inds' of training frame j, yields after
+        every rays_per_iter rays and returns the depths [len(inds)]."""
+        H, W, focal = self.hwf
+        rays_o, rays_d = get_rays(H, W, focal, self.poses[j][:3, :4])
+        rays_o, rays_d = rays_o.reshape(-1, 3), rays_d.reshape(-1, 3)
+        n = self.rays_per_iter if self.rays_per_iter > 0 else max(len(inds), 1)
+        disps = [torch.zeros(0, device=inds.device)]
+        for k in range(0, len(inds), n):
+            inds_k = inds[k:k+n]
+            with torch.no_grad():
+                _, disp, _, _ = render(H, W, focal, chunk=self.chunk, rays=torch.stack([rays_o[inds_k], rays_d[inds_k]], 0),
+                                       frame_time=self.times[j], outputs=['disp_map'], **self.render_kwargs)
+            disps.append(disp)
+            yield
+        return (1.0 / (torch.cat(disps, 0) + 1e-6)) * self.depth_scale
+
+    def _probe_pixels(self, mask):
+        """One random masked pixel per grid cell, every masked pixel for stride 1."""
+        inds = torch.nonzero(mask)[:, 0]
+        if self.stride == 1:
+            return inds
+        inds = inds[torch.randperm(len(inds), generator=self.generator, device='cpu').to(inds.device)]
+        probe = -torch.ones(self.n_cells, dtype=torch.long, device=inds.device)
+        probe[self.cell_of[inds]] = inds
+        return probe[probe >= 0]
+
+    def _refine_frame(self, j):
+        H, W, _ = self.hwf
+        depth_gt = self.depth_maps[j].reshape(-1)
+        mask = self.masks[j].reshape(-1) if self.masks is not None else torch.ones_like(depth_gt)
+        depth_t = torch.zeros_like(depth_gt)
+        rendered = torch.zeros_like(depth_gt, dtype=torch.bool)
+
+        probe = self._probe_pixels(mask > 0)
+        depth_t[probe] = yield from self._render_depth(j, probe)
+        rendered[probe] = True
+
+        if self.stride > 1:
+            # Densely render the cells with the highest probe errors
+            probe_diff = torch.pow(depth_t[probe] - depth_gt[probe], 2)
+            cells = self.cell_of[probe[torch.argsort(probe_diff, descending=True)]]
+            n_masked = torch.cumsum(torch.bincount(self.cell_of[mask > 0], minlength=self.n_cells)[cells], 0)
+            n_cells = int((n_masked < self.candidate_factor * self.quantile * H * W).sum()) + 1
+            cell_selected = torch.zeros(self.n_cells, dtype=torch.bool, device=cells.device)
+            cell_selected[cells[:n_cells]] = True
+            dense = torch.nonzero((mask > 0) & cell_selected[self.cell_of] & ~rendered)[:, 0]
+            depth_t[dense] = yield from self._render_depth(j, dense)
+            rendered[dense] = True
+
+        depth_diff = torch.pow(depth_t - depth_gt, 2) * mask * rendered  # [H x W]
+        quantile = torch.quantile(depth_diff, 1.0 - self.quantile)
+        depth_to_refine = depth_diff > quantile
+        depth_gt[depth_to_refine] = depth_t[depth_to_refine]
+        self.version += 1
+        return quantile, depth_diff, depth_to_refine, rendered
+
+    def _round(self, refinement_round, save_path):
+        H, W, _ = self.hwf
+        if save_path is not None:
+            depth_prev_save_path = os.path.join(save_path, 'depth_prev')
+            depth_refined_save_path = os.path.join(save_path, 'depth_refined')
+            os.makedirs(depth_prev_save_path, exist_ok=True)
+            os.makedirs(depth_refined_save_path, exist_ok=True)
+            self.writer.submit(write_depth_pngs, depth_prev_save_path, self.depth_maps[self.i_train].cpu().numpy(), self.i_train)
+
+        results = []
+        for j in self.i_train:
+            results.append((yield from self._refine_frame(j)))
+        quantile, depth_diff, depth_to_refine, rendered = [torch.stack(r, 0) for r in zip(*results)]
+        if save_path is None:
+            return
+
+        self.writer.submit(write_depth_pngs, depth_refined_save_path, self.depth_maps[self.i_train].cpu().numpy(), self.i_train)
+        save_dict = {
+            'rounds': refinement_round,
+            'quantile': quantile[:, None].cpu().numpy(),
+            'depth_diff': depth_diff.cpu().numpy(),
+            'depth_to_refine': depth_to_refine.reshape(-1, H, W).cpu().numpy(),
+            'rendered': rendered.reshape(-1, H, W).cpu().numpy(),
+        }
+        self.writer.submit(torch.save, save_dict, os.path.join(save_path, 'depth_refine_info.tar'))
+        print('\nRefinement finished, intermediate results saved at', save_path)
+
+
+class TrainStep:
+    """Ray batches of the training iterations in persistent buffers, refilled in place every
+    iteration. The pixel grid and the camera space ray directions of each image size are built
+    once and only the N_rand sampled rays are rotated to the pose of the frame. render() then
+    assembles the ray batch in a buffer too and, if the batch is rendered in a single chunk,
+    render_rays() draws its N_rand x (N_samples + N_importance) samples into the buffers of the
+    pool. All tensors returned are overwritten by the next iteration.
+
+    ray_importance_maps: per-frame pixel sampling weights, None to sample pixels uniformly.
+    loss_masks: per-frame masks returned with the rays, None if not needed.
+    depth_scale: the sampled depths are divided by it if not None.
+    """
+    def __init__(self, N_rand, images, poses, ray_importance_maps=None, depth_maps=None, loss_masks=None, depth_scale=None):
+        self.N_rand = N_rand
+        self.images = images
+        self.poses = poses
+        self.ray_importance_maps = ray_importance_maps
+        self.depth_maps = depth_maps
+        self.loss_masks = loss_masks
+        self.depth_scale = depth_scale
+        self.pool = BufferPool()
+        self._grids = {}
+
+    def _grid(self, H, W, focal, offset, crop):
+        """Camera space ray directions [H x W, 3] of the pixels of an image size and the
+        indices of the pixels of the central crop (dH, dW), None to sample the whole image."""
+        key = (H, W, focal, offset, crop)
+        if key not in self._grids:
+            _, dirs = get_rays(H, W, focal, torch.eye(4)[:3, :4], offset=offset)
+            pixel_inds = None
+            if crop is not None:
+                dH, dW = crop
+                rows = torch.arange(H//2 - dH, H//2 + dH)
+                cols = torch.arange(W//2 - dW, W//2 + dW)
+                pixel_inds = (rows[:, None] * W + cols[None, :]).reshape(-1)
+            self._grids[key] = (dirs.reshape(-1, 3), pixel_inds)
+        return self._grids[key]
+
+    def sample(self, img_i, H, W, focal, factor=1, crop=None):
+        """Samples the rays of training frame img_i at the image size H x W of the pyramid level
+        'factor', only from the central crop (dH, dW) if not None.
+        Returns batch_rays [2, N_rand, 3] and the colors [N_rand, 3], depths [N_rand] and masks
+        [N_rand, 1] of the rays, None for the maps that are not given.
+        """
+        N_rand = self.N_rand
+        dirs, pixel_inds = self._grid(H, W, focal, (factor - 1) / (2. * factor), crop)
+        n_pixels = dirs.shape[0] if pixel_inds is None else pixel_inds.shape[0]
+        if self.ray_importance_maps is None:
+            select_inds = torch.as_tensor(np.random.choice(n_pixels, size=[N_rand], replace=False)).to(dirs.device)
+        else:
+            importance = downsample(self.ray_importance_maps[img_i], factor).reshape(-1)
+            if pixel_inds is not None:
+                importance = importance[pixel_inds]
+            select_inds, _, _ = importance_sampling_coords(importance.unsqueeze(0), N_rand)
+            select_inds = torch.clamp(select_inds.squeeze(0), 0, n_pixels - 1)
+        if pixel_inds is not None:
+            select_inds = pixel_inds[select_inds]
+
+        # Rays through the selected pixels: the camera directions rotated by the pose
+        pose = self.poses[img_i, :3, :4]
+        batch_rays = self.pool.get('batch_rays', [2, N_rand, 3])
+        batch_rays[0] = pose[:, 3]
+        torch.matmul(torch.index_select(dirs, 0, select_inds, out=self.pool.get('dirs', [N_rand, 3])), pose[:, :3].t(), out=batch_rays[1])
+
+        target = downsample(self.images[img_i], factor).reshape(-1, 3)
+        target_s = torch.index_select(target, 0, select_inds, out=self.pool.get('target_s', [N_rand, 3]))
+        depth_s, mask_s = None, None
+        if self.depth_maps is not None:
+            depth_s = torch.index_select(downsample(self.depth_maps[img_i], factor).reshape(-1), 0, select_inds,
+                                         out=self.pool.get('depth_s', [N_rand]))
+            if self.depth_scale is not None:
+                depth_s.div_(self.depth_scale)
+        if self.loss_masks is not None:
+            mask_s = torch.index_select(downsample(self.loss_masks[img_i], factor).reshape(-1), 0, select_inds,
+                                        out=self.pool.get('mask_s', [N_rand]))[:, None]
+        return batch_rays, target_s, depth_s, mask_s
+
+    def render(self, H, W, focal, chunk, batch_rays, frame_time, render_kwargs, **kwargs):
+        """render() of batch_rays with the ray batch, and the samples if the rays fit in one
+        chunk, in the buffers of the pool."""
+        N_rays = batch_rays.shape[1]
+        rays_buffer = self.pool.get('rays', [N_rays, 12 if render_kwargs.get('use_viewdirs', False) else 9])
+        return render(H, W, focal, chunk=chunk, rays=batch_rays, frame_time=frame_time, rays_buffer=rays_buffer,
+                      buffers=self.pool if N_rays <= chunk else None, **kwargs, **render_kwargs)
+
+
+def create_nerf(args, training=True):
     """Instantiate NeRF's MLP model.
+    training: if False, only the network weights are loaded from the checkpoint, without the
+      optimizer state and the per-frame maps, as needed to render.
     """
     embed_fn, input_ch = get_embedder(args.multires, 3, args.i_embed)
     embedtime_fn, input_ch_time = get_embedder(args.multires, 1, args.i_embed)
@@ -292,29 +675,47 @@ def create_nerf(args):
                           zero_canonical=not args.not_zero_canonical, time_window_size=args.time_window_size, time_interval=args.time_interval).to(device)
         grad_vars += list(model_fine.parameters())
 
-    network_query_fn = lambda inputs, viewdirs, ts, network_fn : run_network(inputs, viewdirs, ts, network_fn,
+    if args.compile != 'none':
+        for m in [model, model_fine]:
+            if m is not None:
+                method = compile_forward(m, args.compile, args.compile_mode)
+        print("Networks compiled with", method)
+
+    autocast_dtype = None
+    if args.do_half_precision:
+        autocast_dtype = get_autocast_dtype(args.half_precision_dtype, device.type)
+        print("Run model at half precision:", autocast_dtype)
+
+    network_query_fn = lambda inputs, viewdirs, ts, network_fn, **kwargs : run_network(inputs, viewdirs, ts, network_fn,
                                                                 embed_fn=embed_fn,
                                                                 embeddirs_fn=embeddirs_fn,
                                                                 embedtime_fn=embedtime_fn,
                                                                 netchunk=args.netchunk,
-                                                                embd_time_discr=args.nerf_type!="temporal")
+                                                                embd_time_discr=args.nerf_type!="temporal",
+                                                                autocast_dtype=autocast_dtype, **kwargs)
+
+    occupancy_grid = None
+    if args.occupancy_grid:
+        if args.nerf_type == 'tnerf':
+            raise ValueError("occupancy_grid needs a canonical space, not available for tnerf")
+        occupancy_grid = OccupancyGrid(args.occ_grid_bbox[:3], args.occ_grid_bbox[3:], resolution=args.occ_grid_resolution,
+                                       alpha_thresh=args.occ_grid_alpha_thresh).to(device)
 
     # Create optimizer
     optimizer = torch.optim.Adam(params=grad_vars, lr=args.lrate, betas=(0.9, 0.999))
 
-    if args.do_half_precision:
-        print("Run model at half precision")
-        if model_fine is not None:
-            [model, model_fine], optimizers = amp.initialize([model, model_fine], optimizer, opt_level='O1')
-        else:
-            model, optimizers = amp.initialize(model, optimizer, opt_level='O1')
-
     # Extras
     extras = {
         'depth_maps': None,
-        'ray_importance_maps': None
+        'ray_importance_maps': None,
+        'grad_scaler': None,
+        'embedder': getattr(embed_fn, '__self__', None),
     }
 
+    # Loss scaling is only needed for float16, bfloat16 has the range of float32
+    if autocast_dtype == torch.float16:
+        extras['grad_scaler'] = create_grad_scaler()
+
     start = 0
     basedir = args.basedir
     expname = args.expname
@@ -325,29 +726,40 @@ def create_nerf(args):
     if args.ft_path is not None and args.ft_path!='None':
         ckpts = [args.ft_path]
     else:
-        ckpts = [os.path.join(basedir, expname, f) for f in sorted(os.listdir(os.path.join(basedir, expname))) if 'tar' in f]
+        index = CheckpointWriter.read_index(os.path.join(basedir, expname))
+        if index is not None and os.path.exists(os.path.join(basedir, expname, index['latest'])):
+            ckpts = [os.path.join(basedir, expname, e['file']) for e in index['checkpoints']]
+        else:
+            ckpts = [os.path.join(basedir, expname, f) for f in sorted(os.listdir(os.path.join(basedir, expname))) if f.endswith('.tar')]
 
     print('Found ckpts', ckpts)
     if len(ckpts) > 0 and not args.no_reload:
         ckpt_path = ckpts[-1]
         print('Reloading from', ckpt_path)
-        ckpt = torch.load(ckpt_path)
+        keys = ['global_step', 'network_fn_state_dict', 'network_fine_state_dict', 'occupancy_grid']
+        if training:
+            keys += ['optimizer_state_dict', 'grad_scaler', 'maps', 'depth_maps', 'ray_importance_maps']
+        ckpt = load_checkpoint(ckpt_path, keys)
 
         start = ckpt['global_step'] + 1
-        optimizer.load_state_dict(ckpt['optimizer_state_dict'])
+        if 'optimizer_state_dict' in ckpt:
+            optimizer.load_state_dict(ckpt['optimizer_state_dict'])
 
         # Load model
         model.load_state_dict(ckpt['network_fn_state_dict'])
         if model_fine is not None:
             model_fine.load_state_dict(ckpt['network_fine_state_dict'])
-        if args.do_half_precision:
-            amp.load_state_dict(ckpt['amp'])
+        if extras['grad_scaler'] is not None and 'grad_scaler' in ckpt:
+            extras['grad_scaler'].load_state_dict(ckpt['grad_scaler'])
 
-        # Load extras
-        if 'depth_maps' in ckpt:
-            extras['depth_maps'] = ckpt['depth_maps']
-        if 'ray_importance_maps' in ckpt:
-            extras['ray_importance_maps'] = ckpt['ray_importance_maps']
+        # Load extras, large maps are stored in files next to the checkpoint
+        for name in ['depth_maps', 'ray_importance_maps']:
+            if name in ckpt.get('maps', {}):
+                extras[name] = np.load(os.path.join(os.path.dirname(ckpt_path), ckpt['maps'][name]))['arr']
+            elif name in ckpt:
+                extras[name] = ckpt[name]
+        if occupancy_grid is not None and 'occupancy_grid' in ckpt:
+            occupancy_grid.load_state_dict(ckpt['occupancy_grid'])
 
 
     ##########################
@@ -358,11 +770,13 @@ def create_nerf(args):
         'N_importance' : args.N_importance,
         'network_fine': model_fine,
         'N_samples' : args.N_samples,
+        'compositor' : get_compositor(args.volumetric_function),
         'network_fn' : model,
         'use_viewdirs' : args.use_viewdirs,
         'white_bkgd' : args.white_bkgd,
         'raw_noise_std' : args.raw_noise_std,
         'use_two_models_for_fine' : args.use_two_models_for_fine,
+        'occupancy_grid' : occupancy_grid,
     }
 
     # NDC only good for LLFF-style forward facing data
@@ -373,19 +787,229 @@ def create_nerf(args):
     render_kwargs_test = {k : render_kwargs_train[k] for k in render_kwargs_train}
     render_kwargs_test['perturb'] = False
     render_kwargs_test['raw_noise_std'] = 0.
+    render_kwargs_test['termination_thresh'] = args.termination_thresh
+    render_kwargs_test['march_chunk'] = args.march_chunk
 
     if args.use_depth and not args.no_depth_sampling:
         render_kwargs_train['use_depth'] = True
 
+    if args.autotune_chunks:
+        args.chunk, args.netchunk = autotune_chunks(args, render_kwargs_test)
+
     return render_kwargs_train, render_kwargs_test, start, grad_vars, optimizer, extras
 
 
-def raw2outputs(raw, z_vals, rays_d, raw_noise_std=0, white_bkgd=False, pytest=False, volumetric_function="exp"):
+def chunk_autotune_key(args):
+    """Cache key of the model config and device the chunk sizes are tuned for."""
+    config = {k: getattr(args, k, None) for k in [
+        'nerf_type', 'netdepth', 'netwidth', 'netdepth_fine', 'netwidth_fine', 'use_two_models_for_fine',
+        'N_samples', 'N_importance', 'multires', 'multires_views', 'use_viewdirs', 'time_window_size',
+        'do_half_precision', 'half_precision_dtype', 'occupancy_grid', 'termination_thresh', 'volumetric_function']}
+    if device.type == 'cuda':
+        config['device'] = torch.cuda.get_device_name(device)
+    else:
+        config['device'] = 'cpu_%d_threads' % torch.get_num_threads()
+    config['torch'] = torch.__version__
+    return hashlib.sha1(json.dumps(config, sort_keys=True).encode()).hexdigest(), config
+
+
+def probe_chunk_sizes(fn, sizes, mem_budget, n_repeat=2, min_gain=1.05, patience=2):
+    """Runs fn(size) for increasing sizes and measures throughput (items/s) and peak memory.
+    Stops at the first size over mem_budget bytes, or once throughput did not improve by
+    min_gain for 'patience' sizes in a row.
+    """
+    results = []
+    best, stale = 0., 0
+    for size in sizes:
+        with PeakMemoryMeter(device) as meter:
+            fn(size)  # warmup
+            times = []
+            for _ in range(n_repeat):
+                t0 = time.time()
+                fn(size)
+                if device.type == 'cuda':
+                    torch.cuda.synchronize(device)
+                times.append(time.time() - t0)
+        if meter.peak > mem_budget:
+            print('  {:>8d}: {:.1f} MB over budget'.format(size, meter.peak / 2**20))
+            break
+        throughput = size / min(times)
+        results.append({'size': size, 'throughput': throughput, 'peak_memory': meter.peak})
+        print('  {:>8d}: {:12.0f} /s  {:8.1f} MB'.format(size, throughput, meter.peak / 2**20))
+
+        stale = stale + 1 if throughput < best * min_gain else 0
+        best = max(best, throughput)
+        if stale >= patience:
+            break
+    return results
+
+
+def select_chunk_size(results, tolerance=0.95):
+    """Smallest size within tolerance of the best throughput, it needs the least memory."""
+    best = max(r['throughput'] for r in results)
+    return min(r['size'] for r in results if r['throughput'] >= tolerance * best)
+
+
+def autotune_chunks(args, render_kwargs):
+    """Picks args.netchunk and args.chunk for this model and device by probing the network
+    and render_rays at test time (no gradients) with increasing sizes. The result is cached
+    in args.autotune_cache (default <basedir>/chunk_autotune.json) per model config and device.
+    Returns (chunk, netchunk).
+    """
+    cache_path = args.autotune_cache or os.path.join(args.basedir, 'chunk_autotune.json')
+    key, config = chunk_autotune_key(args)
+    cache = {}
+    if os.path.exists(cache_path):
+        with open(cache_path) as f:
+            cache = json.load(f)
+    if key in cache:
+        print('Chunk sizes from', cache_path, ': chunk', cache[key]['chunk'], 'netchunk', cache[key]['netchunk'])
+        return cache[key]['chunk'], cache[key]['netchunk']
+
+    mem_budget = args.autotune_mem_budget * 2**20 if args.autotune_mem_budget > 0 else 0.8 * available_memory(device)
+    print('Autotuning chunk sizes on {} with a memory budget of {:.0f} MB'.format(config['device'], mem_budget / 2**20))
+    network_query_fn, network_fn = render_kwargs['network_query_fn'], render_kwargs['network_fn']
+    netchunk = args.netchunk
+
+    def query(n_pts):
+        args.netchunk = n_pts
+        pts = torch.rand(n_pts, 1, 3) * 2. - 1.
+        viewdirs = F.normalize(torch.rand(n_pts, 3) - 0.5, dim=-1)
+        network_query_fn(pts, viewdirs, 0.5 * torch.ones(n_pts, 1), network_fn)
+
+    render_kwargs = {k: v for k, v in render_kwargs.items() if k not in ['use_viewdirs', 'ndc', 'near', 'far']}
+
+    def render_chunk(n_rays):
+        # rays through the NDC cube, near and far in NDC are 0 and 1
+        rays_o = torch.cat([torch.rand(n_rays, 2) * 2. - 1., -torch.ones(n_rays, 1)], -1)
+        rays_d = torch.cat([(torch.rand(n_rays, 2) - 0.5) * 0.2, 2. * torch.ones(n_rays, 1)], -1)
+        rays = torch.cat([rays_o, rays_d, torch.zeros(n_rays, 1), torch.ones(n_rays, 1), 0.5 * torch.ones(n_rays, 1)], -1)
+        if args.use_viewdirs:
+            rays = torch.cat([rays, F.normalize(rays_d, dim=-1)], -1)
+        batchify_rays(rays, n_rays, **render_kwargs)
+
+    try:
+        with torch.no_grad():
+            print('netchunk (points):')
+            net_results = probe_chunk_sizes(query, [2**k for k in range(12, 23)], mem_budget)
+            netchunk = select_chunk_size(net_results)
+            args.netchunk = netchunk
+            print('chunk (rays):')
+            ray_results = probe_chunk_sizes(render_chunk, [2**k for k in range(8, 18)], mem_budget)
+            chunk = select_chunk_size(ray_results)
+    finally:
+        args.netchunk = netchunk
+
+    print('Selected chunk', chunk, 'netchunk', netchunk)
+    if os.path.exists(cache_path):
+        with open(cache_path) as f:
+            cache = json.load(f)
+    cache[key] = {'chunk': chunk, 'netchunk': netchunk, 'config': config,
+                  'netchunk_probes': net_results, 'chunk_probes': ray_results}
+    os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+    with open(cache_path, 'w') as f:
+        json.dump(cache, f, indent=2)
+    return chunk, netchunk
+
+
+# exp() of large negative arguments leaves the vectorized fast path on CPU, transmittances
+# below exp(LOG_TRANSMITTANCE_MIN) are clamped as they do not contribute to any map.
+LOG_TRANSMITTANCE_MIN = -80.
+
+
+class Compositor:
+    """Alpha compositing for one volumetric function.
+    alpha_fn maps the optical depth relu(sigma) * dist of each sample to its alpha.
+    Where log(1 - alpha) has a closed form log_transmittance_fn, transmittance is accumulated
+    as an exclusive cumulative sum in log space, otherwise as an exclusive cumulative product.
+    local: alpha only depends on the sample itself (required for ray marching).
+    signed: 1 - alpha can be negative (not supported by ray marching).
+    """
+    def __init__(self, alpha_fn, log_transmittance_fn=None, local=True, signed=False):
+        self.alpha_fn = alpha_fn
+        self.log_transmittance_fn = log_transmittance_fn
+        self.local = local
+        self.signed = signed
+
+    def alpha(self, optical_depth):
+        return self.alpha_fn(optical_depth)
+
+    def log_transmittance(self, optical_depth, alpha):
+        if self.log_transmittance_fn is not None:
+            return self.log_transmittance_fn(optical_depth)
+        return torch.log(torch.abs(1. - alpha + 1e-10))
+
+    def transmittance(self, optical_depth, alpha):
+        """Exclusive transmittance prod_{j<i} (1 - alpha_j), the last sample never enters it."""
+        if self.log_transmittance_fn is None:
+            return F.pad(torch.cumprod(1. - alpha[...,:-1] + 1e-10, -1), (1, 0), value=1.)
+        log_transmittance = torch.cumsum(self.log_transmittance_fn(optical_depth[...,:-1]), -1)
+        return torch.exp(F.pad(torch.clamp(log_transmittance, min=LOG_TRANSMITTANCE_MIN), (1, 0)))
+
+    def __call__(self, raw, z_vals, rays_d, raw_noise_std=0, white_bkgd=False, pytest=False, outputs=None):
+        """See raw2outputs."""
+        ray_norm = torch.norm(rays_d, dim=-1, keepdim=True)  # [N_rays, 1]
+        dists = F.pad(z_vals[...,1:] - z_vals[...,:-1], (0, 1), value=1e10)  # [N_rays, N_samples]
+
+        noise = 0.
+        if raw_noise_std > 0.:
+            noise = torch.randn(raw[...,3].shape) * raw_noise_std
+
+            # Overwrite randomly sampled data if pytest
+            if pytest:
+                np.random.seed(0)
+                noise = np.random.rand(*list(raw[...,3].shape)) * raw_noise_std
+                noise = torch.Tensor(noise)
+
+        optical_depth = F.relu(raw[...,3] + noise) * dists * ray_norm
+        alpha = self.alpha(optical_depth)  # [N_rays, N_samples]
+
+        weights = alpha * self.transmittance(optical_depth, alpha)
+
+        rgb_map, disp_map, acc_map, depth_map = None, None, None, None
+        if outputs is None or 'rgb_map' in outputs:
+            rgb_map = torch.sum(weights[...,None] * torch.sigmoid(raw[...,:3]), -2)  # [N_rays, 3]
+        if outputs is None or 'acc_map' in outputs or 'disp_map' in outputs or white_bkgd:
+            acc_map = torch.sum(weights, -1)
+        if outputs is None or 'depth_map' in outputs or 'disp_map' in outputs:
+            depth_map = torch.sum(weights * z_vals, -1) * ray_norm[...,0]
+        if outputs is None or 'disp_map' in outputs:
+            disp_map = 1./torch.clamp(depth_map / (acc_map + 1e-6), min=1e-10)
+
+        if white_bkgd and rgb_map is not None:
+            rgb_map = rgb_map + (1.-acc_map[...,None])
+        return rgb_map, disp_map, acc_map, weights, depth_map
+
+
+COMPOSITORS = {
+    "exp": Compositor(lambda x: 1.-torch.exp(-torch.clamp(x, max=-LOG_TRANSMITTANCE_MIN)),
+                      log_transmittance_fn=lambda x: -x),  ##equation 3
+    "weighted_gaussian": Compositor(lambda x: 1.-torch.exp(-((-x)-torch.mean(-x))**2/(2*torch.std(-x)**2)), local=False),
+    "gaussian": Compositor(lambda x: 1.-torch.exp(-torch.clamp(torch.square(x), max=-LOG_TRANSMITTANCE_MIN)),
+                           log_transmittance_fn=lambda x: -torch.square(x)),
+    "sqaure": Compositor(lambda x: 1.-torch.square(x)),
+    "tan": Compositor(lambda x: 1.-torch.tan(-x), signed=True),
+    "tan_h": Compositor(lambda x: 1.-torch.tanh(-x), signed=True),
+    "tan_pi": Compositor(lambda x: 1.-torch.tan(-x * (math.pi/2)), signed=True),
+}
+
+
+def get_compositor(volumetric_function):
+    if volumetric_function not in COMPOSITORS:
+        raise ValueError("Volumetric function %s not recognized." % volumetric_function)
+    return COMPOSITORS[volumetric_function]
+
+
+@profiled('raw2outputs')
+def raw2outputs(raw, z_vals, rays_d, raw_noise_std=0, white_bkgd=False, pytest=False, compositor=None, outputs=None):
     """Transforms model's predictions to semantically meaningful values.
     Args:
         raw: [num_rays, num_samples along ray, 4]. Prediction from model.
         z_vals: [num_rays, num_samples along ray]. Integration time.
         rays_d: [num_rays, 3]. Direction of each ray.
+        compositor: Compositor of the volumetric function, see COMPOSITORS. Defaults to "exp".
+        outputs: collection of map names to compute, None for all. Maps that are
+          not requested are returned as None; weights are always returned.
     Returns:
         rgb_map: [num_rays, 3]. Estimated RGB color of a ray.
         disp_map: [num_rays]. Disparity map. Inverse of depth map.
@@ -393,60 +1017,110 @@ def raw2outputs(raw, z_vals, rays_d, raw_noise_std=0, white_bkgd=False, pytest=F
         weights: [num_rays, num_samples]. Weights assigned to each sampled color.
         depth_map: [num_rays]. Estimated distance to object.
     """
-    
-  
-
-    dists = z_vals[...,1:] - z_vals[...,:-1]
-    dists = torch.cat([dists, torch.Tensor([1e10]).expand(dists[...,:1].shape)], -1)  #[N_rays, N_samples]
-
-    dists = dists * torch.norm(rays_d[...,None,:], dim=-1)
-
-
-    if volumetric_function=="exp":
-        raw2alpha = lambda raw, dists, act_fn=F.relu: 1.-torch.exp(-act_fn(raw)*dists)  ##equation 3
-    elif volumetric_function=="weighted_gaussian":
-        raw2alpha= lambda raw, dists, act_fn=F.relu: 1.-torch.exp(-((-act_fn(raw)*dists)-torch.mean((-act_fn(raw)*dists)))**2/(2*torch.std((-act_fn(raw)*dists))**2))
-    elif volumetric_function =="gaussian":
-        raw2alpha= lambda raw, dists, act_fn=F.relu: 1.-torch.exp(-torch.square(-act_fn(raw)*dists))
-    elif volumetric_function=="sqaure":    
-        raw2alpha = lambda raw, dists, act_fn=F.relu: 1.-torch.square(-act_fn(raw)*dists)
-    elif volumetric_function=="tan":
-        raw2alpha= lambda raw, dists, act_fn=F.relu: 1.-torch.tan(-act_fn(raw)*dists)
-    elif volumetric_function=="tan_h":
-        raw2alpha= lambda raw, dists, act_fn=F.relu: 1.-torch.tanh(-act_fn(raw)*dists)
-    elif volumetric_function=="tan_pi":
-        raw2alpha =lambda raw, dists, act_fn=F.relu: 1.-torch.tan(-act_fn(raw)*dists * torch.tensor(math.pi/2))
-
-    rgb = torch.sigmoid(raw[...,:3])  # [N_rays, N_samples, 3]
-    noise = 0.
-    if raw_noise_std > 0.:
-        noise = torch.randn(raw[...,3].shape) * raw_noise_std
-
-        # Overwrite randomly sampled data if pytest
-        if pytest:
-            np.random.seed(0)
-            noise = np.random.rand(*list(raw[...,3].shape)) * raw_noise_std
-            noise = torch.Tensor(noise)
-
-    alpha = raw2alpha(raw[...,3] + noise, dists)  # [N_rays, N_samples]
-    ##equation 3
-    weights = alpha * torch.cumprod(torch.cat([torch.ones((alpha.shape[0], 1)), 1.-alpha + 1e-10], -1), -1)[:, :-1]
-    rgb_map = torch.sum(weights[...,None] * rgb, -2)  # [N_rays, 3]
-
-    depth_map = torch.sum(weights * z_vals * torch.norm(rays_d[...,None,:], dim=-1), -1)
-    disp_map = 1./torch.max(1e-10 * torch.ones_like(depth_map), depth_map / (torch.sum(weights, -1)  + 1e-6))
+    if compositor is None:
+        compositor = COMPOSITORS["exp"]
+    return compositor(raw, z_vals, rays_d, raw_noise_std, white_bkgd, pytest=pytest, outputs=outputs)
+
+
+@profiled('march_rays')
+def march_rays(rays_o, rays_d, viewdirs, frame_time, z_vals, network_fn, network_query_fn, compositor,
+               white_bkgd=False, termination_thresh=1e-4, march_chunk=8, occupancy_grid=None):
+    """Inference-only alternative to querying all samples and calling raw2outputs.
+    Samples are evaluated in depth-ordered chunks of 'march_chunk' per ray and rays whose
+    transmittance drops below 'termination_thresh' are removed from the active set.
+    Requires a local, unsigned compositor.
+    Returns the same maps as raw2outputs, with zero weights for the skipped samples, plus
+    position_delta and the number of evaluated samples per ray.
+    """
+    N_rays, N_samples = z_vals.shape
+    ray_norm = torch.norm(rays_d, dim=-1, keepdim=True)
+    dists = F.pad(z_vals[...,1:] - z_vals[...,:-1], (0, 1), value=1e10) * ray_norm  #[N_rays, N_samples]
+    log_thresh = math.log(termination_thresh)
+
+    weights = torch.zeros_like(z_vals)
+    position_delta = torch.zeros(N_rays, N_samples, 3)
+    rgb_map = torch.zeros(N_rays, 3)
+    log_transmittance = torch.zeros(N_rays)
+    n_evaluated = torch.zeros(N_rays)
+    active = torch.arange(N_rays)
+
+    for i in range(0, N_samples, march_chunk):
+        z_chunk = z_vals[active, i:i+march_chunk]
+        pts = rays_o[active,None,:] + rays_d[active,None,:] * z_chunk[...,:,None]
+        raw, dx, n = run_network_occupied(network_query_fn, pts, viewdirs[active] if viewdirs is not None else None,
+                                          frame_time[active], network_fn, occupancy_grid)
+        n_evaluated[active] += n if n is not None else z_chunk.shape[-1]
+
+        optical_depth = F.relu(raw[...,3]) * dists[active, i:i+march_chunk]
+        alpha = compositor.alpha(optical_depth)
+        log_t = torch.cumsum(compositor.log_transmittance(optical_depth, alpha), -1)
+        w = alpha * torch.exp(torch.clamp(F.pad(log_t[:, :-1], (1, 0)) + log_transmittance[active,None], min=LOG_TRANSMITTANCE_MIN))
+        weights[active, i:i+march_chunk] = w
+        position_delta[active, i:i+march_chunk] = dx
+        rgb_map[active] += torch.einsum('...n,...nc->...c', w, torch.sigmoid(raw[...,:3]))
+        log_transmittance[active] = log_transmittance[active] + log_t[:, -1]
+
+        # compact the active set
+        active = active[log_transmittance[active] > log_thresh]
+        if active.shape[0] == 0:
+            break
+
+    depth_map = torch.sum(weights * z_vals, -1) * ray_norm[...,0]
     acc_map = torch.sum(weights, -1)
+    disp_map = 1./torch.clamp(depth_map / (acc_map + 1e-6), min=1e-10)
 
     if white_bkgd:
         rgb_map = rgb_map + (1.-acc_map[...,None])
-    return rgb_map, disp_map, acc_map, weights, depth_map
+    return rgb_map, disp_map, acc_map, weights, depth_map, position_delta, n_evaluated
+
+
+@profiled('render_baked_rays')
+def render_baked_rays(baked, rays_o, rays_d, viewdirs, near, far, frame_time, N_samples, lindisp=False,
+                      compositor=None, white_bkgd=False, outputs=None):
+    """Renders a BakedGrid in a single uniform pass of 'N_samples' per ray, in place of the
+    coarse and importance passes of render_rays. The deformation is interpolated at every
+    sample, colour and density only at samples with an occupied corner.
+    Returns the render_rays outputs in 'outputs' (None for all), samples_per_ray counts the
+    occupied samples.
+    """
+    assert len(torch.unique(frame_time)) == 1, "Only accepts all rays from same time"
+    N_rays = rays_o.shape[0]
+    t_vals = torch.linspace(0., 1., steps=N_samples)
+    if not lindisp:
+        z_vals = near * (1.-t_vals) + far * (t_vals)
+    else:
+        z_vals = 1./(1./near * (1.-t_vals) + 1./far * (t_vals))
+    z_vals = z_vals.expand([N_rays, N_samples])
+
+    pts = rays_o[...,None,:] + rays_d[...,None,:] * z_vals[...,:,None]
+    dirs = viewdirs[:,None].expand(pts.shape).reshape(-1, 3) if viewdirs is not None else None
+    with stage_timer.stage('baked_query', pts=pts.shape):
+        raw, occupied = baked.query_occupied(pts.reshape(-1, 3), dirs, frame_time.reshape(-1)[0])
+    raw = raw.reshape(N_rays, N_samples, 4)
+    occupied = occupied.reshape(N_rays, N_samples)
+    if stage_timer.enabled:
+        stage_timer.count('network_evals', occupied.sum())
+
+    want = lambda k: outputs is None or k in outputs
+    with stage_timer.stage('raw2outputs', raw=raw.shape):
+        rgb_map, disp_map, acc_map, _, _ = raw2outputs(raw, z_vals, rays_d, white_bkgd=white_bkgd, compositor=compositor,
+                                                       outputs=[k for k in ['rgb_map', 'disp_map', 'acc_map'] if want(k)])
+    ret = {'rgb_map' : rgb_map, 'disp_map' : disp_map, 'acc_map' : acc_map, 'z_vals' : z_vals,
+           'samples_per_ray' : occupied.sum(-1).float()}
+    ret = {k : ret[k] for k in ret if want(k) and ret[k] is not None}
+    if outputs is not None and 'raw' in outputs:
+        ret['raw'] = raw
+    if outputs is not None and 'pts' in outputs:
+        ret['pts'] = pts
+    return ret
 
 
+@profiled('render_rays')
 def render_rays(ray_batch,
                 network_fn,
                 network_query_fn,
                 N_samples,
-                volumetric_function,
+                compositor=None,
                 retraw=False,
                 lindisp=False,
                 perturb=0.,
@@ -458,7 +1132,13 @@ def render_rays(ray_batch,
                 pytest=False,
                 z_vals=None,
                 use_two_models_for_fine=False,
-                use_depth=False):
+                use_depth=False,
+                occupancy_grid=None,
+                termination_thresh=0.,
+                march_chunk=8,
+                outputs=None,
+                buffers=None,
+                baked=None):
     """Volumetric rendering.
     Args:
       ray_batch: array of shape [batch_size, ...]. All information necessary
@@ -468,6 +1148,8 @@ def render_rays(ray_batch,
         in space.
       network_query_fn: function used for passing queries to network_fn.
       N_samples: int. Number of different times to sample along each ray.
+      compositor: Compositor used to turn raw predictions into maps, see COMPOSITORS.
+        Defaults to "exp".
       retraw: bool. If True, include model's raw, unprocessed predictions.
       lindisp: bool. If True, sample linearly in inverse depth rather than in depth.
       perturb: float, 0 or 1. If non-zero, each ray is sampled at stratified
@@ -478,18 +1160,40 @@ def render_rays(ray_batch,
       white_bkgd: bool. If True, assume a white background.
       raw_noise_std: ...
       verbose: bool. If True, print more debugging info.
+      occupancy_grid: OccupancyGrid. If not None, samples in empty cells are not
+        passed to the networks.
+      termination_thresh: float. If > 0, rays are marched in chunks of march_chunk
+        samples and terminated once their transmittance drops below this value.
+        Only used when gradients are disabled.
+      outputs: collection of the keys below to return, None for all of them (raw
+        only if retraw, pts and pts_0 only on request). Maps that are not requested
+        are not computed.
+      buffers: BufferPool. If not None, the sample depths and positions are drawn
+        into its buffers, for a single call per training step. The returned z_vals
+        are one of them.
+      baked: BakedGrid. If not None, rendered instead of the networks in a single
+        uniform pass of N_samples + N_importance samples, see render_baked_rays.
     Returns:
       rgb_map: [num_rays, 3]. Estimated RGB color of a ray. Comes from fine model.
       disp_map: [num_rays]. Disparity map. 1 / depth.
       acc_map: [num_rays]. Accumulated opacity along each ray. Comes from fine model.
+      z_vals: [num_rays, num_samples]. Sample distances along each ray.
+      position_delta: [num_rays, num_samples, 3]. Deformation of each sample.
+      pts: [num_rays, num_samples, 3]. Sample positions of position_delta.
       raw: [num_rays, num_samples, 4]. Raw predictions from model.
       rgb0: See rgb_map. Output for coarse model.
       disp0: See disp_map. Output for coarse model.
       acc0: See acc_map. Output for coarse model.
+      position_delta_0: See position_delta. Output for coarse model.
+      pts_0: See pts. Output for coarse model.
       z_std: [num_rays]. Standard deviation of distances along ray for each
         sample.
+      samples_per_ray: [num_rays]. Number of network evaluations per ray, only
+        if occupancy_grid is not None or rays are marched.
     """
 
+    if compositor is None:
+        compositor = COMPOSITORS["exp"]
     N_rays = ray_batch.shape[0]
     rays_o, rays_d = ray_batch[:,0:3], ray_batch[:,3:6] # [N_rays, 3] each
     viewdirs = ray_batch[:,-3:] if ray_batch.shape[-1] > 9 else None
@@ -497,6 +1201,45 @@ def render_rays(ray_batch,
     near, far, frame_time = bounds[...,0], bounds[...,1], bounds[...,2] # [-1,1]
     z_samples = None
     rgb_map_0, disp_map_0, acc_map_0, position_delta_0 = None, None, None, None
+    raw_coarse, position_delta_coarse, z_vals_0 = None, None, None
+    rgb_map, disp_map, acc_map = None, None, None
+    composited = False
+    samples_per_ray = []
+    march = termination_thresh > 0. and not torch.is_grad_enabled() and compositor.local and not compositor.signed
+
+    if baked is not None:
+        return render_baked_rays(baked, rays_o, rays_d, viewdirs, near, far, frame_time, N_samples + max(N_importance, 0),
+                                 lindisp, compositor, white_bkgd, outputs)
+
+    want = lambda k: outputs is None or k in outputs
+    buffer = lambda name, shape: buffers.get(name, shape) if buffers is not None else None
+
+    def sort(z_vals, name):
+        if buffers is None:
+            return torch.sort(z_vals, -1)
+        return torch.sort(z_vals, -1, out=(buffers.get(name, z_vals.shape), buffers.get(name + '_order', z_vals.shape, torch.long)))
+
+    def sample_points(z_vals, name):
+        pts = torch.mul(rays_d[...,None,:], z_vals[...,:,None], out=buffer(name, list(z_vals.shape) + [3]))
+        return pts.add_(rays_o[...,None,:])  # [N_rays, N_samples, 3]
+
+    final_maps = [k for k in ['rgb_map', 'disp_map', 'acc_map'] if want(k)]
+    coarse_maps = [k for k, k0 in [('rgb_map', 'rgb0'), ('disp_map', 'disp0'), ('acc_map', 'acc0')] if want(k0)]
+
+    def query_and_composite(z_vals, fn, maps, stage):
+        if march:
+            with stage_timer.stage(stage + '_march', z_vals=z_vals.shape):
+                rgb_map, disp_map, acc_map, weights, depth_map, position_delta, n_evaluated = march_rays(
+                    rays_o, rays_d, viewdirs, frame_time, z_vals, fn, network_query_fn, compositor,
+                    white_bkgd, termination_thresh, march_chunk, occupancy_grid)
+            return None, position_delta, n_evaluated, rgb_map, disp_map, acc_map, weights, depth_map
+
+        pts = sample_points(z_vals, 'pts_' + stage)
+        with stage_timer.stage(stage + '_network', pts=pts.shape):
+            raw, position_delta, n_evaluated = run_network_occupied(network_query_fn, pts, viewdirs, frame_time, fn, occupancy_grid)
+        with stage_timer.stage('raw2outputs', raw=raw.shape):
+            return (raw, position_delta, n_evaluated) + raw2outputs(raw, z_vals, rays_d, raw_noise_std, white_bkgd, pytest=pytest,
+                                                                    compositor=compositor, outputs=maps)
 
     if z_vals is None:
         if not use_depth:
@@ -510,15 +1253,15 @@ def render_rays(ray_batch,
         else:
             mean = near.expand([N_rays, N_samples])
             std = far.expand([N_rays, N_samples])
-            z_vals, _ = torch.sort(torch.normal(mean, std), dim=1)
+            z_vals, _ = sort(torch.normal(mean, std, out=buffer('z_normal', [N_rays, N_samples])), 'z_vals')
 
         if perturb > 0.:
             # get intervals between samples
-            mids = .5 * (z_vals[...,1:] + z_vals[...,:-1])
-            upper = torch.cat([mids, z_vals[...,-1:]], -1)
-            lower = torch.cat([z_vals[...,:1], mids], -1)
+            mids = torch.add(z_vals[...,1:], z_vals[...,:-1], out=buffer('mids', [N_rays, N_samples - 1])).mul_(.5)
+            upper = torch.cat([mids, z_vals[...,-1:]], -1, out=buffer('upper', [N_rays, N_samples]))
+            lower = torch.cat([z_vals[...,:1], mids], -1, out=buffer('lower', [N_rays, N_samples]))
             # stratified samples in those intervals
-            t_rand = torch.rand(z_vals.shape)
+            t_rand = torch.rand(z_vals.shape, out=buffer('t_rand', [N_rays, N_samples]))
 
             # Pytest, overwrite u with numpy's fixed random numbers
             if pytest:
@@ -526,9 +1269,7 @@ def render_rays(ray_batch,
                 t_rand = np.random.rand(*list(z_vals.shape))
                 t_rand = torch.Tensor(t_rand)
 
-            z_vals = lower + (upper - lower) * t_rand
-
-        pts = rays_o[...,None,:] + rays_d[...,None,:] * z_vals[...,:,None] # [N_rays, N_samples, 3]
+            z_vals = torch.add(lower, upper.sub_(lower).mul_(t_rand), out=buffer('z_vals_perturbed', [N_rays, N_samples]))
 
 
         # if (torch.isnan(pts).any() or torch.isinf(pts).any()) and DEBUG:
@@ -545,35 +1286,67 @@ def render_rays(ray_batch,
 
 
         if N_importance <= 0:
-            raw, position_delta = network_query_fn(pts, viewdirs, frame_time, network_fn)
-            rgb_map, disp_map, acc_map, weights, depth_map = raw2outputs(raw, z_vals, rays_d, raw_noise_std, white_bkgd, pytest=pytest, volumetric_function=volumetric_function)
+            # no fine pass, the coarse outputs are final
+            raw, position_delta, n_evaluated, rgb_map, disp_map, acc_map, weights, depth_map = query_and_composite(z_vals, network_fn, final_maps, 'coarse')
+            samples_per_ray.append(n_evaluated)
+            composited = True
 
         else:
             if use_two_models_for_fine:
-                raw, position_delta_0 = network_query_fn(pts, viewdirs, frame_time, network_fn)
-                rgb_map_0, disp_map_0, acc_map_0, weights, _ = raw2outputs(raw, z_vals, rays_d, raw_noise_std, white_bkgd, pytest=pytest, volumetric_function=volumetric_function)
+                raw, position_delta_0, n_evaluated, rgb_map_0, disp_map_0, acc_map_0, weights, _ = query_and_composite(z_vals, network_fn, coarse_maps, 'coarse')
+                z_vals_0 = z_vals
+
+            elif march or network_fine is not None:
+                raw, _, n_evaluated, _, _, _, weights, _ = query_and_composite(z_vals, network_fn, (), 'coarse')
 
             else:
-                with torch.no_grad():
-                    raw, _ = network_query_fn(pts, viewdirs, frame_time, network_fn)
-                    _, _, _, weights, _ = raw2outputs(raw, z_vals, rays_d, raw_noise_std, white_bkgd, pytest=pytest, volumetric_function=volumetric_function)
+                # Keep the coarse outputs (with gradients) for the fine pass, which then
+                # only has to evaluate the importance samples
+                pts = sample_points(z_vals, 'pts_coarse')
+                with stage_timer.stage('coarse_network', pts=pts.shape):
+                    raw_coarse, position_delta_coarse, n_evaluated = run_network_occupied(network_query_fn, pts, viewdirs, frame_time, network_fn, occupancy_grid)
+                with torch.no_grad(), stage_timer.stage('raw2outputs', raw=raw_coarse.shape):
+                    _, _, _, weights, _ = raw2outputs(raw_coarse, z_vals, rays_d, raw_noise_std, white_bkgd, pytest=pytest,
+                                                      compositor=compositor, outputs=())
+            samples_per_ray.append(n_evaluated)
 
             z_vals_mid = .5 * (z_vals[...,1:] + z_vals[...,:-1])
-            z_samples = importance_sampling_ray(z_vals_mid, weights[...,1:-1], N_importance, det=(perturb==0.), pytest=pytest)
+            with stage_timer.stage('importance_sampling', weights=weights.shape):
+                z_samples = importance_sampling_ray(z_vals_mid, weights[...,1:-1], N_importance, det=(perturb==0.), pytest=pytest)
             z_samples = z_samples.detach()
-            z_vals, _ = torch.sort(torch.cat([z_vals, z_samples], -1), -1)
-
-    pts = rays_o[...,None,:] + rays_d[...,None,:] * z_vals[...,:,None] # [N_rays, N_samples + N_importance, 3]
-    run_fn = network_fn if network_fine is None else network_fine
-    raw, position_delta = network_query_fn(pts, viewdirs, frame_time, run_fn)
-    rgb_map, disp_map, acc_map, weights, _ = raw2outputs(raw, z_vals, rays_d, raw_noise_std, white_bkgd, pytest=pytest, volumetric_function=volumetric_function)
+            z_vals, sort_inds = sort(torch.cat([z_vals, z_samples], -1, out=buffer('z_cat', [N_rays, N_samples + N_importance])), 'z_vals_all')
+
+    if raw_coarse is not None:
+        # Evaluate the importance samples only and merge them with the coarse outputs in depth order
+        pts = sample_points(z_samples, 'pts_fine') # [N_rays, N_importance, 3]
+        with stage_timer.stage('fine_network', pts=pts.shape):
+            raw, position_delta, n_evaluated = run_network_occupied(network_query_fn, pts, viewdirs, frame_time, network_fn, occupancy_grid)
+        raw = torch.gather(torch.cat([raw_coarse, raw], 1), 1, sort_inds[...,None].expand([-1, -1, raw.shape[-1]]))
+        position_delta = torch.gather(torch.cat([position_delta_coarse, position_delta], 1), 1,
+                                      sort_inds[...,None].expand([-1, -1, position_delta.shape[-1]]))
+        with stage_timer.stage('raw2outputs', raw=raw.shape):
+            rgb_map, disp_map, acc_map, weights, _ = raw2outputs(raw, z_vals, rays_d, raw_noise_std, white_bkgd, pytest=pytest,
+                                                                 compositor=compositor, outputs=final_maps)
+        samples_per_ray.append(n_evaluated)
+
+    elif not composited:
+        run_fn = network_fn if network_fine is None else network_fine
+        raw, position_delta, n_evaluated, rgb_map, disp_map, acc_map, weights, _ = query_and_composite(z_vals, run_fn, final_maps, 'fine')  # N_samples + N_importance
+        samples_per_ray.append(n_evaluated)
 
    #print("rgb_map",rgb_map)
     ret = {'rgb_map' : rgb_map, 'disp_map' : disp_map, 'acc_map' : acc_map, 'z_vals' : z_vals,
            'position_delta' : position_delta}
+    ret = {k : ret[k] for k in ret if want(k) and ret[k] is not None}
     #print("ret",ret)
-    if retraw:
+    if raw is not None and (retraw if outputs is None else 'raw' in outputs):
         ret['raw'] = raw
+    if outputs is not None and 'pts' in outputs:
+        ret['pts'] = rays_o[...,None,:] + rays_d[...,None,:] * z_vals[...,:,None]
+    if outputs is not None and 'pts_0' in outputs and z_vals_0 is not None:
+        ret['pts_0'] = rays_o[...,None,:] + rays_d[...,None,:] * z_vals_0[...,:,None]
+    if (occupancy_grid is not None or march) and want('samples_per_ray'):
+        ret['samples_per_ray'] = torch.stack(samples_per_ray, 0).sum(0).float()
     if N_importance > 0:
         if rgb_map_0 is not None:
             ret['rgb0'] = rgb_map_0
@@ -581,9 +1354,9 @@ def render_rays(ray_batch,
             ret['disp0'] = disp_map_0
         if acc_map_0 is not None:
             ret['acc0'] = acc_map_0
-        if position_delta_0 is not None:
+        if position_delta_0 is not None and want('position_delta_0'):
             ret['position_delta_0'] = position_delta_0
-        if z_samples is not None:
+        if z_samples is not None and want('z_std'):
             ret['z_std'] = torch.std(z_samples, dim=-1, unbiased=False)  # [N_rays]
 
     # for k in ret:
@@ -593,6 +1366,115 @@ def render_rays(ray_batch,
     return ret
 
 
+# Directory of the weights-only snapshots train() saves for the eval worker (--eval_worker), and
+# the file it creates there once the last snapshot is written
+EVAL_SNAPSHOT_DIR = 'eval_snapshots'
+EVAL_DONE_FILE = 'training_done'
+
+
+# Chunk sizes replacing the GPU defaults of --chunk and --netchunk on CPU, where smaller
+# batches keep the activations in cache (see benchmarks/bench_cpu_throughput.py)
+CPU_CHUNK_DEFAULTS = {'chunk': 1024*2, 'netchunk': 1024*8}
+
+
+DEVICE_ARGS = ['device', 'num_threads', 'num_interop_threads', 'cpu_affinity']
+
+
+def add_device_args(parser):
+    parser.add_argument("--device", type=str, default='auto', choices=['auto', 'cuda', 'cpu'],
+                        help='device to run on, auto picks cuda if available')
+    parser.add_argument("--num_threads", type=int, default=0,
+                        help='intra-op threads on CPU, 0 for one per core of the cpu_affinity')
+    parser.add_argument("--num_interop_threads", type=int, default=0,
+                        help='inter-op threads on CPU, 0 for the torch default')
+    parser.add_argument("--cpu_affinity", type=str, default='',
+                        help='cores to pin the process and its threads to on CPU, e.g. 0-7,16, empty for all')
+    return parser
+
+
+def configure_device(args):
+    """Selects args.device for the whole process and returns it. On CUDA new tensors are created
+    on the GPU by default. On CPU the process is pinned to args.cpu_affinity (the threads started
+    later inherit it), the thread pools are sized and chunk sizes left at their GPU defaults are
+    replaced by CPU_CHUNK_DEFAULTS."""
+    global device
+    device = torch.device(('cuda' if torch.cuda.is_available() else 'cpu') if args.device == 'auto' else args.device)
+    if device.type == 'cuda':
+        set_default_device(device)
+        return device
+
+    if args.cpu_affinity:
+        os.sched_setaffinity(0, parse_cpu_list(args.cpu_affinity))
+    n_cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    torch.set_num_threads(args.num_threads if args.num_threads > 0 else n_cores)
+    if args.num_interop_threads > 0:
+        torch.set_num_interop_threads(args.num_interop_threads)
+
+    defaults = config_parser()
+    for k, v in CPU_CHUNK_DEFAULTS.items():
+        if hasattr(args, k) and getattr(args, k) == defaults.get_default(k):
+            setattr(args, k, v)
+    print('Running on CPU with {} threads, chunk {} netchunk {}'.format(
+        torch.get_num_threads(), getattr(args, 'chunk', '-'), getattr(args, 'netchunk', '-')))
+    return device
+
+
+def report_stage_times(writer, i, window, totals, json_path):
+    """Logs the stage times and throughput of the iterations since the last report ('window',
+    as returned by StageTimer.reset()) to Tensorboard, and those of the whole run, accumulated
+    in 'totals', to json_path."""
+    def summarize(times, calls, counters):
+        steps = max(calls.get('step', 0), 1)
+        step_time = max(times.get('step', 0.), 1e-9)
+        train_evals = sum(v for k, v in counters.items() if k.startswith('render/') and k.endswith('network_evals'))
+        return {
+            'iterations': calls.get('step', 0),
+            'ms_per_iter': {k: 1000. * t / steps for k, t in sorted(times.items())},
+            'share_of_step': {k: t / step_time for k, t in sorted(times.items()) if k != 'step' and '/' not in k},
+            'calls': dict(sorted(calls.items())),
+            'counters': dict(sorted(counters.items())),
+            'rays_per_sec': counters.get('rays', 0.) / step_time,
+            'samples_per_sec': train_evals / step_time,
+            'network_evals_per_iter': train_evals / steps,
+        }
+
+    times, calls, counters = window
+    summary = summarize(times, calls, counters)
+    for k, ms in summary['ms_per_iter'].items():
+        writer.add_scalar('time/' + k + '_ms', ms, i)
+    for k in ['rays_per_sec', 'samples_per_sec', 'network_evals_per_iter']:
+        writer.add_scalar('throughput/' + k, summary[k], i)
+
+    for key, window_dict in zip(['times', 'calls', 'counters'], window):
+        total = totals.setdefault(key, {})
+        for k, v in window_dict.items():
+            total[k] = total.get(k, 0) + v
+    with open(json_path, 'w') as f:
+        json.dump(summarize(totals['times'], totals['calls'], totals['counters']), f, indent=2)
+    tqdm.write('[TIME] ' + ' '.join('{}: {:.1f}ms'.format(k, ms) for k, ms in summary['ms_per_iter'].items() if '/' not in k)
+               + ' | {:.0f} rays/s {:.0f} samples/s'.format(summary['rays_per_sec'], summary['samples_per_sec']))
+
+
+def report_memory(writer, i, window, totals, json_path):
+    """Logs the peak memory of the stages since the last report ('window', as returned by
+    StageTimer.reset_memory()) to Tensorboard (if writer is not None), and the peak of the whole
+    run, kept in 'totals', with the largest growth of each stage to json_path."""
+    for k, peak in window.items():
+        totals[k] = max(totals.get(k, 0), peak)
+        if writer is not None:
+            writer.add_scalar('memory/' + k + '_mb', peak / 2**20, i)
+    with open(json_path, 'w') as f:
+        json.dump({
+            'peak_mb': {k: v / 2**20 for k, v in sorted(totals.items())},
+            'growth_mb': {k: v / 2**20 for k, v in sorted(stage_timer.memory_growth.items())},
+        }, f, indent=2)
+    if len(window) > 0:
+        # The stage allocating the most is the one to make smaller with chunk, netchunk or N_rand
+        top = max(window, key=lambda k: stage_timer.memory_growth.get(k, 0))
+        tqdm.write('[MEMORY] peak {:.0f} MB, largest stage {} ({:.0f} MB above its start)'.format(
+            max(window.values()) / 2**20, top, stage_timer.memory_growth.get(top, 0) / 2**20))
+
+
 def config_parser():
 
     import configargparse
@@ -623,6 +1505,8 @@ def config_parser():
                         help='batch size (number of random rays per gradient step)')
     parser.add_argument("--do_half_precision", action='store_true',
                         help='do half precision training and inference')
+    parser.add_argument("--half_precision_dtype", type=str, default=None,
+                        help='options: float16 / bfloat16, default is float16 on GPU and bfloat16 on CPU')
     parser.add_argument("--lrate", type=float, default=5e-4, 
                         help='learning rate')
     parser.add_argument("--lrate_decay", type=int, default=250, 
@@ -631,6 +1515,17 @@ def config_parser():
                         help='number of rays processed in parallel, decrease if running out of memory')
     parser.add_argument("--netchunk", type=int, default=1024*64, 
                         help='number of pts sent through network in parallel, decrease if running out of memory')
+    add_device_args(parser)
+    parser.add_argument("--compile", type=str, default='none', choices=COMPILE_METHODS,
+                        help='compile the networks: torch.compile, TorchScript traces, auto for torch.compile if available, none to run eagerly')
+    parser.add_argument("--compile_mode", type=str, default='default',
+                        help='torch.compile mode: default / reduce-overhead (CUDA graphs) / max-autotune')
+    parser.add_argument("--autotune_chunks", action='store_true',
+                        help='probe the network and renderer at startup and replace chunk and netchunk by the fastest sizes within the memory budget')
+    parser.add_argument("--autotune_mem_budget", type=float, default=0,
+                        help='memory budget for chunk autotuning in MB, 0 for 80%% of the currently available memory')
+    parser.add_argument("--autotune_cache", type=str, default=None,
+                        help='json file caching tuned chunk sizes per model config and device, default is <basedir>/chunk_autotune.json')
     parser.add_argument("--no_batching", action='store_true', 
                         help='only take random rays from 1 image at a time')
     parser.add_argument("--no_reload", action='store_true', 
@@ -672,7 +1567,25 @@ def config_parser():
                         help='render the test set instead of render_poses path')
     parser.add_argument("--render_factor", type=int, default=0, 
                         help='downsampling factor to speed up rendering, set 4 or 8 for fast preview')
+    parser.add_argument("--occupancy_grid", action='store_true',
+                        help='skip samples in empty cells of a canonical occupancy grid')
+    parser.add_argument("--occ_grid_resolution", type=int, default=64,
+                        help='resolution of the occupancy grid')
+    parser.add_argument("--occ_grid_bbox", nargs=6, type=float, default=[-1., -1., -1., 1., 1., 1.],
+                        help='min and max corner of the occupancy grid, samples outside are always evaluated')
+    parser.add_argument("--occ_grid_alpha_thresh", type=float, default=0.01,
+                        help='cells with lower opacity are treated as empty')
+    parser.add_argument("--occ_grid_update_period", type=int, default=16,
+                        help='number of iters between occupancy grid refreshes')
+    parser.add_argument("--occ_grid_warmup", type=int, default=1000,
+                        help='number of iters before samples are skipped')
+    parser.add_argument("--termination_thresh", type=float, default=0.,
+                        help='transmittance below which rays are terminated at test time, 0 to disable ray marching')
+    parser.add_argument("--march_chunk", type=int, default=8,
+                        help='number of samples per ray evaluated per marching step')
     parser.add_argument("--volumetric_function",type=str, default="exp", help="function used for weights in volumetric rendering")
+    parser.add_argument("--baked_path", type=str, default=None,
+                        help='render_only from a grid baked by bake_endonerf.py instead of the networks')
     # training trick options
     parser.add_argument("--precrop_iters", type=int, default=0,
                         help='number of steps to train on central crops')
@@ -680,6 +1593,24 @@ def config_parser():
                         help='number of steps to train on central time')
     parser.add_argument("--precrop_frac", type=float,
                         default=.5, help='fraction of img taken for central crops')
+    parser.add_argument("--stage_timers", action='store_true',
+                        help='time the stages of the training iterations, logged every i_print iterations to Tensorboard and stage_times.json')
+    parser.add_argument("--memory_stats", action='store_true',
+                        help='record the peak memory of the stages of the training iterations (of the rendering with render_only), logged every i_print iterations to Tensorboard and memory_stats.json, and warn about stages likely to run out of memory')
+    parser.add_argument("--profile_steps", type=str, default='',
+                        help='start:end, capture these training iterations (rendered frames with render_only) with torch.profiler')
+    parser.add_argument("--profile_top_n", type=int, default=30,
+                        help='num of operators in the table of the profile')
+    parser.add_argument("--seed", type=int, default=0,
+                        help='random seed, offset by the rank in distributed training')
+    parser.add_argument("--dist_backend", type=str, default='gloo',
+                        help='torch.distributed backend of the training launched by run_endonerf_ddp.py or torchrun')
+    parser.add_argument("--c2f_iters", type=int, nargs='+', default=[],
+                        help='iterations at which the resolution of the training images doubles, training starts on images downsampled by 2^len(c2f_iters); empty trains at full resolution')
+    parser.add_argument("--c2f_no_pe_anneal", action='store_true',
+                        help='do not raise the positional encoding bandwidth along with the resolution')
+    parser.add_argument("--target_psnr", type=float, default=0.,
+                        help='report the wall-clock time until the full resolution training PSNR, averaged over i_print iterations, reaches this value, 0 disables')
     parser.add_argument("--add_tv_loss", action='store_true',
                         help='evaluate tv loss')
     parser.add_argument("--tv_loss_weight", type=float,
@@ -706,6 +1637,12 @@ def config_parser():
                         help='number of rounds of depth map refinement') 
     parser.add_argument("--depth_refine_quantile", type=float, default=0.3,
                         help='proportion of pixels to be updated during depth refinement')           
+    parser.add_argument("--depth_refine_sample_rate", type=float, default=1.,
+                        help='fraction of pixels probed to find the high-error regions in depth refinement, 1 renders all masked pixels')
+    parser.add_argument("--depth_refine_candidate_factor", type=float, default=2.,
+                        help='pixels rendered densely in depth refinement, as a multiple of the pixels to be updated')
+    parser.add_argument("--depth_refine_rays_per_iter", type=int, default=0,
+                        help='rays rendered for depth refinement per training iteration, 0 to refine each round at once')
 
 
     # dataset options
@@ -749,6 +1686,19 @@ def config_parser():
                         help='frequency of tensorboard image logging')
     parser.add_argument("--i_weights", type=int, default=100000,
                         help='frequency of weight ckpt saving')
+    parser.add_argument("--eval_worker", action='store_true',
+                        help='run the i_img, i_testset and i_video evaluations in a separate eval_worker.py process, '
+                             'on weights-only snapshots of these iterations; snapshots saved while it evaluates are skipped')
+    parser.add_argument("--eval_worker_gpu", type=str, default='',
+                        help='CUDA_VISIBLE_DEVICES of the eval worker, empty to share the devices of the training')
+    parser.add_argument("--eval_render_factor", type=int, default=4,
+                        help='downsampling factor of the eval worker renderings, 0 for full resolution')
+    parser.add_argument("--eval_poll_interval", type=float, default=10.,
+                        help='seconds between looks of the eval worker for new ckpts')
+    parser.add_argument("--ckpt_keep_last", type=int, default=0,
+                        help='num of most recent ckpts to keep, 0 keeps all')
+    parser.add_argument("--ckpt_milestone", type=int, default=20000,
+                        help='ckpts at multiples of this iteration are always kept, 0 for none')
     parser.add_argument("--i_testset", type=int, default=200000,
                         help='frequency of testset saving')
     parser.add_argument("--i_video",   type=int, default=200000,
@@ -778,15 +1728,9 @@ def preprocess_image_specularity(images):
 
     return result
 
-def train():
-
-    parser = config_parser()
-    args = parser.parse_args()
-
-
-    # Load data
-
-
+def load_data(args):
+    """Loads and splits the dataset of args as used for training, None for unknown dataset types.
+    """
     if args.dataset_type == 'blender':
         raise NotImplementedError
 
@@ -827,7 +1771,7 @@ def train():
 
     else:
         print('Unknown dataset type', args.dataset_type, 'exiting')
-        return
+        return None
 
     min_time, max_time = times[i_train[0]], times[i_train[-1]]
     assert min_time == 0., "time must start at 0"
@@ -842,24 +1786,53 @@ def train():
         render_poses = np.array(poses[i_test])
         render_times = np.array(times[i_test])
 
+    return images, masks, depth_maps, edges_masks, poses, times, render_poses, render_times, hwf, \
+        i_train, i_val, i_test, near, far, close_depth, inf_depth
+
+
+def train():
+
+    parser = config_parser()
+    args = parser.parse_args()
+    configure_device(args)
+
+    # Load data
+    data = load_data(args)
+    if data is None:
+        return
+    images, masks, depth_maps, edges_masks, poses, times, render_poses, render_times, hwf, \
+        i_train, i_val, i_test, near, far, close_depth, inf_depth = data
+    H, W, focal = hwf
+
+    # Data-parallel training if launched by run_endonerf_ddp.py or torchrun: every rank samples
+    # its own rays, the gradients are averaged and rank 0 logs and saves checkpoints
+    rank, world_size = init_distributed(args.dist_backend)
+    np.random.seed(args.seed + rank)
+    torch.manual_seed(args.seed + rank)
+
     # Create log dir and copy the config file
     basedir = args.basedir
     expname = args.expname
-    os.makedirs(os.path.join(basedir, expname), exist_ok=True)
-    f = os.path.join(basedir, expname, 'args.txt')
-    with open(f, 'w') as file:
-        for arg in sorted(vars(args)):
-            attr = getattr(args, arg)
-            file.write('{} = {}\n'.format(arg, attr))
-    if args.config is not None:
-        f = os.path.join(basedir, expname, 'config.txt')
+    if rank == 0:
+        os.makedirs(os.path.join(basedir, expname), exist_ok=True)
+        f = os.path.join(basedir, expname, 'args.txt')
         with open(f, 'w') as file:
-            file.write(open(args.config, 'r').read())
-    print('Log directory:', os.path.join(basedir, expname))
+            for arg in sorted(vars(args)):
+                attr = getattr(args, arg)
+                file.write('{} = {}\n'.format(arg, attr))
+        if args.config is not None:
+            f = os.path.join(basedir, expname, 'config.txt')
+            with open(f, 'w') as file:
+                file.write(open(args.config, 'r').read())
+        print('Log directory:', os.path.join(basedir, expname))
 
     # Create nerf model
-    render_kwargs_train, render_kwargs_test, start, grad_vars, optimizer, nerf_model_extras = create_nerf(args)
+    render_kwargs_train, render_kwargs_test, start, grad_vars, optimizer, nerf_model_extras = create_nerf(args, training=not args.render_only)
+    if world_size > 1:
+        # Identical initial weights on all ranks
+        broadcast_tensors([p.data for p in grad_vars])
     global_step = start
+    grad_scaler = nerf_model_extras['grad_scaler']
 
     bds_dict = {
         'near' : near + 1e-6,
@@ -890,12 +1863,22 @@ def train():
 
                 save_gt = False
 
+            if args.baked_path is not None:
+                print('Rendering from baked grid', args.baked_path)
+                render_kwargs_test['baked'] = BakedGrid.load(args.baked_path, device, chunk=args.netchunk)
+
             testsavedir = os.path.join(basedir, expname, 'renderonly_{}_{:06d}'.format('test' if args.render_test else ('path_%s' % args.llff_renderpath), start))
             os.makedirs(testsavedir, exist_ok=True)
 
-            rgbs, _ = render_path(render_poses, render_times, hwf, args.chunk, args.volumetric_function, render_kwargs_test, gt_imgs=images,
-                                  savedir=testsavedir, render_factor=args.render_factor, save_also_gt=save_gt, save_depth=True, near_far=(close_depth, inf_depth))
+            profiler = StepProfiler(args.profile_steps, testsavedir, args.profile_top_n)
+            if args.memory_stats:
+                stage_timer.enable(device, memory=True)
+            rgbs, _ = render_path(render_poses, render_times, hwf, args.chunk, render_kwargs_test, gt_imgs=images,
+                                  savedir=testsavedir, render_factor=args.render_factor, save_also_gt=save_gt, save_depth=True, near_far=(close_depth, inf_depth),
+                                  profiler=profiler)
             print('Done rendering', testsavedir)
+            if args.memory_stats:
+                report_memory(None, start, stage_timer.reset_memory(), {}, os.path.join(testsavedir, 'memory_stats.json'))
             imageio.mimwrite(os.path.join(testsavedir, 'video.mp4'), to8b(rgbs), fps=args.video_fps, quality=8)
 
             return
@@ -958,11 +1941,106 @@ def train():
     print('Begin')
 
     # Summary writers
-    writer = SummaryWriter(os.path.join(basedir, 'summaries', expname))
-    
+    writer = SummaryWriter(os.path.join(basedir, 'summaries', expname)) if rank == 0 else None
+
+    # Checkpoints and diagnostics are written in the background
+    file_writer = BackgroundWriter()
+    ckpt_writer = CheckpointWriter(os.path.join(basedir, expname), keep_last=args.ckpt_keep_last,
+                                   milestone=args.ckpt_milestone, writer=file_writer)
+
+    # Evaluations in a separate process, on weights-only snapshots saved at the evaluation iterations
+    eval_process = None
+    eval_snapshots = None
+    if args.eval_worker and rank == 0:
+        os.makedirs(os.path.join(basedir, expname, EVAL_SNAPSHOT_DIR), exist_ok=True)
+        if os.path.exists(os.path.join(basedir, expname, EVAL_SNAPSHOT_DIR, EVAL_DONE_FILE)):
+            os.remove(os.path.join(basedir, expname, EVAL_SNAPSHOT_DIR, EVAL_DONE_FILE))
+        eval_snapshots = CheckpointWriter(os.path.join(basedir, expname, EVAL_SNAPSHOT_DIR), keep_last=2, writer=file_writer)
+        env = dict(os.environ)
+        if args.eval_worker_gpu:
+            env['CUDA_VISIBLE_DEVICES'] = args.eval_worker_gpu
+        eval_process = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'eval_worker.py')]
+                                        + sys.argv[1:] + ['--eval_follow_pid', str(os.getpid())], env=env)
+
+    # Sparse depth map refinement, spread over the training iterations
+    depth_refiner = None
+    if not args.no_depth_refine and depth_maps is not None:
+        depth_refiner = DepthRefiner(depth_maps, masks, poses, times, i_train, hwf, inf_depth - close_depth,
+                                     render_kwargs_test, args.chunk, quantile=args.depth_refine_quantile,
+                                     sample_rate=args.depth_refine_sample_rate,
+                                     candidate_factor=args.depth_refine_candidate_factor,
+                                     rays_per_iter=args.depth_refine_rays_per_iter, writer=file_writer)
+
+    # Maps computed in the training step, the others are skipped
+    train_outputs = ['rgb_map', 'rgb0', 'samples_per_ray']
+    if depth_maps is not None and args.depth_loss_weight > 1e-16:
+        train_outputs += ['disp_map']
+    if args.add_tv_loss or render_kwargs_train['occupancy_grid'] is not None:
+        train_outputs += ['position_delta', 'position_delta_0']
+    if args.add_tv_loss:
+        train_outputs += ['pts', 'pts_0']
+
+    # Ray batches and samples of the training iterations in persistent buffers
+    train_step = TrainStep(N_rand, images, poses,
+                           ray_importance_maps=ray_importance_maps if masks is not None and not args.no_mask_raycast else None,
+                           depth_maps=depth_maps, loss_masks=masks if args.mask_loss else None,
+                           depth_scale=(inf_depth - close_depth) + 1e-6 if not args.no_ndc else None)
+
+    # Coarse-to-fine schedule: downsampled images and a band-limited positional encoding first
+    embedder = nerf_model_extras['embedder']
+    anneal_pe = len(args.c2f_iters) > 0 and not args.c2f_no_pe_anneal and embedder is not None
+    c2f_factor = None
+
+    # torch.profiler capture of the iterations args.profile_steps
+    profiler = StepProfiler(args.profile_steps if rank == 0 else '', os.path.join(basedir, expname), args.profile_top_n)
+
+    # Per-stage times and peak memory of the training iterations, measured and reported by rank 0
+    # only: the ranks run the same stages and the others would synchronize for nothing
+    stage_times_total = {}
+    stage_memory_total = {}
+    if (args.stage_timers or args.memory_stats) and rank == 0:
+        stage_timer.enable(device, memory=args.memory_stats)
+
+    def network_state(global_step):
+        state = {
+            'global_step': global_step,
+            'network_fn_state_dict': render_kwargs_train['network_fn'].state_dict(),
+        }
+        if render_kwargs_train['network_fine'] is not None:
+            state['network_fine_state_dict'] = render_kwargs_train['network_fine'].state_dict()
+        if render_kwargs_train['occupancy_grid'] is not None:
+            state['occupancy_grid'] = render_kwargs_train['occupancy_grid'].state_dict()
+        return state
+
+    def save_checkpoint(step, global_step):
+        save_dict = network_state(global_step)
+        save_dict['optimizer_state_dict'] = optimizer.state_dict()
+
+        if grad_scaler is not None:
+            save_dict['grad_scaler'] = grad_scaler.state_dict()
+        maps = {
+            'ray_importance_maps': (ray_importance_maps, 0),
+            'depth_maps': (depth_maps, depth_refiner.version if depth_refiner is not None else 0),
+        }
+        path = ckpt_writer.save(step, save_dict, maps)
+        print('Saved checkpoints at', path)
+
+    # Wall-clock time to the target PSNR, measured from the first iteration of this run
+    train_time0 = time.time()
+    target_psnrs = collections.deque(maxlen=args.i_print)
+    target_reached = False
+
     start = start + 1
-    for i in trange(start, N_iters):
-        torch.cuda.empty_cache()
+    for i in trange(start, N_iters, disable=rank > 0):
+        profiler.step(i)
+        stage_timer.begin_step()
+        if anneal_pe:
+            embedder.alpha = coarse_to_fine_bandwidth(i, args.c2f_iters, args.multires) if i < max(args.c2f_iters) else None
+        if coarse_to_fine_factor(i, args.c2f_iters) != c2f_factor:
+            c2f_factor = coarse_to_fine_factor(i, args.c2f_iters)
+            H_l, W_l, focal_l = H // c2f_factor, W // c2f_factor, focal / c2f_factor
+            if len(args.c2f_iters) > 0 and rank == 0:
+                print(f"[Config] Training on {H_l} x {W_l} images from iter {i}")
         ##### Sample random ray batch #####
         if use_batching:
             raise NotImplementedError("Not implemented")
@@ -981,6 +2059,7 @@ def train():
 
         else:
             # Random from one image
+            stage_timer.begin('ray_sampling')
             if i >= args.precrop_iters_time:
                 img_i = np.random.choice(i_train)
             else:
@@ -988,73 +2067,32 @@ def train():
                 max_sample = max(int(skip_factor), 3)
                 img_i = np.random.choice(i_train[:max_sample])
 
-            # target = torch.Tensor(images[img_i]).to(device)
-            target = images[img_i]
-            pose = poses[img_i, :3, :4]
             frame_time = times[img_i]
 
-            if masks is not None:
-                mask = masks[img_i]
-                ray_importance_map = ray_importance_maps[img_i]
-            if depth_maps is not None:
-                depth_map = depth_maps[img_i]
-            if edges_masks is not None:
-                edges_mask = edges_masks[img_i]
-
-            if N_rand is not None:
-                rays_o, rays_d = get_rays(H, W, focal, torch.Tensor(pose))  # (H, W, 3), (H, W, 3)
-
-                if i < args.precrop_iters:
-                    dH = int(H//2 * args.precrop_frac)
-                    dW = int(W//2 * args.precrop_frac)
-                    coords = torch.stack(
-                        torch.meshgrid(
-                            torch.linspace(H//2 - dH, H//2 + dH - 1, 2*dH),
-                            torch.linspace(W//2 - dW, W//2 + dW - 1, 2*dW)
-                        ), -1)
-                    if i == start:
-                        print(f"[Config] Center cropping of size {2*dH} x {2*dW} is enabled until iter {args.precrop_iters}")                
-                else:
-                    coords = torch.stack(torch.meshgrid(torch.linspace(0, H-1, H), torch.linspace(0, W-1, W)), -1)  # (H, W, 2)
-
-                coords = torch.reshape(coords, [-1,2])  # (H * W, 2)
-                if masks is None or args.no_mask_raycast:
-                    select_inds = np.random.choice(coords.shape[0], size=[N_rand], replace=False)  # (N_rand,)
-                elif masks is not None:
-                    select_inds, _, cdf = importance_sampling_coords(ray_importance_map[coords[:, 0].long(), coords[:, 1].long()].unsqueeze(0), N_rand)
-                    select_inds = torch.max(torch.zeros_like(select_inds), select_inds)
-                    select_inds = torch.min((coords.shape[0] - 1) * torch.ones_like(select_inds), select_inds)
-                    select_inds = select_inds.squeeze(0)
-                    
-                select_coords = coords[select_inds].long()  # (N_rand, 2)
-                rays_o = rays_o[select_coords[:, 0], select_coords[:, 1]]  # (N_rand, 3)
-                rays_d = rays_d[select_coords[:, 0], select_coords[:, 1]]  # (N_rand, 3)
-                batch_rays = torch.stack([rays_o, rays_d], 0)
-                target_s = target[select_coords[:, 0], select_coords[:, 1]]  # (N_rand, 3)
-                if depth_maps is not None:
-                    depth_s = depth_map[select_coords[:, 0], select_coords[:, 1]]
-                    if not args.no_ndc:
-                        depth_s = depth_s / ((inf_depth - close_depth) + 1e-6)
-
-                    # Apply depth-guided ray sampling
-                    if not args.no_depth_sampling:
-                        bds_dict = {
-                            'near' : depth_s.detach().clone() + 1e-6,
-                            'far' : args.depth_sampling_sigma,
-                        }
-                        render_kwargs_train.update(bds_dict)
-                if masks is not None and args.mask_loss:
-                    mask_s = mask[select_coords[:, 0], select_coords[:, 1]]
-                    mask_s = mask_s.unsqueeze(-1)
-                else:
-                    mask_s = None
+            crop = None
+            if i < args.precrop_iters:
+                crop = (int(H_l//2 * args.precrop_frac), int(W_l//2 * args.precrop_frac))
+                if i == start:
+                    print(f"[Config] Center cropping of size {2*crop[0]} x {2*crop[1]} is enabled until iter {args.precrop_iters}")
+            batch_rays, target_s, depth_s, mask_s = train_step.sample(img_i, H_l, W_l, focal_l, c2f_factor, crop)
+
+            # Apply depth-guided ray sampling
+            if depth_s is not None and not args.no_depth_sampling:
+                bds_dict = {
+                    'near' : torch.add(depth_s, 1e-6, out=train_step.pool.get('near', depth_s.shape)),
+                    'far' : args.depth_sampling_sigma,
+                }
+                render_kwargs_train.update(bds_dict)
+            stage_timer.end('ray_sampling')
+            stage_timer.count('rays', batch_rays.shape[1])
 
         #####  Core optimization loop  #####
-        rgb, disp, acc, extras = render(H, W, focal, chunk=args.chunk, rays=batch_rays, frame_time=frame_time,
-                                                verbose=i < 10, retraw=True,
-                                                **render_kwargs_train)
+        with stage_timer.stage('render', rays=batch_rays.shape):
+            rgb, disp, acc, extras = train_step.render(H_l, W_l, focal_l, args.chunk, batch_rays, frame_time, render_kwargs_train,
+                                                       verbose=i < 10, outputs=train_outputs)
 
         if args.add_tv_loss:
+            stage_timer.begin('tv_deformation')
             frame_time_prev = times[img_i - 1] if img_i > 0 else None
             frame_time_next = times[img_i + 1] if img_i < times.shape[0] - 1 else None
 
@@ -1064,18 +2102,27 @@ def train():
                 else:
                     frame_time_next = None
 
+            tv_times = []
             if frame_time_prev is not None:
-                rand_time_prev = frame_time_prev + (frame_time - frame_time_prev) * torch.rand(1)[0]
-                _, _, _, extras_prev = render(H, W, focal, chunk=args.chunk, rays=batch_rays, frame_time=rand_time_prev,
-                                                verbose=i < 10, retraw=True, z_vals=extras['z_vals'].detach(),
-                                                **render_kwargs_train)
-
+                tv_times.append(frame_time_prev + (frame_time - frame_time_prev) * torch.rand(1)[0])
             if frame_time_next is not None:
-                rand_time_next = frame_time + (frame_time_next - frame_time) * torch.rand(1)[0]
-                _, _, _, extras_next = render(H, W, focal, chunk=args.chunk, rays=batch_rays, frame_time=rand_time_next,
-                                                verbose=i < 10, retraw=True, z_vals=extras['z_vals'].detach(),
-                                                **render_kwargs_train)
-
+                tv_times.append(frame_time + (frame_time_next - frame_time) * torch.rand(1)[0])
+
+            # Deformation of the same samples at all TV times in one batched query, the
+            # canonical network is not evaluated
+            tv_position_deltas = {}
+            network_fine = render_kwargs_train['network_fine']
+            for k_pts, k_delta, network in [('pts', 'position_delta', network_fine if network_fine is not None else render_kwargs_train['network_fn']),
+                                            ('pts_0', 'position_delta_0', render_kwargs_train['network_fn'])]:
+                if k_pts not in extras:
+                    continue
+                pts = extras[k_pts].detach()
+                tv_frame_time = torch.cat([t * torch.ones_like(pts[:, :1, 0]) for t in tv_times], 0)
+                tv_position_deltas[k_delta] = query_deformation(render_kwargs_train['network_query_fn'], pts.repeat(len(tv_times), 1, 1),
+                                                                tv_frame_time, network, render_kwargs_train['occupancy_grid'])
+            stage_timer.end('tv_deformation')
+
+        stage_timer.begin('loss')
         optimizer.zero_grad()
         if mask_s is not None:
             rgb = rgb * mask_s
@@ -1086,14 +2133,9 @@ def train():
 
         tv_loss = 0
         if args.add_tv_loss:
-            if frame_time_prev is not None:
-                tv_loss += ((extras['position_delta'] - extras_prev['position_delta']).pow(2)).sum()
-                if 'position_delta_0' in extras:
-                    tv_loss += ((extras['position_delta_0'] - extras_prev['position_delta_0']).pow(2)).sum()
-            if frame_time_next is not None:
-                tv_loss += ((extras['position_delta'] - extras_next['position_delta']).pow(2)).sum()
-                if 'position_delta_0' in extras:
-                    tv_loss += ((extras['position_delta_0'] - extras_next['position_delta_0']).pow(2)).sum()
+            for k_delta, tv_position_delta in tv_position_deltas.items():
+                tv_position_delta = tv_position_delta.reshape([len(tv_times)] + list(extras[k_delta].shape))
+                tv_loss += ((extras[k_delta][None] - tv_position_delta).pow(2)).sum()
             tv_loss = tv_loss * args.tv_loss_weight
 
         loss = img_loss + tv_loss
@@ -1113,14 +2155,31 @@ def train():
             img_loss0 = img2mse(extras['rgb0'], target_s)
             loss = loss + img_loss0
             psnr0 = mse2psnr(img_loss0)
+        stage_timer.end('loss')
 
-        if args.do_half_precision:
-            with amp.scale_loss(loss, optimizer) as scaled_loss:
-                scaled_loss.backward()
-        else:
-            loss.backward()
+        with stage_timer.stage('backward'):
+            if grad_scaler is not None:
+                grad_scaler.scale(loss).backward()
+            else:
+                loss.backward()
+        if world_size > 1:
+            with stage_timer.stage('all_reduce'):
+                all_reduce_grads(grad_vars)
+        with stage_timer.stage('optimizer'):
+            if grad_scaler is not None:
+                grad_scaler.step(optimizer)
+                grad_scaler.update()
+            else:
+                optimizer.step()
 
-        optimizer.step()
+        occupancy_grid = render_kwargs_train['occupancy_grid']
+        if occupancy_grid is not None:
+            occupancy_grid.observe_deformation(extras['position_delta'])
+            if i >= args.occ_grid_warmup and i % args.occ_grid_update_period == 0:
+                with stage_timer.stage('occupancy_grid'):
+                    update_occupancy_grid(occupancy_grid, render_kwargs_train, chunk=args.netchunk)
+                    if world_size > 1:
+                        broadcast_tensors([occupancy_grid.density, occupancy_grid.occupied])
 
         # NOTE: IMPORTANT!
         ###   update learning rate   ###
@@ -1132,115 +2191,65 @@ def train():
 
         ##### Refine depth maps and ray importance maps ##### section 2.1
         refinement_round = i // args.depth_refine_period
-        if not args.no_depth_refine and depth_maps is not None and i % args.depth_refine_period == 0 and refinement_round <= args.depth_refine_rounds:
-            print('Render RGB and depth maps for refinement...')
-            
-            refinement_save_path = os.path.join(basedir, expname, 'refinement{:04d}'.format(refinement_round))
-            if not os.path.exists(refinement_save_path):
-                os.makedirs(refinement_save_path)
-            depth_prev_save_path = os.path.join(refinement_save_path, 'depth_prev')
-            depth_refined_save_path = os.path.join(refinement_save_path, 'depth_refined')
-            if not os.path.exists(depth_prev_save_path):
-                os.makedirs(depth_prev_save_path)
-            if not os.path.exists(depth_refined_save_path):
-                os.makedirs(depth_refined_save_path)
-            # importance_maps_prev_save_path = os.path.join(refinement_save_path, 'importance_maps_prev')
-            # importance_maps_refined_save_path = os.path.join(refinement_save_path, 'importance_maps_refined')
-            # if not os.path.exists(importance_maps_prev_save_path):
-            #     os.makedirs(importance_maps_prev_save_path)
-            # if not os.path.exists(importance_maps_refined_save_path):
-            #     os.makedirs(importance_maps_refined_save_path)
-
-            with torch.no_grad():
-                rgbs_t, disps_t = render_path_gpu(poses[i_train], times[i_train], hwf, args.chunk, render_kwargs_test)
-
-                masks_gt = masks[i_train] # [N_train, H, W]
-
-                # Refine depth maps
-                depth_t = (1.0 / (disps_t + 1e-6)) * (inf_depth - close_depth)
-                depth_gt = depth_maps[i_train]
-
-                max_depth = depth_maps[i_train].max()
-                for j in i_train:
-                    imageio.imwrite(os.path.join(depth_prev_save_path, 'depth_{:0d}.png'.format(j)), to8b((depth_maps[j] / max_depth).cpu().numpy()))
-
-                depth_diff = torch.pow(depth_t - depth_gt, 2) * masks_gt # [N_train, H, W]
-                depth_diff = depth_diff.reshape(depth_diff.shape[0], -1) # [N_train, H x W]
-                quantile = torch.quantile(depth_diff, 1.0 - args.depth_refine_quantile, dim=1, keepdim=True) # [N_train, 1]
-                depth_to_refine = (depth_diff > quantile).reshape(*depth_t.shape) # [N_train, H, W]
-                depth_gt[depth_to_refine] = depth_t[depth_to_refine]
-                depth_maps[i_train] = depth_gt
-
-                max_depth = depth_maps[i_train].max()
-                for j in i_train:
-                    imageio.imwrite(os.path.join(depth_refined_save_path, 'depth_{:0d}.png'.format(j)), to8b((depth_maps[j] / max_depth).cpu().numpy()))
-
-                save_dict = {
-                    'rounds': refinement_round,
-                    'quantile': quantile.cpu().numpy(),
-                    'depth_diff': depth_diff.cpu().numpy(),
-                    'depth_to_refine': depth_to_refine.cpu().numpy()
-                }
-                torch.save(save_dict, os.path.join(refinement_save_path, 'depth_refine_info.tar'))
-
-                del disps_t, depth_t, depth_gt, depth_to_refine, depth_diff, quantile
-
-                # Refine ray importance maps
-                # max_importance = ray_importance_maps[i_train].max()
-                # for j in i_train:
-                #     imageio.imwrite(os.path.join(importance_maps_prev_save_path, 'importance_{:0d}.png'.format(j)), to8b((ray_importance_maps[j] / max_importance).cpu().numpy()))
-
-                # rgbs_gt = images[i_train] # [N_train, H, W, 3]
-                # rgb_mse = torch.mean(torch.pow(rgbs_t - rgbs_gt, 2), dim=-1) * masks_gt # [N_train, H, W]
-                # rgb_psnr = mse2psnr(rgb_mse)
-                # new_importance_maps = torch.nan_to_num(1.0 - F.softmax(rgb_psnr / 10.0, dim=0)) # [N_train, H, W]
-                # ray_importance_maps[i_train] = ray_importance_maps[i_train] * (1.0 + new_importance_maps)
-
-                # max_importance = ray_importance_maps[i_train].max()
-                # for j in i_train:
-                #     imageio.imwrite(os.path.join(importance_maps_refined_save_path, 'importance_{:0d}.png'.format(j)), to8b((ray_importance_maps[j] / max_importance).cpu().numpy()))
-
-                # save_dict = {
-                #     'rounds': refinement_round,
-                #     'rgb_mse': rgb_mse.cpu().numpy(),
-                #     'rgb_psnr': rgb_psnr.cpu().numpy(),
-                #     'new_importance_maps': new_importance_maps.cpu().numpy()
-                # }
-                # torch.save(save_dict, os.path.join(refinement_save_path, 'importance_map_info.tar'))
-
-                # del rgbs_gt, rgb_mse, rgb_psnr, new_importance_maps
-
-                del rgbs_t, masks_gt
-
-                print('\nRefinement finished, intermediate results saved at', refinement_save_path)
+        if depth_refiner is not None and i % args.depth_refine_period == 0 and refinement_round <= args.depth_refine_rounds:
+            # The refinement is deterministic, every rank refines its copy of the depth maps and
+            # rank 0 saves the diagnostics
+            if rank == 0:
+                print('Render depth maps for refinement...')
+            with stage_timer.stage('refinement'):
+                depth_refiner.start(refinement_round, os.path.join(basedir, expname, 'refinement{:04d}'.format(refinement_round)) if rank == 0 else None)
+
+            # Refine ray importance maps
+            # max_importance = ray_importance_maps[i_train].max()
+            # for j in i_train:
+            #     imageio.imwrite(os.path.join(importance_maps_prev_save_path, 'importance_{:0d}.png'.format(j)), to8b((ray_importance_maps[j] / max_importance).cpu().numpy()))
+
+            # rgbs_gt = images[i_train] # [N_train, H, W, 3]
+            # rgb_mse = torch.mean(torch.pow(rgbs_t - rgbs_gt, 2), dim=-1) * masks_gt # [N_train, H, W]
+            # rgb_psnr = mse2psnr(rgb_mse)
+            # new_importance_maps = torch.nan_to_num(1.0 - F.softmax(rgb_psnr / 10.0, dim=0)) # [N_train, H, W]
+            # ray_importance_maps[i_train] = ray_importance_maps[i_train] * (1.0 + new_importance_maps)
+
+            # max_importance = ray_importance_maps[i_train].max()
+            # for j in i_train:
+            #     imageio.imwrite(os.path.join(importance_maps_refined_save_path, 'importance_{:0d}.png'.format(j)), to8b((ray_importance_maps[j] / max_importance).cpu().numpy()))
+
+            # save_dict = {
+            #     'rounds': refinement_round,
+            #     'rgb_mse': rgb_mse.cpu().numpy(),
+            #     'rgb_psnr': rgb_psnr.cpu().numpy(),
+            #     'new_importance_maps': new_importance_maps.cpu().numpy()
+            # }
+            # torch.save(save_dict, os.path.join(refinement_save_path, 'importance_map_info.tar'))
+
+        if depth_refiner is not None:
+            with stage_timer.stage('refinement'):
+                depth_refiner.step()
 
 
         ################################
         # Rest is logging
+        stage_timer.begin('logging')
 
-        if i%args.i_weights==0:
-            path = os.path.join(basedir, expname, '{:06d}.tar'.format(i))
-            save_dict = {
-                'global_step': global_step,
-                'network_fn_state_dict': render_kwargs_train['network_fn'].state_dict(),
-                'optimizer_state_dict': optimizer.state_dict(),
-                'ray_importance_maps': ray_importance_maps.cpu().numpy(),
-                'depth_maps': depth_maps.cpu().numpy() if depth_maps is not None else None
-            }
-            if render_kwargs_train['network_fine'] is not None:
-                save_dict['network_fine_state_dict'] = render_kwargs_train['network_fine'].state_dict()
-
-            if args.do_half_precision:
-                save_dict['amp'] = amp.state_dict()
-            torch.save(save_dict, path)
-            print('Saved checkpoints at', path)
-
-        if i % args.i_print == 0:
+        if i%args.i_weights==0 and rank == 0:
+            save_checkpoint(i, global_step)
+
+        if args.target_psnr > 0 and not target_reached and c2f_factor == 1 and rank == 0:
+            target_psnrs.append(psnr.item())
+            if len(target_psnrs) == target_psnrs.maxlen and np.mean(target_psnrs) >= args.target_psnr:
+                target_reached = True
+                train_time = time.time() - train_time0
+                tqdm.write(f"[TARGET] PSNR {args.target_psnr} reached at iter {i} after {train_time:.1f} s")
+                writer.add_scalar('time_to_target_psnr', train_time, i)
+
+        if i % args.i_print == 0 and rank == 0:
             tqdm_txt = f"[TRAIN] Iter: {i} Img Loss: {img_loss.item()} PSNR: {psnr.item()}"
             if args.add_tv_loss:
                 tqdm_txt += f" TV: {tv_loss.item()}"
             if depth_maps is not None:
                 tqdm_txt += f" Depth Loss: {depth_loss.item()}"
+            if 'samples_per_ray' in extras:
+                tqdm_txt += f" Samples/ray: {extras['samples_per_ray'].mean().item()}"
             tqdm.write(tqdm_txt)
 
             writer.add_scalar('loss', img_loss.item(), i)
@@ -1252,17 +2261,16 @@ def train():
                 writer.add_scalar('tv', tv_loss.item(), i)
             if depth_maps is not None:
                 writer.add_scalar('depth', depth_loss.item(), i)
+            if 'samples_per_ray' in extras:
+                writer.add_scalar('samples_per_ray', extras['samples_per_ray'].mean().item(), i)
 
-        del loss, img_loss, psnr, target_s
-        if 'rgb0' in extras:
-            del img_loss0, psnr0
-        if args.add_tv_loss:
-            del tv_loss
-        if depth_maps is not None:
-            del depth_loss, depth_s
-        del rgb, disp, acc, extras
+        if eval_process is not None and eval_process.poll() is not None:
+            warnings.warn('Eval worker exited with code {}, evaluating in the training process'.format(eval_process.returncode))
+            eval_process = None
+        if eval_process is not None and any(i % period == 0 for period in [args.i_img, args.i_testset, args.i_video]):
+            eval_snapshots.save(i, network_state(global_step))
 
-        if i%args.i_img==0:
+        if i%args.i_img==0 and eval_process is None and rank == 0:
             torch.cuda.empty_cache()
             # Log a rendered validation view to Tensorboard
             img_i=np.random.choice(i_val)
@@ -1271,7 +2279,8 @@ def train():
             frame_time = times[img_i]
             with torch.no_grad():
                 rgb, disp, acc, extras = render(H, W, focal, chunk=args.chunk, c2w=pose, frame_time=frame_time,
-                                                    **render_kwargs_test)
+                                                outputs=['rgb_map', 'disp_map', 'acc_map', 'rgb0', 'disp0', 'z_std'],
+                                                **render_kwargs_test)
 
             psnr = mse2psnr(img2mse(rgb, target))
             writer.add_image('gt', to8b(target.cpu().numpy()), i, dataformats='HWC')
@@ -1289,13 +2298,13 @@ def train():
             print("finish summary")
             writer.flush()
 
-        if i%args.i_video==0:
+        if i%args.i_video==0 and eval_process is None and rank == 0:
             torch.cuda.empty_cache()
             # Turn on testing mode
             print("Rendering video...")
             with torch.no_grad():
                 savedir = os.path.join(basedir, expname, 'frames_{}_{}_{:06d}_time/'.format(expname, args.llff_renderpath, i))
-                rgbs, disps = render_path(render_poses, render_times, hwf, args.chunk, args.volumetric_function, render_kwargs_test, savedir=savedir)
+                rgbs, disps = render_path(render_poses, render_times, hwf, args.chunk, render_kwargs_test, savedir=savedir)
             print('Done, saving', rgbs.shape, disps.shape)
             moviebase = os.path.join(basedir, expname, '{}_{}_{:06d}_'.format(expname, args.llff_renderpath, i))
             imageio.mimwrite(moviebase + 'rgb.mp4', to8b(rgbs), fps=args.video_fps, quality=8)
@@ -1308,18 +2317,41 @@ def train():
             #     render_kwargs_test['c2w_staticcam'] = None
             #     imageio.mimwrite(moviebase + 'rgb_still.mp4', to8b(rgbs_still), fps=30, quality=8)
 
-        if i%args.i_testset==0:
+        if i%args.i_testset==0 and eval_process is None and rank == 0:
             testsavedir = os.path.join(basedir, expname, 'testset_{:06d}'.format(i))
             print('Testing poses shape...', poses[i_test].shape)
             with torch.no_grad():
                 render_path(torch.Tensor(poses[i_test]).to(device), torch.Tensor(times[i_test]).to(device),
-                            hwf, args.chunk,args.volumetric_function, render_kwargs_test, gt_imgs=torch.Tensor(images[i_test]).to(device), savedir=testsavedir)
+                            hwf, args.chunk, render_kwargs_test, gt_imgs=torch.Tensor(images[i_test]).to(device), savedir=testsavedir)
             print('Saved test set')
 
+        stage_timer.end('logging')
+        stage_timer.end_step()
+        if stage_timer.enabled and i % args.i_print == 0 and rank == 0:
+            window = stage_timer.reset()
+            if args.stage_timers:
+                report_stage_times(writer, i, window, stage_times_total, os.path.join(basedir, expname, 'stage_times.json'))
+            if args.memory_stats:
+                report_memory(writer, i, stage_timer.reset_memory(), stage_memory_total, os.path.join(basedir, expname, 'memory_stats.json'))
+
         global_step += 1
 
+    profiler.stop()
+    if depth_refiner is not None and depth_refiner.active:
+        # Finish the round the last iterations started, its depth maps go into a last checkpoint
+        depth_refiner.finish()
+        if rank == 0:
+            save_checkpoint(N_iters - 1, global_step - 1)
+    if rank == 0:
+        print('Trained {} iterations in {:.1f} s on {} rank(s)'.format(N_iters - start, time.time() - train_time0, world_size))
+    file_writer.close()
+    if world_size > 1:
+        dist.destroy_process_group()
+    if eval_process is not None:
+        open(os.path.join(basedir, expname, EVAL_SNAPSHOT_DIR, EVAL_DONE_FILE), 'w').close()
+        print('Waiting for the eval worker to finish...')
+        eval_process.wait()
 
-if __name__=='__main__':
-    torch.set_default_tensor_type('torch.cuda.FloatTensor')
 
+if __name__=='__main__':
     train()
@@ -0,0 +1,78 @@
+import os
+import sys
+import time
+import subprocess
+import configargparse
+import torch
+
+
+'''
+Launch data-parallel training of run_endonerf.py on several processes of this machine
+'''
+
+###################################################################################################
+# Usage Example
+###################################################################################################
+
+# 4 processes on CPU or on the GPUs of the box:  python run_endonerf_ddp.py --nproc 4 --config configs/example.txt
+# Other machines of a multi-node run:           torchrun --nnodes 2 --nproc_per_node 4 ... run_endonerf.py --config configs/example.txt
+
+###################################################################################################
+
+
+def launch(nproc, train_args, master_addr='127.0.0.1', master_port=29500):
+    """Runs run_endonerf.py with train_args on nproc ranks, with the GPUs of the box (if any)
+    assigned round-robin. Returns the first non-zero exit code of the ranks, or 0."""
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'run_endonerf.py')
+    visible = os.environ.get('CUDA_VISIBLE_DEVICES')
+    gpus = visible.split(',') if visible else [str(k) for k in range(torch.cuda.device_count())]
+    if '--device' in train_args and train_args[train_args.index('--device') + 1] == 'cpu':
+        gpus = []
+
+    # Ranks sharing the CPU cores would oversubscribe them with a thread pool each, they are
+    # pinned to disjoint cores unless the training arguments set an affinity
+    rank_args = [[] for _ in range(nproc)]
+    if len(gpus) == 0 and '--cpu_affinity' not in train_args and hasattr(os, 'sched_getaffinity'):
+        cores = sorted(os.sched_getaffinity(0))
+        if len(cores) >= nproc:
+            for rank in range(nproc):
+                rank_cores = cores[rank * len(cores) // nproc:(rank + 1) * len(cores) // nproc]
+                rank_args[rank] = ['--cpu_affinity', ','.join(str(c) for c in rank_cores)]
+
+    procs = []
+    for rank in range(nproc):
+        env = dict(os.environ, RANK=str(rank), LOCAL_RANK=str(rank), WORLD_SIZE=str(nproc),
+                   MASTER_ADDR=master_addr, MASTER_PORT=str(master_port))
+        if len(gpus) > 0:
+            env['CUDA_VISIBLE_DEVICES'] = gpus[rank % len(gpus)]
+        procs.append(subprocess.Popen([sys.executable, script] + train_args + rank_args[rank], env=env))
+
+    # A failed rank leaves the others blocked in a collective, they are terminated
+    returncode = 0
+    while any(p.poll() is None for p in procs):
+        failed = [p.returncode for p in procs if p.returncode not in (None, 0)]
+        if len(failed) > 0:
+            returncode = failed[0]
+            for p in procs:
+                if p.poll() is None:
+                    p.terminate()
+            break
+        time.sleep(1)
+    for p in procs:
+        p.wait()
+        if returncode == 0 and p.returncode != 0:
+            returncode = p.returncode
+    return returncode
+
+
+if __name__ == '__main__':
+    parser = configargparse.ArgumentParser()
+    parser.add_argument("--nproc", type=int, default=2,
+                        help='num of training processes')
+    parser.add_argument("--master_addr", type=str, default='127.0.0.1',
+                        help='address of rank 0')
+    parser.add_argument("--master_port", type=int, default=29500,
+                        help='free port of rank 0 for the process group')
+    args, train_args = parser.parse_known_args()
+
+    sys.exit(launch(args.nproc, train_args, args.master_addr, args.master_port))
@@ -3,7 +3,19 @@ import torch
 torch.autograd.set_detect_anomaly(True)
 import torch.nn as nn
 import torch.nn.functional as F
+import torch.distributed as dist
 import numpy as np
+import math
+import contextlib
+import functools
+import os
+import re
+import time
+import json
+import warnings
+import pickle
+import collections
+import concurrent.futures
 from torch import searchsorted
 
 
@@ -13,6 +25,533 @@ mse2psnr = lambda x : -10. * torch.log(x) / torch.log(torch.Tensor([10.]))
 to8b = lambda x : (255*np.clip(x,0,1)).astype(np.uint8)
 
 
+# Mixed precision
+def get_autocast_dtype(name, device_type):
+    if name is None:
+        return torch.float16 if device_type == 'cuda' else torch.bfloat16
+    if name not in ['float16', 'bfloat16']:
+        raise ValueError("Half precision dtype %s not recognized." % name)
+    return getattr(torch, name)
+
+
+def autocast(dtype, device_type):
+    """torch.autocast context for the MLPs, a no-op if dtype is None."""
+    if dtype is None:
+        return contextlib.nullcontext()
+    return torch.autocast(device_type=device_type, dtype=dtype)
+
+
+def create_grad_scaler():
+    if hasattr(torch, 'amp') and hasattr(torch.amp, 'GradScaler'):
+        return torch.amp.GradScaler('cuda')
+    return torch.cuda.amp.GradScaler()
+
+
+# Memory
+def available_memory(device):
+    """Free memory in bytes on device, for CPU the available system memory."""
+    if device.type == 'cuda':
+        free, _ = torch.cuda.mem_get_info(device)
+        return free
+    with open('/proc/meminfo') as f:
+        meminfo = dict(line.split(':', 1) for line in f)
+    return int(meminfo['MemAvailable'].split()[0]) * 1024
+
+
+class MemoryStats:
+    """Allocated memory and its peak in bytes on device: the statistics of the CUDA caching
+    allocator, or on CPU the resident set of the process, whose peak is reset through
+    /proc/self/clear_refs on Linux and is the high-water mark of the process elsewhere.
+    """
+    def __init__(self, device):
+        self.device = device
+        self._can_reset = device.type == 'cuda' or os.access('/proc/self/clear_refs', os.W_OK)
+
+    @staticmethod
+    def _proc_status(key):
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(key):
+                    return int(line.split()[1]) * 1024
+
+    def current(self):
+        if self.device.type == 'cuda':
+            return torch.cuda.memory_allocated(self.device)
+        if os.path.exists('/proc/self/status'):
+            return self._proc_status('VmRSS:')
+        return self.peak()
+
+    def peak(self):
+        if self.device.type == 'cuda':
+            return torch.cuda.max_memory_allocated(self.device)
+        if os.path.exists('/proc/self/status'):
+            return self._proc_status('VmHWM:')
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def reset_peak(self):
+        """Restarts the peak at the current allocation, returns False if it cannot be reset."""
+        if self.device.type == 'cuda':
+            torch.cuda.reset_peak_memory_stats(self.device)
+            return True
+        if self._can_reset:
+            try:
+                with open('/proc/self/clear_refs', 'w') as f:
+                    f.write('5')
+                return True
+            except OSError:
+                self._can_reset = False
+        return False
+
+    def available(self):
+        """Bytes that can still be allocated, including the blocks cached by the CUDA allocator."""
+        if self.device.type == 'cuda':
+            return available_memory(self.device) + torch.cuda.memory_reserved(self.device) - torch.cuda.memory_allocated(self.device)
+        return available_memory(self.device)
+
+
+def is_out_of_memory(e):
+    return isinstance(e, MemoryError) or 'out of memory' in str(e) or "can't allocate memory" in str(e)
+
+
+class PeakMemoryMeter:
+    """Context manager measuring the peak memory in bytes allocated inside the block.
+    On CPU this is the growth of the process' resident set, and where its peak cannot be
+    reset the growth of its high-water mark, which only measures a block that allocates more
+    than all blocks before it.
+    """
+    def __init__(self, device):
+        self.device = device
+        self.stats = MemoryStats(device)
+        self.peak = 0
+
+    def __enter__(self):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+        self.start = self.stats.current()
+        if not self.stats.reset_peak():
+            self.start = self.stats.peak()
+        return self
+
+    def __exit__(self, *exc):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+        self.peak = max(self.stats.peak() - self.start, 0)
+        return False
+
+
+class BufferPool:
+    """Persistent tensors by name, reallocated only when the requested shape or dtype changes,
+    for the tensors of the same shapes computed in every training iteration. A buffer is
+    overwritten by the next user of its name, and a buffer saved for the backward pass must
+    not be reused before the backward pass ran.
+    """
+    def __init__(self):
+        self.buffers = {}
+        self.allocations = 0
+
+    def get(self, name, shape, dtype=torch.float32):
+        buf = self.buffers.get(name)
+        if buf is None or buf.shape != torch.Size(shape) or buf.dtype != dtype:
+            buf = torch.empty(shape, dtype=dtype)
+            self.buffers[name] = buf
+            self.allocations += 1
+        return buf
+
+
+# Timing
+class StageTimer:
+    """Wall time of named stages, summed per stage until reset(), and counters such as the
+    number of rays. Stages started inside another stage are recorded under 'parent/name', so
+    that e.g. the network passes of training and of refinement renders are kept apart, and the
+    iteration time is recorded by begin_step() and end_step() under 'step'. Disabled, stage()
+    returns a shared no-op context. On CUDA the device is synchronized at the stage boundaries
+    so that asynchronously launched kernels are attributed to the stage that launched them.
+
+    With memory tracking the peak memory allocated during each stage is recorded too (see
+    MemoryStats), until reset_memory(). A stage whose largest growth so far exceeds the memory
+    still available when it starts again is warned about, with the shapes passed to stage()
+    or begin() by it and the stages around it, and so is an out of memory error raised inside
+    a stage() block.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.synchronize = False
+        self.memory = None
+        self.memory_growth = {}
+        self._warned = set()
+        self._null = contextlib.nullcontext()
+        self._stack = []
+        self.reset()
+        self.reset_memory()
+
+    def enable(self, device, memory=False):
+        self.enabled = True
+        self.synchronize = device.type == 'cuda'
+        self.memory = MemoryStats(device) if memory else None
+
+    def stage(self, name, **shapes):
+        if not self.enabled:
+            return self._null
+        return self._timed(name, shapes)
+
+    @contextlib.contextmanager
+    def _timed(self, name, shapes):
+        self.begin(name, **shapes)
+        try:
+            yield
+        except (RuntimeError, MemoryError) as e:
+            # Reported by the innermost stage only
+            if self.memory is not None and is_out_of_memory(e) and not hasattr(e, 'stage'):
+                e.stage = self._stack[-1][0]
+                warnings.warn('Out of memory in stage {} ({})'.format(e.stage, self._describe_shapes()))
+            raise
+        finally:
+            self.end(name)
+
+    def _now(self):
+        if self.synchronize:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def _path(self, name):
+        return self._stack[-1][0] + '/' + name if len(self._stack) > 0 else name
+
+    def _describe_shapes(self):
+        shapes = {}
+        for entry in self._stack:
+            shapes.update(entry[4])
+        return ', '.join('{} {}'.format(k, list(v)) for k, v in shapes.items())
+
+    def begin(self, name, **shapes):
+        """Starts stage name, for blocks too long for a with statement. shapes are the shapes of
+        the tensors the stage works on, for the memory warnings."""
+        if not self.enabled:
+            return
+        path = self._path(name)
+        mem_start = 0
+        if self.memory is not None:
+            # The peak is restarted for the stage, the peak of the parent so far is kept
+            if len(self._stack) > 0:
+                self._stack[-1][3] = max(self._stack[-1][3], self.memory.peak())
+            else:
+                self._step_peak = max(self._step_peak, self.memory.peak())
+            mem_start = self.memory.current()
+            self.memory.reset_peak()
+        self._stack.append([path, None, mem_start, 0, shapes])
+        if self.memory is not None:
+            self._check_headroom(path)
+        self._stack[-1][1] = self._now()
+
+    def _check_headroom(self, path):
+        growth = self.memory_growth.get(path)
+        if growth is None or path in self._warned:
+            return
+        available = self.memory.available()
+        if growth > available:
+            self._warned.add(path)
+            warnings.warn('Stage {} allocated up to {:.0f} MB before, only {:.0f} MB are available: it may run out of memory ({})'.format(
+                path, growth / 2**20, available / 2**20, self._describe_shapes()))
+
+    def end(self, name):
+        if not self.enabled or len(self._stack) == 0:
+            return
+        path, t0, mem_start, mem_peak, _ = self._stack.pop()
+        self.times[path] += self._now() - t0
+        self.calls[path] += 1
+        if self.memory is not None:
+            peak = max(mem_peak, self.memory.peak())
+            self.peak_memory[path] = max(self.peak_memory[path], peak)
+            self.memory_growth[path] = max(self.memory_growth.get(path, 0), peak - mem_start)
+            if len(self._stack) > 0:
+                self._stack[-1][3] = max(self._stack[-1][3], peak)
+            else:
+                self._step_peak = max(self._step_peak, peak)
+
+    def begin_step(self):
+        if self.enabled:
+            self._step_t0 = self._now()
+            if self.memory is not None:
+                self.memory.reset_peak()
+                self._step_peak = 0
+
+    def end_step(self):
+        if self.enabled:
+            self.times['step'] += self._now() - self._step_t0
+            self.calls['step'] += 1
+            if self.memory is not None:
+                self.peak_memory['step'] = max(self.peak_memory['step'], self._step_peak, self.memory.peak())
+
+    def count(self, name, value):
+        """Adds value (a number or a tensor, read at reset()) to counter name of the current stage."""
+        if self.enabled:
+            name = self._path(name)
+            self.counters[name] = self.counters[name] + value
+
+    def reset(self):
+        """Returns the times in seconds, call counts and counters since the last reset."""
+        snapshot = (dict(getattr(self, 'times', {})), dict(getattr(self, 'calls', {})),
+                    {k: float(v) for k, v in getattr(self, 'counters', {}).items()})
+        self.times = collections.defaultdict(float)
+        self.calls = collections.defaultdict(int)
+        self.counters = collections.defaultdict(int)
+        return snapshot
+
+    def reset_memory(self):
+        """Returns the peak memory in bytes of each stage since the last reset."""
+        snapshot = dict(getattr(self, 'peak_memory', {}))
+        self.peak_memory = collections.defaultdict(int)
+        self._step_peak = 0
+        return snapshot
+
+
+stage_timer = StageTimer()
+
+
+# Profiling
+_profiling = False
+
+
+def profiled(name):
+    """Decorator labelling the calls of a function with record_function(name) while a
+    StepProfiler captures, and adding only a flag test otherwise."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _profiling:
+                return fn(*args, **kwargs)
+            with torch.profiler.record_function(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class StepProfiler:
+    """Captures the steps 'start:end' (end excluded) of a loop with torch.profiler, step(i) is
+    called at the beginning of every step. The Chrome trace and a table of the top_n operators
+    are written to out_dir/profile_<start>_<end>/ when the window closes.
+    """
+    def __init__(self, steps, out_dir, top_n=30):
+        self.window = tuple(int(k) for k in steps.split(':')) if steps else None
+        self.out_dir = out_dir
+        self.top_n = top_n
+        self.prof = None
+        self.done = False
+
+    def step(self, i):
+        if self.window is None or self.done:
+            return
+        start, end = self.window
+        if self.prof is None and start <= i < end:
+            self._start()
+        elif self.prof is not None and i >= end:
+            self.stop()
+
+    def _start(self):
+        global _profiling
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self.prof = torch.profiler.profile(activities=activities, record_shapes=True)
+        self.prof.__enter__()
+        _profiling = True
+
+    def stop(self):
+        """Closes the window if it is open and exports the results."""
+        global _profiling
+        if self.prof is None:
+            return
+        _profiling = False
+        self.prof.__exit__(None, None, None)
+        save_dir = os.path.join(self.out_dir, 'profile_{}_{}'.format(*self.window))
+        os.makedirs(save_dir, exist_ok=True)
+        self.prof.export_chrome_trace(os.path.join(save_dir, 'trace.json'))
+        sort_by = 'self_cuda_time_total' if torch.cuda.is_available() else 'self_cpu_time_total'
+        table = self.prof.key_averages().table(sort_by=sort_by, row_limit=self.top_n)
+        with open(os.path.join(save_dir, 'ops.txt'), 'w') as f:
+            f.write(table)
+        print('Profile of steps {}:{} saved at {}'.format(self.window[0], self.window[1], save_dir))
+        self.prof = None
+        self.done = True
+
+
+class BackgroundWriter:
+    """Runs file writes on a worker thread so that training does not wait for image
+    encoding and disk. Jobs run in submission order, at most 'max_pending' are queued.
+    An exception raised by a job is re-raised by the next submit() or wait().
+    """
+    def __init__(self, max_pending=8):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.pending = collections.deque()
+        self.max_pending = max_pending
+
+    def _collect(self, block=False):
+        while self.pending and (block or self.pending[0].done()):
+            self.pending.popleft().result()
+            block = False
+
+    def submit(self, fn, *args, **kwargs):
+        self._collect(block=len(self.pending) >= self.max_pending)
+        self.pending.append(self.executor.submit(fn, *args, **kwargs))
+
+    def wait(self):
+        while self.pending:
+            self.pending.popleft().result()
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
+
+
+def to_cpu(obj):
+    """Copies the tensors of a nested dict/list/tuple (e.g. a state_dict) to CPU, so that
+    the copy is not changed by further training."""
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        out = type(obj)((k, to_cpu(v)) for k, v in obj.items())
+        if hasattr(obj, '_metadata'):
+            out._metadata = obj._metadata
+        return out
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return obj
+
+
+def nbytes(obj):
+    """Total size in bytes of the tensors and arrays of a nested dict/list/tuple."""
+    if torch.is_tensor(obj):
+        return obj.numel() * obj.element_size()
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, dict):
+        return sum(nbytes(v) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return sum(nbytes(v) for v in obj)
+    return 0
+
+
+def load_checkpoint(path, keys=None):
+    """Loads the entries 'keys' (all if None) of checkpoint 'path' to CPU, whatever device it
+    was saved from. The file is memory-mapped, so tensors of entries that are not used are
+    never read from disk. Move the results to the device with load_state_dict or .to().
+    """
+    try:
+        ckpt = torch.load(path, map_location='cpu', mmap=True, weights_only=True)
+    except pickle.UnpicklingError:
+        # Checkpoints from before CheckpointWriter hold the maps as numpy arrays
+        ckpt = torch.load(path, map_location='cpu', mmap=True, weights_only=False)
+    except TypeError:
+        # mmap needs torch >= 2.1, older versions read the whole file
+        ckpt = torch.load(path, map_location='cpu')
+    if keys is not None:
+        ckpt = {k: ckpt[k] for k in keys if k in ckpt}
+    return ckpt
+
+
+class CheckpointWriter:
+    """Writes the training checkpoints '{step:06d}.tar' of 'ckpt_dir' on a background thread.
+
+    save() copies the state to CPU on the calling thread. Files are written to a temporary
+    name and renamed, so an interrupted write never leaves a truncated checkpoint. Only the
+    last 'keep_last' checkpoints (all if 0) and those at multiples of 'milestone' are kept.
+    Large per-frame maps are stored as separate compressed '{name}_{step:06d}.npz' files,
+    written again only when their version changes, and referenced by file name in the
+    checkpoint's 'maps' entry.
+
+    The index 'checkpoints.json' lists the kept checkpoints in order of steps with their
+    entries and sizes, so that readers find the latest one without listing the directory
+    and can tell which entries it has without loading it (see load_checkpoint).
+    """
+    ckpt_re = re.compile(r'^(\d+)\.tar$')
+    map_re = re.compile(r'^([a-z_]+)_(\d+)\.npz$')
+    index_name = 'checkpoints.json'
+
+    def __init__(self, ckpt_dir, keep_last=0, milestone=0, writer=None):
+        self.ckpt_dir = ckpt_dir
+        self.keep_last = keep_last
+        self.milestone = milestone
+        self.writer = writer if writer is not None else BackgroundWriter()
+        self.map_files = {}  # name -> (version, file name)
+        index = CheckpointWriter.read_index(ckpt_dir)
+        self.index = index['checkpoints'] if index is not None else []
+
+    @staticmethod
+    def read_index(ckpt_dir):
+        """The index of the checkpoints in ckpt_dir, None if there is none."""
+        path = os.path.join(ckpt_dir, CheckpointWriter.index_name)
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def save(self, step, state, maps=None):
+        """state: dict of checkpoint entries. maps: dict name -> (array, version), a map is
+        written if its version differs from the one last written. Returns the checkpoint path."""
+        state = to_cpu(state)
+        state['maps'] = {}
+        for name, (array, version) in (maps or {}).items():
+            if array is None:
+                continue
+            if name not in self.map_files or self.map_files[name][0] != version:
+                file_name = '{}_{:06d}.npz'.format(name, step)
+                array = to_cpu(array) if torch.is_tensor(array) else np.array(array, copy=True)
+                self.writer.submit(self._write_map, file_name, array)
+                self.map_files[name] = (version, file_name)
+            state['maps'][name] = self.map_files[name][1]
+
+        file_name = '{:06d}.tar'.format(step)
+        entry = {
+            'file': file_name,
+            'step': step,
+            'global_step': state.get('global_step', step),
+            'entries': {k: nbytes(v) for k, v in state.items() if k != 'maps'},
+            'maps': state['maps'],
+        }
+        self.writer.submit(self._write_ckpt, file_name, state, entry)
+        return os.path.join(self.ckpt_dir, file_name)
+
+    def _write_map(self, file_name, array):
+        path = os.path.join(self.ckpt_dir, file_name)
+        with open(path + '.tmp', 'wb') as f:
+            np.savez_compressed(f, arr=array.numpy() if torch.is_tensor(array) else array)
+        os.replace(path + '.tmp', path)
+
+    def _write_ckpt(self, file_name, state, entry):
+        path = os.path.join(self.ckpt_dir, file_name)
+        torch.save(state, path + '.tmp')
+        os.replace(path + '.tmp', path)
+        self._rotate()
+
+        self.index = sorted([e for e in self.index if e['file'] != file_name] + [entry], key=lambda e: e['step'])
+        self.index = [e for e in self.index if os.path.exists(os.path.join(self.ckpt_dir, e['file']))]
+        path = os.path.join(self.ckpt_dir, self.index_name)
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'latest': self.index[-1]['file'], 'checkpoints': self.index}, f, indent=1)
+        os.replace(path + '.tmp', path)
+
+    def _rotate(self):
+        files = os.listdir(self.ckpt_dir)
+        steps = sorted(int(m.group(1)) for m in map(self.ckpt_re.match, files) if m)
+        keep = set(steps[-self.keep_last:] if self.keep_last > 0 else steps)
+        keep |= set(s for s in steps if self.milestone > 0 and s % self.milestone == 0)
+        for s in steps:
+            if s not in keep:
+                os.remove(os.path.join(self.ckpt_dir, '{:06d}.tar'.format(s)))
+
+        # A checkpoint references the latest map file written at or before its step
+        map_steps = collections.defaultdict(list)
+        for m in map(self.map_re.match, files):
+            if m:
+                map_steps[m.group(1)].append(int(m.group(2)))
+        for name, written in map_steps.items():
+            written = sorted(written)
+            needed = set([written[-1]] + [max(w for w in written if w <= s) for s in keep if s >= written[0]])
+            for w in written:
+                if w not in needed:
+                    os.remove(os.path.join(self.ckpt_dir, '{}_{:06d}.npz'.format(name, w)))
+
+
 # Positional encoding (section 5.1)
 class Embedder:
     def __init__(self, **kwargs):
@@ -20,11 +559,9 @@ class Embedder:
         self.create_embedding_fn()
         
     def create_embedding_fn(self):
-        embed_fns = []
         d = self.kwargs['input_dims']
         out_dim = 0
         if self.kwargs['include_input']:
-            embed_fns.append(lambda x : x)
             out_dim += d
             
         max_freq = self.kwargs['max_freq_log2']
@@ -34,17 +571,44 @@ class Embedder:
             freq_bands = 2.**torch.linspace(0., max_freq, steps=N_freqs)
         else:
             freq_bands = torch.linspace(2.**0., 2.**max_freq, steps=N_freqs)
-            
-        for freq in freq_bands:
-            for p_fn in self.kwargs['periodic_fns']:
-                embed_fns.append(lambda x, p_fn=p_fn, freq=freq : p_fn(x * freq))
-                out_dim += d
+        out_dim += N_freqs * len(self.kwargs['periodic_fns']) * d
                     
-        self.embed_fns = embed_fns
+        self.freq_bands = freq_bands
         self.out_dim = out_dim
-        
+        self._alpha = None
+
+    @property
+    def alpha(self):
+        """Bandwidth of the encoding in frequency bands, None passes all bands. Kept in a tensor
+        that compiled graphs take as an input rather than being specialized on its value."""
+        return self._alpha
+
+    @alpha.setter
+    def alpha(self, alpha):
+        if alpha is None:
+            self._alpha = None
+        elif self._alpha is None:
+            self._alpha = torch.tensor(float(alpha), device=self.freq_bands.device)
+        else:
+            self._alpha.fill_(alpha)
+
+    def band_weights(self):
+        """Window weight of each frequency band: 1 for the bands below alpha, 0 above alpha + 1 and
+        a cosine ramp in between (Park et al., Nerfies), the input itself is never attenuated."""
+        k = torch.arange(len(self.freq_bands), dtype=self.freq_bands.dtype, device=self.freq_bands.device)
+        return (1. - torch.cos(math.pi * torch.clamp(self.alpha - k, 0., 1.))) / 2.
+
     def embed(self, inputs):
-        return torch.cat([fn(inputs) for fn in self.embed_fns], -1)
+        # All bands in one product and one call per periodic fn, in the order
+        # [x, sin(f0 x), cos(f0 x), sin(f1 x), ...] of the per-band fns of the original NeRF
+        x = inputs[..., None, :] * self.freq_bands.to(inputs.device)[:, None]  # [..., N_freqs, d]
+        bands = torch.stack([p_fn(x) for p_fn in self.kwargs['periodic_fns']], -2)  # [..., N_freqs, N_fns, d]
+        if self.alpha is not None:
+            bands = bands * self.band_weights().to(inputs.device)[:, None, None]
+        bands = bands.reshape(list(inputs.shape[:-1]) + [-1])
+        if self.kwargs['include_input']:
+            return torch.cat([inputs, bands], -1)
+        return bands
 
 
 def get_embedder(multires, input_dims, i=0):
@@ -61,10 +625,89 @@ def get_embedder(multires, input_dims, i=0):
     }
     
     embedder_obj = Embedder(**embed_kwargs)
-    embed = lambda x, eo=embedder_obj : eo.embed(x)
+    # The bound method keeps the Embedder reachable as embed.__self__, to anneal its bandwidth
+    embed = embedder_obj.embed
     return embed, embedder_obj.out_dim
 
 
+def coarse_to_fine_factor(i, c2f_iters):
+    """Downsampling factor of the training images at iteration i: halved at each of the
+    iterations c2f_iters, full resolution after the last one."""
+    return 2 ** sum(1 for it in c2f_iters if i < it)
+
+
+def coarse_to_fine_bandwidth(i, c2f_iters, multires):
+    """Positional encoding bandwidth (in frequency bands) at iteration i, raised linearly from the
+    bands resolvable at the initial downsampling factor to all multires bands at the last of c2f_iters."""
+    alpha0 = multires - math.log2(coarse_to_fine_factor(0, c2f_iters))
+    return alpha0 + (multires - alpha0) * min(i / float(max(c2f_iters)), 1.)
+
+
+def downsample(x, factor):
+    """Area downsampling of an image [H, W] or [H, W, C] by an integer factor, the pixels at the
+    border that do not fill a factor x factor block are dropped."""
+    if factor == 1:
+        return x
+    y = x[..., None] if x.dim() == 2 else x
+    y = F.avg_pool2d(y.permute(2, 0, 1)[None].float(), factor)[0].permute(1, 2, 0)
+    return y[..., 0] if x.dim() == 2 else y
+
+
+def parse_cpu_list(cpus):
+    """Core ids of a list like '0-3,8,10-11'."""
+    cores = set()
+    for part in cpus.split(','):
+        lo, _, hi = part.partition('-')
+        cores.update(range(int(lo), int(hi if hi else lo) + 1))
+    return cores
+
+
+def set_default_device(device):
+    """New tensors are created on 'device' unless a device is given."""
+    if hasattr(torch, 'set_default_device'):
+        torch.set_default_device(device)
+    elif torch.device(device).type == 'cuda':
+        torch.set_default_tensor_type('torch.cuda.FloatTensor')  # torch < 2.0
+
+# Distributed training
+def init_distributed(backend='gloo'):
+    """Joins the process group described by the environment variables of run_endonerf_ddp.py
+    or torchrun (RANK, WORLD_SIZE, MASTER_ADDR, MASTER_PORT). Returns (rank, world_size),
+    (0, 1) if not launched distributed."""
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    if world_size <= 1:
+        return 0, 1
+    if not dist.is_initialized():
+        dist.init_process_group(backend, rank=int(os.environ['RANK']), world_size=world_size)
+    return dist.get_rank(), dist.get_world_size()
+
+
+def all_reduce_grads(params):
+    """Averages the gradients of params over all ranks, in one flat all-reduce."""
+    world_size = dist.get_world_size()
+    for p in params:
+        if p.grad is None:
+            p.grad = torch.zeros_like(p)
+    flat = torch.cat([p.grad.reshape(-1) for p in params])
+    dist.all_reduce(flat)
+    flat /= world_size
+    offset = 0
+    for p in params:
+        p.grad.copy_(flat[offset:offset + p.numel()].view_as(p))
+        offset += p.numel()
+
+
+def broadcast_tensors(tensors, src=0):
+    """Overwrites tensors in place with those of rank src."""
+    for t in tensors:
+        if t.dtype == torch.bool:
+            u = t.to(torch.uint8)
+            dist.broadcast(u, src)
+            t.copy_(u.bool())
+        else:
+            dist.broadcast(t, src)
+
+
 # Model
 class DirectTemporalNeRF(nn.Module):
     def __init__(self, D=8, W=256, input_ch=3, input_ch_views=3, input_ch_time=1, output_ch=4, skips=[4],
@@ -85,6 +728,7 @@ class DirectTemporalNeRF(nn.Module):
         self._occ = NeRFOriginal(D=D, W=W, input_ch=input_ch, input_ch_views=input_ch_views,
                                  input_ch_time=input_ch_time, output_ch=output_ch, skips=skips,
                                  use_viewdirs=use_viewdirs, memory=memory, embed_fn=embed_fn, output_color_ch=3)
+        self.output_ch = self._occ.output_ch
         self._time, self._time_out = self.create_time_net()
 
     def create_time_net(self):
@@ -112,13 +756,29 @@ class DirectTemporalNeRF(nn.Module):
 
         return net_final(h)
 
+    def query_deformation(self, input_pts, ts):
+        """Position delta of the embedded points at the embedded times ts, without evaluating
+        the canonical network. Unlike forward, every point may have its own time.
+        """
+        t = ts[0]
+        dx = self.query_time(input_pts, t, self._time, self._time_out)
+        if self.zero_canonical:
+            dx = dx * (t[:, :1] != 0.)
+        return dx
+
     def forward(self, x, ts):
-        input_pts, input_views = torch.split(x, [self.input_ch, self.input_ch_views], dim=-1)
         t = ts[0]
 
         assert len(torch.unique(t[:, :1])) == 1, "Only accepts all points from same time"
         cur_time = t[0, 0]
-        if cur_time == 0. and self.zero_canonical:
+        return self.forward_at(x, t, bool(cur_time == 0.) and self.zero_canonical)
+
+    def forward_at(self, x, t, canonical):
+        """forward of points at a single time t, in canonical space without querying the
+        deformation if canonical. The shortcut is a Python bool so that compiled graphs are
+        specialized on it, see compile_forward."""
+        input_pts, input_views = torch.split(x, [self.input_ch, self.input_ch_views], dim=-1)
+        if canonical:
             dx = torch.zeros_like(input_pts[:, :3])
         else:
             dx = self.query_time(input_pts, t, self._time, self._time_out)
@@ -146,13 +806,18 @@ class TNeRF(nn.Module):
         self._occ = NeRFOriginal(D=D, W=W, input_ch=input_ch + input_ch_time, input_ch_views=input_ch_views,
                                  input_ch_time=input_ch_time, output_ch=output_ch, skips=skips,
                                  use_viewdirs=use_viewdirs, memory=memory, embed_fn=embed_fn, output_color_ch=3)
+        self.output_ch = self._occ.output_ch
 
     def forward(self, x, ts):
-        input_pts, input_views = torch.split(x, [self.input_ch, self.input_ch_views], dim=-1)
         t = ts[0]
 
         assert len(torch.unique(t[:, :1])) == 1, "Only accepts all points from same time"
 
+        return self.forward_at(x, t, False)
+
+    def forward_at(self, x, t, canonical):
+        """See DirectTemporalNeRF.forward_at, there is no canonical shortcut."""
+        input_pts, input_views = torch.split(x, [self.input_ch, self.input_ch_views], dim=-1)
         return self._occ(torch.cat([input_pts, t, input_views], dim=-1), t)
 
 class RecurrentTemporalNeRF(nn.Module):
@@ -177,6 +842,7 @@ class RecurrentTemporalNeRF(nn.Module):
         self._occ = NeRFOriginal(D=D, W=W, input_ch=input_ch, input_ch_views=input_ch_views,
                                  input_ch_time=input_ch_time, output_ch=output_ch, skips=skips,
                                  use_viewdirs=use_viewdirs, memory=memory, embed_fn=embed_fn, output_color_ch=3)
+        self.output_ch = self._occ.output_ch
         self._time_hidden, self._time_gru, self._time_out = self.create_time_net()
 
     def create_time_net(self):
@@ -207,31 +873,48 @@ class RecurrentTemporalNeRF(nn.Module):
 
         return h
 
+    def query_time(self, input_pts, t):
+        time_hidden_window = []
+        for i in range(1, self.time_window_size):
+            time_hidden_window.append(
+                self.query_time_hidden(
+                    input_pts,
+                    self.embedtime_fn(torch.maximum(torch.zeros_like(t[:, :1]), t[:, :1] - i * self.time_interval)),
+                    self._time_hidden
+                )
+            )
+
+        time_hidden = torch.stack(time_hidden_window)
+        curr_time_hidden = self.query_time_hidden(input_pts, t, self._time_hidden).unsqueeze(0)
+        out_h, _ = self._time_gru(curr_time_hidden, time_hidden)
+        out_h = out_h.squeeze(0)
+
+        return self._time_out(out_h)
+
+    def query_deformation(self, input_pts, ts):
+        """Position delta of the embedded points at the embedded times ts, without evaluating
+        the canonical network. Unlike forward, every point may have its own time.
+        """
+        t = ts[0]
+        dx = self.query_time(input_pts, t)
+        if self.zero_canonical:
+            dx = dx * (t[:, :1] != 0.)
+        return dx
+
     def forward(self, x, ts):
-        input_pts, input_views = torch.split(x, [self.input_ch, self.input_ch_views], dim=-1)
         t = ts[0]
 
         assert len(torch.unique(t[:, :1])) == 1, "Only accepts all points from same time"
         cur_time = t[0, 0]
-        if cur_time == 0. and self.zero_canonical:
+        return self.forward_at(x, t, bool(cur_time == 0.) and self.zero_canonical)
+
+    def forward_at(self, x, t, canonical):
+        """See DirectTemporalNeRF.forward_at."""
+        input_pts, input_views = torch.split(x, [self.input_ch, self.input_ch_views], dim=-1)
+        if canonical:
             dx = torch.zeros_like(input_pts[:, :3])
         else:
-            time_hidden_window = []
-            for i in range(1, self.time_window_size):
-                time_hidden_window.append(
-                    self.query_time_hidden(
-                        input_pts,
-                        self.embedtime_fn(torch.maximum(torch.zeros_like(t[:, :1]), t[:, :1] - i * self.time_interval)),
-                        self._time_hidden
-                    )
-                )
-            
-            time_hidden = torch.stack(time_hidden_window)
-            curr_time_hidden = self.query_time_hidden(input_pts, t, self._time_hidden).unsqueeze(0)
-            out_h, _ = self._time_gru(curr_time_hidden, time_hidden)
-            out_h = out_h.squeeze(0)
-
-            dx = self._time_out(out_h)
+            dx = self.query_time(input_pts, t)
             input_pts_orig = input_pts[:, :3]
             input_pts = self.embed_fn(input_pts_orig + dx)
         out, _ = self._occ(torch.cat([input_pts, input_views], dim=-1), t)
@@ -297,10 +980,16 @@ class NeRFOriginal(nn.Module):
             self.feature_linear = nn.Linear(W, W)
             self.alpha_linear = nn.Linear(W, 1)
             self.rgb_linear = nn.Linear(W//2, output_color_ch)
+            self.output_ch = output_color_ch + 1
         else:
             self.output_linear = nn.Linear(W, output_ch)
+            self.output_ch = output_ch
 
     def forward(self, x, ts):
+        return self.forward_at(x, ts[0], False)
+
+    def forward_at(self, x, t, canonical):
+        """See DirectTemporalNeRF.forward_at, the time is not used."""
         input_pts, input_views = torch.split(x, [self.input_ch, self.input_ch_views], dim=-1)
         h = input_pts
         for i, l in enumerate(self.pts_linears):
@@ -355,6 +1044,287 @@ class NeRFOriginal(nn.Module):
         self.alpha_linear.bias.data = torch.from_numpy(np.transpose(weights[idx_alpha_linear+1]))
 
 
+
+# Compiled networks
+class _CanonicalForward(nn.Module):
+    """model.forward_at with a fixed canonical flag, the module traced by TracedForward."""
+    def __init__(self, model, canonical):
+        super(_CanonicalForward, self).__init__()
+        self.model = model
+        self.canonical = canonical
+
+    def forward(self, x, t):
+        return type(self.model).forward_at(self.model, x, t, self.canonical)
+
+
+class TracedForward:
+    """forward_at of a model traced with torch.jit.trace, the TorchScript fallback of torch.compile
+    for torch < 2.0. Traces are shape specialized, one is recorded per canonical flag, input shape
+    and grad mode."""
+    def __init__(self, model):
+        self.model = model
+        self.graphs = {}
+
+    def __call__(self, x, t, canonical):
+        embedder = getattr(getattr(self.model, 'embed_fn', None), '__self__', None)
+        if embedder is not None and embedder.alpha is not None:
+            # A trace would freeze the band window, coarse-to-fine iterations run eagerly
+            return type(self.model).forward_at(self.model, x, t, canonical)
+        key = (canonical, tuple(x.shape), x.dtype, torch.is_grad_enabled())
+        if key not in self.graphs:
+            self.graphs[key] = torch.jit.trace(_CanonicalForward(self.model, canonical), (x, t), check_trace=False)
+        return self.graphs[key](x, t)
+
+
+COMPILE_METHODS = ['none', 'auto', 'compile', 'torchscript']
+
+
+def compile_forward(model, method='auto', mode='default'):
+    """Replaces model.forward_at, the network evaluation of a chunk of points at one time, by
+    compiled graphs: torch.compile with 'mode' ('reduce-overhead' captures CUDA graphs), or
+    torch.jit traces ('torchscript'), 'auto' for torch.compile where available. The eager
+    checks of forward (single time, canonical shortcut) stay outside of the graphs, which are
+    specialized on the canonical flag instead of breaking on the value of the time.
+    If compiling or running a graph fails, a warning is printed and the model runs eagerly
+    from then on. Returns the method used.
+    """
+    if method == 'auto':
+        method = 'compile' if hasattr(torch, 'compile') else 'torchscript'
+    if method == 'compile':
+        # A graph per canonical flag, grad mode and coarse-to-fine state (with the number of points
+        # dynamic once it varied), more than the default limit of 8 before dynamo gives up
+        config = torch._dynamo.config
+        limit = 'recompile_limit' if hasattr(config, 'recompile_limit') else 'cache_size_limit'
+        setattr(config, limit, max(getattr(config, limit), 32))
+        compiled = torch.compile(model.forward_at, mode=None if mode == 'default' else mode)
+    elif method == 'torchscript':
+        compiled = TracedForward(model)
+    else:
+        raise ValueError("Compile method %s not recognized." % method)
+    eager = model.forward_at
+
+    def forward_at(x, t, canonical):
+        nonlocal compiled
+        if compiled is not None:
+            try:
+                return compiled(x, t, canonical)
+            except Exception as e:
+                if is_out_of_memory(e):
+                    raise
+                warnings.warn('Compiled {} failed, running it eagerly: {}'.format(type(model).__name__, e))
+                compiled = None
+        return eager(x, t, canonical)
+
+    model.forward_at = forward_at
+    return method
+
+# Occupancy grid for empty-space skipping
+class OccupancyGrid:
+    """Binary occupancy of the canonical space, used by render_rays to skip empty samples.
+
+    Densities are refreshed periodically from the canonical network (see `update`) and
+    decayed so that cells can become empty again. Occupied cells are dilated by the
+    largest deformation observed during training, which makes the grid a conservative
+    test for observation-space samples without evaluating the deformation network.
+    Points outside the bounding box are always treated as occupied.
+    """
+    def __init__(self, bbox_min, bbox_max, resolution=64, alpha_thresh=0.01, decay=0.95):
+        self.bbox_min = torch.Tensor(bbox_min)
+        self.bbox_max = torch.Tensor(bbox_max)
+        self.resolution = resolution
+        self.alpha_thresh = alpha_thresh
+        self.decay = decay
+        self.cell_size = (self.bbox_max - self.bbox_min) / resolution
+        self.density = torch.zeros([resolution] * 3)                   # (z, y, x) order
+        self.occupied = torch.ones([resolution] * 3, dtype=torch.bool)  # everything is occupied until the first update
+        self.max_deform = 0.
+
+    def to(self, device):
+        for k in ['bbox_min', 'bbox_max', 'cell_size', 'density', 'occupied']:
+            setattr(self, k, getattr(self, k).to(device))
+        return self
+
+    def state_dict(self):
+        return {'density': self.density, 'occupied': self.occupied, 'max_deform': self.max_deform}
+
+    def load_state_dict(self, state_dict):
+        self.density = state_dict['density'].to(self.density.device)
+        self.occupied = state_dict['occupied'].to(self.occupied.device)
+        self.max_deform = state_dict['max_deform']
+
+    def observe_deformation(self, position_delta):
+        self.max_deform = max(self.max_deform, torch.abs(position_delta).max().item())
+
+    def update(self, density_fn, chunk=1024*64):
+        """Refresh from `density_fn`, mapping canonical points [N, 3] to non-negative densities [N]."""
+        R = self.resolution
+        inds = torch.stack(torch.meshgrid(*[torch.arange(R)] * 3, indexing='ij'), -1).reshape(-1, 3).flip(-1)  # (x, y, z)
+        pts = self.bbox_min + (inds + torch.rand(inds.shape)) * self.cell_size  # jittered within each cell
+
+        sigma = torch.cat([density_fn(pts[i:i+chunk]) for i in range(0, pts.shape[0], chunk)], 0)
+        self.density = torch.maximum(self.density * self.decay, sigma.reshape([R] * 3))
+
+        alpha = 1. - torch.exp(-self.density * torch.norm(self.cell_size))
+        occupied = (alpha > self.alpha_thresh).float()[None, None]
+
+        self.max_deform *= self.decay
+        margin = min(int(math.ceil(self.max_deform / self.cell_size.min().item())) + 1, R // 2)
+        self.occupied = F.max_pool3d(occupied, 2 * margin + 1, stride=1, padding=margin)[0, 0] > 0
+
+    def query(self, pts):
+        """Occupancy of points [..., 3] in observation space."""
+        x = torch.floor((pts - self.bbox_min) / self.cell_size).long()
+        inside = ((x >= 0) & (x < self.resolution)).all(-1)
+        x = x.clamp(0, self.resolution - 1)
+        return self.occupied[x[..., 2], x[..., 1], x[..., 0]] | ~inside
+
+
+# Baked sparse voxel grid
+SH_C0 = 0.28209479177387814
+SH_C1 = 0.4886025119029199
+SH_C2 = [1.0925484305920792, -1.0925484305920792, 0.31539156525252005, -1.0925484305920792, 0.5462742152960396]
+
+
+def sh_basis(dirs, degree):
+    """Real spherical harmonics basis up to degree 2.
+    dirs: [N, 3] unit vectors. Returns [N, (degree+1)**2].
+    """
+    x, y, z = dirs[..., 0], dirs[..., 1], dirs[..., 2]
+    basis = [SH_C0 * torch.ones_like(x)]
+    if degree >= 1:
+        basis += [-SH_C1 * y, SH_C1 * z, -SH_C1 * x]
+    if degree >= 2:
+        basis += [SH_C2[0] * x * y, SH_C2[1] * y * z, SH_C2[2] * (2 * z * z - x * x - y * y),
+                  SH_C2[3] * x * z, SH_C2[4] * (x * x - y * y)]
+    return torch.stack(basis, -1)
+
+
+class BakedGrid:
+    """Sparse voxel grid baked from a trained temporal NeRF (see bake_endonerf.py).
+
+    The canonical space is stored as a dense index volume pointing into compact
+    arrays of raw density and SH colour coefficients (-1 marks pruned voxels).
+    Per-frame deformation is a dense, coarser grid of position deltas.
+    `query` has the same signature as `network_query_fn`, so `render_rays` can
+    render a baked scene by swapping the query function; passing the grid as
+    `baked` to `render_rays` renders it natively in a single uniform pass that
+    only shades samples in occupied cells (see `query_occupied`).
+    """
+    def __init__(self, bbox_min, bbox_max, index, density, sh, sh_degree, deform, times, chunk=1024*64):
+        self.bbox_min = bbox_min
+        self.bbox_max = bbox_max
+        self.index = index          # [R, R, R] long, (z, y, x) order
+        self.resolution = index.shape[0]
+        self.sh_degree = sh_degree
+        # raw sigma followed by SH coefficients; the extra zero row is gathered for pruned voxels
+        feats = torch.cat([density[:, None], sh.reshape(sh.shape[0], -1)], -1)
+        self.feats = torch.cat([feats, torch.zeros_like(feats[:1])], 0)
+        self.deform = deform        # [F, 3, Rd, Rd, Rd]
+        self.times = times          # [F]
+        self.chunk = chunk
+        # (x, y, z) offsets of the 8 trilinear corners of a cell
+        self.offsets = torch.tensor([[0,0,0], [1,0,0], [0,1,0], [1,1,0], [0,0,1], [1,0,1], [0,1,1], [1,1,1]], device=index.device)
+
+    @staticmethod
+    def load(path, device, chunk=1024*64):
+        try:
+            ckpt = torch.load(path, map_location=device, weights_only=True)
+        except TypeError:
+            ckpt = torch.load(path, map_location=device)  # weights_only needs torch >= 1.13
+        return BakedGrid(ckpt['bbox_min'].float(), ckpt['bbox_max'].float(), ckpt['index'].long(),
+                         ckpt['density'].float(), ckpt['sh'].float(), ckpt['sh_degree'],
+                         ckpt['deform'].float(), ckpt['times'].float(), chunk=chunk)
+
+    def query_deformation(self, pts, t):
+        """Position delta at observation-space `pts` [N, 3] for scalar time `t`."""
+        grid = 2. * (pts - self.bbox_min) / (self.bbox_max - self.bbox_min) - 1.
+        grid = grid.reshape(1, -1, 1, 1, 3)
+
+        i1 = int(torch.searchsorted(self.times, t.reshape(1)).clamp(1, self.times.shape[0] - 1))
+        i0 = i1 - 1
+        w = ((t - self.times[i0]) / (self.times[i1] - self.times[i0] + 1e-10)).clamp(0., 1.)
+        deform = (1. - w) * self.deform[i0] + w * self.deform[i1] if self.times.shape[0] > 1 else self.deform[0]
+
+        dx = F.grid_sample(deform[None], grid, mode='bilinear', padding_mode='border', align_corners=True)
+        return dx.reshape(3, -1).t()
+
+    def corners(self, pts):
+        """Rows of `feats` [N, 8] at the trilinear corners of canonical `pts` [N, 3] and their
+        weights [N, 8]. Pruned corners and points outside the grid get row -1, the zero row."""
+        R = self.resolution
+        x = (pts - self.bbox_min) / (self.bbox_max - self.bbox_min) * (R - 1)
+        inside = ((x >= 0) & (x <= R - 1)).all(-1)
+        x = x.clamp(0, R - 1)
+        x0 = torch.floor(x).long().clamp(max=R - 2)
+        f = x - x0
+
+        ix = x0[:, None] + self.offsets  # [N, 8, 3]
+        rows = torch.where(inside[:, None], self.index[ix[..., 2], ix[..., 1], ix[..., 0]], -1)
+        weights = torch.prod(torch.where(self.offsets.bool(), f[:, None], 1. - f[:, None]), -1)
+        return rows, weights
+
+    def shade(self, rows, weights, dirs):
+        """Raw outputs [N, 4] interpolated from the corner rows and weights of `corners`."""
+        feats = torch.einsum('nk,nkc->nc', weights, self.feats[rows])
+        sigma = feats[:, :1]
+        sh = feats[:, 1:].reshape(-1, 3, (self.sh_degree + 1) ** 2)
+        if dirs is None:
+            rgb = sh[..., 0]
+        else:
+            rgb = torch.sum(sh * sh_basis(dirs, self.sh_degree)[:, None], -1)
+        return torch.cat([rgb, sigma], -1)
+
+    def query_canonical(self, pts, dirs):
+        """Trilinearly interpolated raw outputs [N, 4] at canonical `pts` [N, 3]."""
+        rows, weights = self.corners(pts)
+        return self.shade(rows, weights, dirs)
+
+    def query_occupied(self, pts, dirs, t):
+        """Raw outputs [N, 4] at observation-space `pts` [N, 3] for scalar time `t`, only
+        interpolated for samples with an occupied corner; the others get zeros, i.e. no density.
+        Returns the raw outputs and the occupancy [N] of the samples."""
+        raw = torch.zeros(pts.shape[0], 4, device=pts.device)
+        occupied = torch.zeros(pts.shape[0], dtype=torch.bool, device=pts.device)
+        for i in range(0, pts.shape[0], self.chunk):
+            p = pts[i:i+self.chunk]
+            rows, weights = self.corners(p + self.query_deformation(p, t))
+            occ = (rows >= 0).any(-1)
+            dirs_occ = dirs[i:i+self.chunk][occ] if dirs is not None else None
+            raw[i:i+self.chunk][occ] = self.shade(rows[occ], weights[occ], dirs_occ)
+            occupied[i:i+self.chunk] = occ
+        return raw, occupied
+
+    def query(self, inputs, viewdirs, frame_time, network_fn=None, deformation_only=False):
+        """Drop-in replacement for `network_query_fn`; `network_fn` is ignored."""
+        if deformation_only:
+            position_delta = torch.zeros_like(inputs)
+            for t in torch.unique(frame_time):
+                rays = frame_time[:, 0] == t
+                position_delta[rays] = self.query_deformation(inputs[rays].reshape(-1, 3), t).reshape(inputs[rays].shape)
+            return position_delta
+
+        assert len(torch.unique(frame_time)) == 1, "Only accepts all points from same time"
+        cur_time = frame_time.reshape(-1)[0]
+
+        pts_flat = torch.reshape(inputs, [-1, 3])
+        dirs_flat = None
+        if viewdirs is not None:
+            dirs_flat = torch.reshape(viewdirs[:, None].expand(inputs.shape), [-1, 3])
+
+        raw_list = []
+        dx_list = []
+        for i in range(0, pts_flat.shape[0], self.chunk):
+            dx = self.query_deformation(pts_flat[i:i+self.chunk], cur_time)
+            raw = self.query_canonical(pts_flat[i:i+self.chunk] + dx,
+                                       dirs_flat[i:i+self.chunk] if dirs_flat is not None else None)
+            raw_list += [raw]
+            dx_list += [dx]
+
+        raw = torch.reshape(torch.cat(raw_list, 0), list(inputs.shape[:-1]) + [4])
+        position_delta = torch.reshape(torch.cat(dx_list, 0), list(inputs.shape[:-1]) + [3])
+        return raw, position_delta
+
+
 def hsv_to_rgb(h, s, v):
     '''
     h,s,v in range [0,1]
@@ -377,10 +1347,11 @@ def hsv_to_rgb(h, s, v):
 
 # Ray helpers
 ##
-def get_rays(H, W, focal, c2w):
+def get_rays(H, W, focal, c2w, offset=0.):
+    """offset: subpixel shift of the ray through each pixel, in pixels."""
     i, j = torch.meshgrid(torch.linspace(0, W-1, W), torch.linspace(0, H-1, H))  # pytorch's meshgrid has indexing='ij'
-    i = i.t()
-    j = j.t()
+    i = i.t() + offset
+    j = j.t() + offset
     dirs = torch.stack([(i-W*.5)/focal, -(j-H*.5)/focal, -torch.ones_like(i)], -1)
     # Rotate ray directions from camera frame to the world frame
     rays_d = torch.sum(dirs[..., np.newaxis, :] * c2w[:3,:3], -1)  # dot product, equals to: [c2w.dot(dir) for dir in dirs]
@@ -419,6 +1390,7 @@ def ndc_rays(H, W, focal, near, rays_o, rays_d):
     return rays_o, rays_d
 
 
+@profiled('importance_sampling_coords')
 def importance_sampling_coords(weights, N_samples, det=False, pytest=False):
     # Get pdf
     weights = weights + 1e-5 # prevent nans
@@ -451,6 +1423,7 @@ def importance_sampling_coords(weights, N_samples, det=False, pytest=False):
 
 
 # Hierarchical sampling (section 5.2)
+@profiled('importance_sampling_ray')
 def importance_sampling_ray(bins, weights, N_samples, det=False, pytest=False):
     # Get pdf
     weights = weights + 1e-5 # prevent nans
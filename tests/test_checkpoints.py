@@ -0,0 +1,66 @@
+import os, sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from run_endonerf_helpers import *
+
+
+def write_checkpoints(ckpt_dir, steps, keep_last, milestone, depth_versions):
+    """Saves a checkpoint at every step, the depth maps change at the steps of depth_versions
+    and the ray importance maps never. Returns the depth maps saved at each step."""
+    writer = CheckpointWriter(ckpt_dir, keep_last=keep_last, milestone=milestone, writer=BackgroundWriter())
+    importance = np.ones([2, 4, 5], np.float32)
+    depth_saved = {}
+    version = 0
+    for step in steps:
+        version = depth_versions.get(step, version)
+        depth = np.full([2, 4, 5], version, np.float32)
+        depth_saved[step] = depth
+        writer.save(step, {'global_step': step, 'network_fn_state_dict': {'w': torch.full([3], float(step))}},
+                    {'ray_importance_maps': (importance, 0), 'depth_maps': (depth, version)})
+    writer.writer.close()
+    return depth_saved
+
+
+def test_rotation_keeps_last_milestones_and_their_maps(tmp_path):
+    ckpt_dir = str(tmp_path)
+    depth_saved = write_checkpoints(ckpt_dir, [10, 20, 30, 40, 50, 60], keep_last=2, milestone=40,
+                                    depth_versions={30: 1, 50: 2})
+
+    # The last 2 and the multiples of 40. The importance maps of step 10 are still referenced by
+    # every kept checkpoint, the depth maps of step 10 by none
+    assert sorted(os.listdir(ckpt_dir)) == ['000040.tar', '000050.tar', '000060.tar', 'checkpoints.json',
+                                            'depth_maps_000030.npz', 'depth_maps_000050.npz',
+                                            'ray_importance_maps_000010.npz']
+
+    index = CheckpointWriter.read_index(ckpt_dir)
+    assert index['latest'] == '000060.tar'
+    assert [e['step'] for e in index['checkpoints']] == [40, 50, 60]
+    for entry in index['checkpoints']:
+        ckpt = load_checkpoint(os.path.join(ckpt_dir, entry['file']))
+        assert ckpt['global_step'] == entry['step']
+        assert ckpt['maps'] == entry['maps']
+        assert entry['maps']['ray_importance_maps'] == 'ray_importance_maps_000010.npz'
+        depth = np.load(os.path.join(ckpt_dir, entry['maps']['depth_maps']))['arr']
+        np.testing.assert_array_equal(depth, depth_saved[entry['step']])
+
+
+def test_keep_last_zero_keeps_all(tmp_path):
+    ckpt_dir = str(tmp_path)
+    write_checkpoints(ckpt_dir, [10, 20, 30], keep_last=0, milestone=0, depth_versions={20: 1})
+
+    assert sorted(os.listdir(ckpt_dir)) == ['000010.tar', '000020.tar', '000030.tar', 'checkpoints.json',
+                                            'depth_maps_000010.npz', 'depth_maps_000020.npz',
+                                            'ray_importance_maps_000010.npz']
+    assert [e['step'] for e in CheckpointWriter.read_index(ckpt_dir)['checkpoints']] == [10, 20, 30]
+
+
+def test_rotation_continues_the_index_of_a_resumed_run(tmp_path):
+    ckpt_dir = str(tmp_path)
+    write_checkpoints(ckpt_dir, [10, 20], keep_last=2, milestone=0, depth_versions={})
+    write_checkpoints(ckpt_dir, [30], keep_last=2, milestone=0, depth_versions={})
+
+    index = CheckpointWriter.read_index(ckpt_dir)
+    assert [e['step'] for e in index['checkpoints']] == [20, 30]
+    for entry in index['checkpoints']:
+        for file_name in entry['maps'].values():
+            assert os.path.exists(os.path.join(ckpt_dir, file_name))
@@ -0,0 +1,78 @@
+import os, sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import math
+
+import pytest
+
+from run_endonerf import *
+
+
+def reference_raw2outputs(raw, z_vals, rays_d, volumetric_function):
+    """raw2outputs as it was before the compositor registry, used as reference."""
+    if volumetric_function=="exp":
+        raw2alpha = lambda raw, dists, act_fn=F.relu: 1.-torch.exp(-act_fn(raw)*dists)
+    elif volumetric_function=="weighted_gaussian":
+        raw2alpha= lambda raw, dists, act_fn=F.relu: 1.-torch.exp(-((-act_fn(raw)*dists)-torch.mean((-act_fn(raw)*dists)))**2/(2*torch.std((-act_fn(raw)*dists))**2))
+    elif volumetric_function =="gaussian":
+        raw2alpha= lambda raw, dists, act_fn=F.relu: 1.-torch.exp(-torch.square(-act_fn(raw)*dists))
+    elif volumetric_function=="sqaure":
+        raw2alpha = lambda raw, dists, act_fn=F.relu: 1.-torch.square(-act_fn(raw)*dists)
+    elif volumetric_function=="tan":
+        raw2alpha= lambda raw, dists, act_fn=F.relu: 1.-torch.tan(-act_fn(raw)*dists)
+    elif volumetric_function=="tan_h":
+        raw2alpha= lambda raw, dists, act_fn=F.relu: 1.-torch.tanh(-act_fn(raw)*dists)
+    elif volumetric_function=="tan_pi":
+        raw2alpha =lambda raw, dists, act_fn=F.relu: 1.-torch.tan(-act_fn(raw)*dists * torch.tensor(math.pi/2))
+
+    dists = z_vals[...,1:] - z_vals[...,:-1]
+    dists = torch.cat([dists, torch.Tensor([1e10]).expand(dists[...,:1].shape)], -1)
+    dists = dists * torch.norm(rays_d[...,None,:], dim=-1)
+
+    rgb = torch.sigmoid(raw[...,:3])
+    alpha = raw2alpha(raw[...,3], dists)
+    weights = alpha * torch.cumprod(torch.cat([torch.ones((alpha.shape[0], 1)), 1.-alpha + 1e-10], -1), -1)[:, :-1]
+    rgb_map = torch.sum(weights[...,None] * rgb, -2)
+
+    depth_map = torch.sum(weights * z_vals * torch.norm(rays_d[...,None,:], dim=-1), -1)
+    disp_map = 1./torch.max(1e-10 * torch.ones_like(depth_map), depth_map / (torch.sum(weights, -1)  + 1e-6))
+    acc_map = torch.sum(weights, -1)
+    return rgb_map, disp_map, acc_map, weights, depth_map
+
+
+def random_inputs(n_rays, n_samples, density_scale):
+    raw = torch.randn(n_rays, n_samples, 4)
+    raw[...,3] = raw[...,3] * density_scale
+    z_vals, _ = torch.sort(torch.rand(n_rays, n_samples), -1)
+    rays_d = torch.randn(n_rays, 3)
+    return raw, z_vals, rays_d
+
+
+def assert_close_where_finite(a, b, name):
+    """tan and sqaure can legitimately overflow, the overflowing entries are compared by position."""
+    finite = torch.isfinite(a) & torch.isfinite(b)
+    assert torch.equal(finite, torch.isfinite(a)), name
+    assert torch.allclose(a[finite], b[finite], rtol=1e-4, atol=1e-5), \
+        '{}: max |diff| {:.2e}'.format(name, (a[finite] - b[finite]).abs().max().item())
+
+
+@pytest.mark.parametrize('name', list(COMPOSITORS.keys()))
+@pytest.mark.parametrize('density_scale', [0.1, 5.])
+def test_compositor_matches_reference(name, density_scale):
+    """Every compositor must reproduce the old raw2outputs, forward and backward through the rgb
+    map, the log-space transmittance and the dropped +1e-10 of the cumprod included."""
+    torch.manual_seed(0)
+    raw, z_vals, rays_d = random_inputs(256, 64, density_scale)
+    raw_new, raw_ref = raw.clone().requires_grad_(True), raw.clone().requires_grad_(True)
+
+    out_new = raw2outputs(raw_new, z_vals, rays_d, compositor=COMPOSITORS[name])
+    out_ref = reference_raw2outputs(raw_ref, z_vals, rays_d, name)
+    for key, a, b in zip(['rgb_map', 'disp_map', 'acc_map', 'weights', 'depth_map'], out_new, out_ref):
+        assert a.shape == b.shape, key
+        assert_close_where_finite(a.detach(), b.detach(), key)
+
+    rgb_new, rgb_ref = out_new[0], out_ref[0]
+    keep = torch.isfinite(rgb_ref).all(-1)
+    rgb_new[keep].sum().backward()
+    rgb_ref[keep].sum().backward()
+    assert_close_where_finite(raw_new.grad, raw_ref.grad, 'grad')
@@ -0,0 +1,78 @@
+import os, sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+from run_endonerf import *
+
+
+def make_network(use_viewdirs):
+    embed_fn, input_ch = get_embedder(4, 3)
+    embedtime_fn, input_ch_time = get_embedder(2, 1)
+    embeddirs_fn, input_ch_views = get_embedder(2, 3) if use_viewdirs else (None, 0)
+    model = DirectTemporalNeRF(D=2, W=16, input_ch=input_ch, input_ch_views=input_ch_views, input_ch_time=input_ch_time,
+                               output_ch=5, skips=[], use_viewdirs=use_viewdirs, embed_fn=embed_fn)
+    calls = []
+
+    def network_query_fn(inputs, viewdirs, ts, network_fn, **kwargs):
+        calls.append(inputs.shape)
+        return run_network(inputs, viewdirs, ts, network_fn, embed_fn=embed_fn, embeddirs_fn=embeddirs_fn,
+                           embedtime_fn=embedtime_fn, **kwargs)
+    return model, network_query_fn, calls
+
+
+def make_samples(N_rays=8, N_samples=16, t=0.5):
+    pts = torch.rand(N_rays, N_samples, 3) * 2. - 1.
+    viewdirs = F.normalize(torch.randn(N_rays, 3), dim=-1)
+    frame_time = torch.full((N_rays, 1), t)
+    return pts, viewdirs, frame_time
+
+
+def test_query_outside_bbox_is_occupied():
+    grid = OccupancyGrid([-1., -1., -1.], [1., 1., 1.], resolution=8)
+    grid.occupied[:] = False
+    pts = torch.tensor([[0., 0., 0.], [0.5, -0.5, 0.2], [1.5, 0., 0.], [0., -2., 0.]])
+    assert grid.query(pts).tolist() == [False, False, True, True]
+
+
+@pytest.mark.parametrize('use_viewdirs', [True, False])
+def test_full_grid_matches_network(use_viewdirs):
+    torch.manual_seed(0)
+    model, network_query_fn, _ = make_network(use_viewdirs)
+    pts, viewdirs, frame_time = make_samples()
+    grid = OccupancyGrid([-1., -1., -1.], [1., 1., 1.], resolution=8)
+    viewdirs = viewdirs if use_viewdirs else None
+
+    with torch.no_grad():
+        raw_ref, dx_ref = network_query_fn(pts, viewdirs, frame_time, model)
+        raw, dx, n_evaluated = run_network_occupied(network_query_fn, pts, viewdirs, frame_time, model, grid)
+    assert raw.shape == raw_ref.shape
+    assert torch.allclose(raw, raw_ref, atol=1e-5)
+    assert torch.allclose(dx, dx_ref, atol=1e-5)
+    assert n_evaluated.tolist() == [pts.shape[1]] * pts.shape[0]
+
+
+@pytest.mark.parametrize('use_viewdirs', [True, False])
+def test_empty_grid_skips_network(use_viewdirs):
+    torch.manual_seed(0)
+    model, network_query_fn, calls = make_network(use_viewdirs)
+    pts, viewdirs, frame_time = make_samples()
+    grid = OccupancyGrid([-1., -1., -1.], [1., 1., 1.], resolution=8)
+    grid.occupied[:] = False
+
+    raw, dx, n_evaluated = run_network_occupied(network_query_fn, pts, viewdirs if use_viewdirs else None,
+                                                frame_time, model, grid)
+    assert calls == []
+    assert raw.shape == pts.shape[:-1] + (model.output_ch,)
+    assert (raw[..., 3] == -1e10).all()
+    assert (raw[..., :3] == 0).all()
+    assert (dx == 0).all() and dx.shape == pts.shape
+    assert (n_evaluated == 0).all()
+
+    dx = query_deformation(network_query_fn, pts, frame_time, model, grid)
+    assert calls == []
+    assert (dx == 0).all() and dx.shape == pts.shape
+
+    rgb_map, disp_map, acc_map, _, _ = raw2outputs(raw, torch.linspace(0., 1., pts.shape[1]).expand(pts.shape[:-1]),
+                                                   F.normalize(torch.randn(pts.shape[0], 3), dim=-1))
+    assert (acc_map == 0).all() and (rgb_map == 0).all()
@@ -0,0 +1,53 @@
+import os, sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+from run_endonerf import *
+
+
+def make_render_kwargs(use_viewdirs):
+    embed_fn, input_ch = get_embedder(4, 3)
+    embedtime_fn, input_ch_time = get_embedder(2, 1)
+    embeddirs_fn, input_ch_views = get_embedder(2, 3) if use_viewdirs else (None, 0)
+    model = DirectTemporalNeRF(D=2, W=32, input_ch=input_ch, input_ch_views=input_ch_views, input_ch_time=input_ch_time,
+                               output_ch=5, skips=[], use_viewdirs=use_viewdirs, embed_fn=embed_fn)
+    network_query_fn = lambda inputs, viewdirs, ts, network_fn, **kwargs: run_network(
+        inputs, viewdirs, ts, network_fn, embed_fn=embed_fn, embeddirs_fn=embeddirs_fn, embedtime_fn=embedtime_fn, **kwargs)
+    return model, {'network_fn': model, 'network_query_fn': network_query_fn, 'N_samples': 16, 'N_importance': 8,
+                   'perturb': 0., 'raw_noise_std': 0.}
+
+
+def make_rays(N_rays, t, use_viewdirs):
+    rays_o = torch.randn(N_rays, 3) * 0.1
+    rays_d = F.normalize(torch.randn(N_rays, 3) * 0.2 + torch.tensor([0., 0., -1.]), dim=-1)
+    rays = [rays_o, rays_d, torch.zeros(N_rays, 1), torch.ones(N_rays, 1), torch.full((N_rays, 1), t)]
+    if use_viewdirs:
+        rays.append(rays_d)
+    return torch.cat(rays, -1)
+
+
+@pytest.mark.parametrize('use_viewdirs', [True, False])
+@pytest.mark.parametrize('t', [0., 0.5])
+def test_coarse_reuse_matches_full_evaluation(use_viewdirs, t):
+    """The fine pass of a single network reuses the coarse outputs and only evaluates the
+    importance samples; it must match evaluating all N_samples + N_importance samples, which
+    render_rays does when the fine network is given explicitly."""
+    torch.manual_seed(0)
+    model, render_kwargs = make_render_kwargs(use_viewdirs)
+    ray_batch = make_rays(64, t, use_viewdirs)
+    outputs = ['rgb_map', 'disp_map', 'acc_map', 'z_vals', 'position_delta']
+
+    results = {}
+    for name, network_fine in [('reuse', None), ('full', model)]:
+        model.zero_grad()
+        ret = render_rays(ray_batch, network_fine=network_fine, outputs=outputs, **render_kwargs)
+        (ret['rgb_map'].sum() + ret['disp_map'].sum() + ret['position_delta'].sum()).backward()
+        results[name] = ret, {k: p.grad.clone() for k, p in model.named_parameters() if p.grad is not None}
+
+    (reuse, reuse_grads), (full, full_grads) = results['reuse'], results['full']
+    for k in outputs:
+        assert torch.allclose(reuse[k], full[k], atol=1e-5), k
+    assert reuse_grads.keys() == full_grads.keys() and len(reuse_grads) > 0
+    for k in reuse_grads:
+        assert torch.allclose(reuse_grads[k], full_grads[k], rtol=1e-4, atol=1e-5), k